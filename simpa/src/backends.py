@@ -0,0 +1,200 @@
+import importlib
+import multiprocessing
+import queue
+import sys
+import threading
+from typing import Callable, Iterable, Optional
+
+BACKENDS = ["multiprocessing", "dask"]
+
+
+def get_pool_context():
+    """Prefer fork so that workers inherit the loaded ICD10 graph copy-on-write."""
+    if "fork" in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context("fork")
+    return multiprocessing.get_context()
+
+
+class PoolBackend:
+    """Maps tasks over a multiprocessing.Pool of this machine.
+
+    start hands the shared state to every worker once through the pool
+    initializer, so tasks only carry their own arguments, e.g. tile coordinates.
+    """
+
+    def __init__(self, processes: Optional[int] = None):
+        self.processes = processes
+        self.pool = None
+
+    def start(self, initializer: Callable, initargs: tuple) -> "PoolBackend":
+        self.pool = get_pool_context().Pool(
+            self.processes, initializer=initializer, initargs=initargs
+        )
+        return self
+
+    def imap_unordered(self, func: Callable, iterable: Iterable):
+        """Results of func over iterable in completion order, with next(timeout)
+        raising multiprocessing.TimeoutError like a pool iterator."""
+        return self.pool.imap_unordered(func, iterable)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def _importable(func: Callable) -> Callable:
+    """func, or for a function of a script run with python -m the same function
+    of its module imported by name. Dask pickles such functions by reference, so
+    that the tasks of a worker share the module globals its initializer sets."""
+    if func.__module__ != "__main__":
+        return func
+    spec = getattr(sys.modules["__main__"], "__spec__", None)
+    if spec is None:
+        raise ValueError("Run the script with python -m to use the dask backend.")
+    return getattr(importlib.import_module(spec.name), func.__qualname__)
+
+
+# state of a dask worker process that _run_initialized has been initialized with
+_initialized_state = None
+_initialize_lock = threading.Lock()
+
+
+def _run_initialized(func: Callable, initializer: Callable, state: tuple, item):
+    """Dask task, runs initializer with the scattered state once per worker
+    process before calling func on item."""
+    global _initialized_state
+    with _initialize_lock:
+        if _initialized_state is not state:
+            initializer(*state)
+            _initialized_state = state
+    return func(item)
+
+
+class DaskResults:
+    """Iterator over the results of Dask tasks in completion order, with
+    next(timeout) like a pool iterator.
+
+    A feeder thread submits a task for every item of iterable as it comes, so an
+    iterable that blocks, e.g. on a semaphore, throttles the submission.
+    """
+
+    def __init__(self, client, func: Callable, iterable: Iterable, initializer, state):
+        self.done = queue.Queue()
+        self.submitted = 0
+        self.returned = 0
+        self.fed = threading.Event()
+        self.error = None
+        self.feeder = threading.Thread(
+            target=self._feed,
+            args=(client, func, iterable, initializer, state),
+            daemon=True,
+        )
+        self.feeder.start()
+
+    def _feed(self, client, func, iterable, initializer, state):
+        try:
+            for item in iterable:
+                future = client.submit(
+                    _run_initialized, func, initializer, state, item, pure=False
+                )
+                self.submitted += 1
+                future.add_done_callback(self.done.put)
+        except Exception as e:
+            self.error = e
+        finally:
+            self.fed.set()
+
+    def next(self, timeout: Optional[float] = None):
+        waited = 0.0
+        while True:
+            if self.error is not None:
+                raise self.error
+            if self.fed.is_set() and self.returned == self.submitted:
+                raise StopIteration
+            try:
+                future = self.done.get(timeout=0.1)
+            except queue.Empty:
+                waited += 0.1
+                if timeout is not None and waited >= timeout:
+                    raise multiprocessing.TimeoutError
+                continue
+            self.returned += 1
+            return future.result()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return self.next()
+
+
+class DaskBackend:
+    """Maps tasks over the workers of a Dask cluster, a LocalCluster unless the
+    address of a scheduler is given.
+
+    start scatters the shared state to every worker once, tasks refer to the
+    scattered copy and the initializer runs once per worker process.
+    """
+
+    def __init__(self, address: Optional[str] = None, n_workers: Optional[int] = None):
+        self.address = address
+        self.n_workers = n_workers
+        self.client = None
+        self.cluster = None
+
+    def start(self, initializer: Callable, initargs: tuple) -> "DaskBackend":
+        from dask.distributed import Client, LocalCluster
+
+        if self.address:
+            self.client = Client(self.address)
+        else:
+            # the comparisons are pure python, so processes instead of threads
+            self.cluster = LocalCluster(
+                n_workers=self.n_workers, threads_per_worker=1, processes=True
+            )
+            self.client = Client(self.cluster)
+        self.initializer = _importable(initializer)
+        # one future for the whole tuple, so that every task of a worker gets
+        # the same object and _run_initialized initializes the worker once
+        [self.state] = self.client.scatter([initargs], broadcast=True, hash=False)
+        return self
+
+    def imap_unordered(self, func: Callable, iterable: Iterable) -> DaskResults:
+        return DaskResults(
+            self.client, _importable(func), iterable, self.initializer, self.state
+        )
+
+    def close(self):
+        if self.client is not None:
+            self.client.close()
+            self.client = None
+        if self.cluster is not None:
+            self.cluster.close()
+            self.cluster = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def make_backend(
+    backend: str = "multiprocessing",
+    address: Optional[str] = None,
+    processes: Optional[int] = None,
+):
+    """Execution backend for tile tasks, see BACKENDS. address is the Dask
+    scheduler to connect to, processes the number of local workers."""
+    if backend == "multiprocessing":
+        return PoolBackend(processes)
+    if backend == "dask":
+        return DaskBackend(address, processes)
+    raise ValueError(f"Unknown backend {backend}")
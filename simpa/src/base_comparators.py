@@ -1,13 +1,19 @@
 from abc import ABC, abstractmethod
-import statistics
+from typing import Iterable, Optional, Union
+import numpy as np
+from scipy.sparse import csr_matrix
 from scipy.stats import norm
 
+from simpa.src.minhash import MinHashLSHIndex
 from simpa.src.schemas import CodedNumerical, Numerical
 
 
 class BaseComparator(ABC):
+    # types that are compared with _compare_set
+    set_types: tuple = (list,)
+
     def compare(self, a, b, *args, **kwargs):
-        if isinstance(a, list) or isinstance(b, list):
+        if isinstance(a, self.set_types) or isinstance(b, self.set_types):
             return self._compare_set(a, b, *args, **kwargs)
         else:
             return self._compare_pair(a, b, *args, **kwargs)
@@ -37,7 +43,66 @@ def items_have_mean_and_std(a: CodedNumerical, b: CodedNumerical):
     )
 
 
+def to_float_array(values: list) -> np.ndarray:
+    return np.array([np.nan if v is None else v for v in values], dtype=np.float64)
+
+
+def match_sorted_ids(ids_a: np.ndarray, ids_b: np.ndarray):
+    """Index pairs (i, j) with ids_a[i] == ids_b[j] for two sorted id arrays.
+
+    Repeated ids yield all their combinations, like a nested loop would.
+    """
+    left = np.searchsorted(ids_b, ids_a, side="left")
+    right = np.searchsorted(ids_b, ids_a, side="right")
+    counts = right - left
+    offsets = np.cumsum(counts) - counts
+    index_a = np.repeat(np.arange(len(ids_a)), counts)
+    index_b = np.repeat(left - offsets, counts) + np.arange(counts.sum())
+    return index_a, index_b
+
+
+class DistributionItems:
+    """The CodedNumerical items of one encounter as arrays sorted by id.
+
+    The percentile of each value in its item distribution is computed once here
+    and is NaN if the value or the distribution is missing.
+    """
+
+    __slots__ = ("hadm_id", "ids", "percentiles", "abnormal")
+
+    def __init__(
+        self,
+        hadm_id: int,
+        ids: np.ndarray,
+        percentiles: np.ndarray,
+        abnormal: np.ndarray,
+    ):
+        self.hadm_id = hadm_id
+        self.ids = ids
+        self.percentiles = percentiles
+        self.abnormal = abnormal
+
+    @classmethod
+    def from_items(cls, items: list[CodedNumerical]) -> "DistributionItems":
+        hadm_id = items[0].hadm_id if len(items) > 0 else None
+        ids = np.array([i.id for i in items])
+        values = to_float_array([i.value for i in items])
+        means = to_float_array([i.id_mean for i in items])
+        std_devs = to_float_array([i.id_std_dev for i in items])
+        std_devs[std_devs == 0] = np.nan
+        percentiles = norm.cdf((values - means) / std_devs)
+        abnormal = np.array([bool(i.abnormal) for i in items], dtype=bool)
+
+        order = np.argsort(ids, kind="stable")
+        return cls(hadm_id, ids[order], percentiles[order], abnormal[order])
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+
 class DistributionComparator(BaseComparator):
+    set_types = (list, DistributionItems)
+
     def __init__(self):
         pass
 
@@ -89,31 +154,189 @@ class DistributionComparator(BaseComparator):
 
     def _compare_set(
         self,
-        set_a: list[CodedNumerical],
-        set_b: list[CodedNumerical],
+        set_a: Union[list[CodedNumerical], DistributionItems],
+        set_b: Union[list[CodedNumerical], DistributionItems],
         scale_by_distribution: bool = True,
         aggregation: str = "mean",
     ) -> float:
-        similarities = []
-        for a in set_a:
-            for b in set_b:
-                if a.id == b.id:
-                    similarity = self._compare_pair(
-                        a=a,
-                        b=b,
-                        scale_by_distribution=scale_by_distribution,
-                    )
-                    if similarity is not None:
-                        similarities.append(similarity)
+        if not isinstance(set_a, DistributionItems):
+            set_a = DistributionItems.from_items(set_a)
+        if not isinstance(set_b, DistributionItems):
+            set_b = DistributionItems.from_items(set_b)
+        if len(set_a) == 0 or len(set_b) == 0:
+            return None
+
+        index_a, index_b = match_sorted_ids(set_a.ids, set_b.ids)
+        if set_a.hadm_id == set_b.hadm_id:
+            similarities = np.ones(len(index_a))
+        else:
+            p_a = set_a.percentiles[index_a]
+            p_b = set_b.percentiles[index_b]
+            valid = ~np.isnan(p_a) & ~np.isnan(p_b)
+            valid &= set_a.abnormal[index_a] | set_b.abnormal[index_b]
+            p_a = p_a[valid]
+            p_b = p_b[valid]
+
+            similarities = 1 - np.abs(p_a - p_b)
+            if scale_by_distribution:
+                mean_percentiles = (p_a + p_b) / 2
+                similarities *= 2 * np.abs(mean_percentiles - 0.5)
+
         if aggregation == "mean":
             if len(similarities) == 0:
                 similarity = None
-            elif len(similarities) == 1:
-                similarity = similarities[0]
             else:
-                similarity = statistics.mean(similarities)
+                similarity = float(similarities.mean())
+        else:
+            raise ValueError(f"Unknown aggregation {aggregation}")
         return similarity
 
+    def compare_cohort(
+        self,
+        encounters: list[Optional[DistributionItems]],
+        scale_by_distribution: bool = True,
+        block_size: int = 256,
+        dtype=np.float32,
+    ) -> np.ndarray:
+        """Set similarity of all encounter pairs as a (N, N) matrix.
+
+        Builds an encounters x items percentile matrix with an abnormal mask and
+        accumulates the item similarities item by item for blocks of rows.
+        Entries where _compare_set returns None are NaN. Encounters without
+        items are given as None or empty DistributionItems. Repeated items of
+        one encounter are collapsed to their mean percentile.
+        """
+        n = len(encounters)
+        encounters = [
+            e if e is not None else DistributionItems.from_items([]) for e in encounters
+        ]
+        percentiles, abnormal = self._percentile_matrix(encounters)
+        has_items = np.array([len(e) > 0 for e in encounters])
+
+        result = np.full((n, n), np.nan, dtype=dtype)
+        item_rows = [
+            np.flatnonzero(~np.isnan(percentiles[:, m]))
+            for m in range(percentiles.shape[1])
+        ]
+        for start in range(0, n, block_size):
+            end = min(start + block_size, n)
+            sums = np.zeros((end - start, n))
+            counts = np.zeros((end - start, n))
+            for m, rows in enumerate(item_rows):
+                block_rows = rows[(rows >= start) & (rows < end)]
+                if len(block_rows) == 0:
+                    continue
+                p_a = percentiles[block_rows, m][:, None]
+                p_b = percentiles[rows, m][None, :]
+                similarities = 1 - np.abs(p_a - p_b)
+                if scale_by_distribution:
+                    similarities *= 2 * np.abs((p_a + p_b) / 2 - 0.5)
+                valid = abnormal[block_rows, m][:, None] | abnormal[rows, m][None, :]
+                block_index = np.ix_(block_rows - start, rows)
+                sums[block_index] += np.where(valid, similarities, 0.0)
+                counts[block_index] += valid
+
+            with np.errstate(divide="ignore", invalid="ignore"):
+                result[start:end] = np.where(counts > 0, sums / counts, np.nan)
+
+        # equal encounters are similar in every common item
+        np.fill_diagonal(result, np.where(has_items, 1.0, np.nan))
+        return result
+
+    def compare_block(
+        self,
+        encounters_a: list[Optional[DistributionItems]],
+        encounters_b: list[Optional[DistributionItems]],
+        scale_by_distribution: bool = True,
+        dtype=np.float32,
+    ) -> np.ndarray:
+        """Like compare_cohort, for encounters_a against encounters_b as a
+        (len(encounters_a), len(encounters_b)) matrix, e.g. for a tile of the
+        cohort. Only the items of these encounters are accumulated."""
+        n_a = len(encounters_a)
+        encounters = [
+            e if e is not None else DistributionItems.from_items([])
+            for e in [*encounters_a, *encounters_b]
+        ]
+        percentiles, abnormal = self._percentile_matrix(encounters)
+
+        sums = np.zeros((n_a, len(encounters) - n_a))
+        counts = np.zeros((n_a, len(encounters) - n_a))
+        for m in range(percentiles.shape[1]):
+            rows = ~np.isnan(percentiles[:, m])
+            rows_a = np.flatnonzero(rows[:n_a])
+            rows_b = np.flatnonzero(rows[n_a:]) + n_a
+            if len(rows_a) == 0 or len(rows_b) == 0:
+                continue
+            p_a = percentiles[rows_a, m][:, None]
+            p_b = percentiles[rows_b, m][None, :]
+            similarities = 1 - np.abs(p_a - p_b)
+            if scale_by_distribution:
+                similarities *= 2 * np.abs((p_a + p_b) / 2 - 0.5)
+            valid = abnormal[rows_a, m][:, None] | abnormal[rows_b, m][None, :]
+            block_index = np.ix_(rows_a, rows_b - n_a)
+            sums[block_index] += np.where(valid, similarities, 0.0)
+            counts[block_index] += valid
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            result = np.where(counts > 0, sums / counts, np.nan).astype(dtype)
+        # equal encounters are similar in every common item
+        hadm_ids = np.array([e.hadm_id if len(e) > 0 else -1 for e in encounters])
+        equal = hadm_ids[:n_a, None] == hadm_ids[None, n_a:]
+        result[equal & (hadm_ids[:n_a, None] != -1)] = 1.0
+        return result
+
+    def _percentile_matrix(self, encounters: list[DistributionItems]):
+        ids = [e.ids for e in encounters if len(e) > 0]
+        items = np.unique(np.concatenate(ids)) if len(ids) > 0 else np.empty(0)
+        percentiles = np.zeros((len(encounters), len(items)))
+        counts = np.zeros((len(encounters), len(items)))
+        abnormal = np.zeros((len(encounters), len(items)), dtype=bool)
+        for i, encounter in enumerate(encounters):
+            if len(encounter) == 0:
+                continue
+            columns = np.searchsorted(items, encounter.ids)
+            valid = ~np.isnan(encounter.percentiles)
+            np.add.at(percentiles[i], columns[valid], encounter.percentiles[valid])
+            np.add.at(counts[i], columns[valid], 1)
+            np.logical_or.at(abnormal[i], columns, encounter.abnormal)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            percentiles = np.where(counts > 0, percentiles / counts, np.nan)
+        return percentiles, abnormal
+
+
+def binary_matrix(value_sets: list[Optional[Iterable]]) -> csr_matrix:
+    """Encode each set of values as a row of a binary (N, vocabulary) CSR matrix."""
+    vocabulary = {}
+    indptr = [0]
+    indices = []
+    for values in value_sets:
+        values = set(values) if values is not None else set()
+        indices.extend(vocabulary.setdefault(v, len(vocabulary)) for v in values)
+        indptr.append(len(indices))
+    data = np.ones(len(indices), dtype=np.int32)
+    return csr_matrix(
+        (data, np.array(indices, dtype=np.int64), np.array(indptr, dtype=np.int64)),
+        shape=(len(value_sets), len(vocabulary)),
+    )
+
+
+def jaccard_blocks(matrix: csr_matrix, block_size: int = 1024, upper: bool = True):
+    """Yield (start, block) of the all-pairs Jaccard similarity of a binary matrix.
+
+    block holds rows start:start + block_size against all columns, or only the
+    columns from start on if upper is set. Intersections come from one sparse
+    product per block, unions from the row sums. Pairs of empty rows are NaN.
+    """
+    sizes = np.asarray(matrix.sum(axis=1)).ravel()
+    for start in range(0, matrix.shape[0], block_size):
+        end = min(start + block_size, matrix.shape[0])
+        column_start = start if upper else 0
+        intersection = (matrix[start:end] @ matrix[column_start:].T).toarray()
+        union = sizes[start:end, None] + sizes[None, column_start:] - intersection
+        with np.errstate(divide="ignore", invalid="ignore"):
+            yield start, np.where(union > 0, intersection / union, np.nan)
+
 
 class BinaryComparator(BaseComparator):
     def __init__(self):
@@ -132,6 +355,95 @@ class BinaryComparator(BaseComparator):
         union = set_a.union(set_b)
         return len(intersection) / len(union)
 
+    def compare_cohort(
+        self,
+        encounters: list[Optional[list]],
+        block_size: int = 1024,
+        dtype=np.float32,
+    ) -> np.ndarray:
+        """Jaccard similarity of all encounter pairs as a (N, N) matrix.
+
+        Encounters without items are given as None or an empty list, pairs of
+        two such encounters are NaN.
+        """
+        return self.compare_cohort_values(
+            [[i.value for i in e] if e is not None else None for e in encounters],
+            block_size=block_size,
+            dtype=dtype,
+        )
+
+    def compare_cohort_values(
+        self,
+        value_sets: list[Optional[Iterable]],
+        block_size: int = 1024,
+        dtype=np.float32,
+    ) -> np.ndarray:
+        """Like compare_cohort, for the item values of the encounters, e.g. the
+        columns of an EncounterStore."""
+        matrix = binary_matrix(value_sets)
+        n = len(value_sets)
+        result = np.empty((n, n), dtype=dtype)
+        for start, block in jaccard_blocks(matrix, block_size=block_size):
+            end = start + len(block)
+            result[start:end, start:] = block
+            result[start:, start:end] = block.T
+        return result
+
+    def compare_block_values(
+        self,
+        value_sets_a: list[Optional[Iterable]],
+        value_sets_b: list[Optional[Iterable]],
+        dtype=np.float32,
+        pairs: Optional[tuple[np.ndarray, np.ndarray]] = None,
+    ) -> np.ndarray:
+        """Like compare_cohort_values, for value_sets_a against value_sets_b as a
+        (len(value_sets_a), len(value_sets_b)) matrix, e.g. for a tile of the
+        cohort. With pairs (rows, columns), e.g. the LSH candidates of the
+        block, only those pairs are compared, the others are 0, or NaN if both
+        sets are empty."""
+        n_a = len(value_sets_a)
+        matrix = binary_matrix([*value_sets_a, *value_sets_b])
+        sizes = np.asarray(matrix.sum(axis=1)).ravel()
+        if pairs is None:
+            intersection = (matrix[:n_a] @ matrix[n_a:].T).toarray()
+            union = sizes[:n_a, None] + sizes[None, n_a:] - intersection
+            with np.errstate(divide="ignore", invalid="ignore"):
+                return np.where(union > 0, intersection / union, np.nan).astype(dtype)
+        rows, columns = pairs
+        result = np.where(
+            (sizes[:n_a, None] == 0) & (sizes[None, n_a:] == 0), np.nan, 0
+        ).astype(dtype)
+        intersection = np.asarray(
+            matrix[rows].multiply(matrix[n_a + columns]).sum(axis=1)
+        ).ravel()
+        union = sizes[rows] + sizes[n_a + columns] - intersection
+        with np.errstate(divide="ignore", invalid="ignore"):
+            result[rows, columns] = np.where(
+                union > 0, intersection / union, np.nan
+            )
+        return result
+
+    def build_lsh_index(
+        self, keys: list, encounters: list[list], **kwargs
+    ) -> MinHashLSHIndex:
+        """MinHash LSH index over the item values of encounters, for candidate
+        pairs and top k queries without comparing all pairs. Encounters without
+        items (None) are indexed as empty sets."""
+        return self.build_lsh_index_values(
+            keys, [[i.value for i in e or []] for e in encounters], **kwargs
+        )
+
+    def build_lsh_index_values(
+        self, keys: list, value_sets: list[Optional[Iterable]], **kwargs
+    ) -> MinHashLSHIndex:
+        """Like build_lsh_index, for the value sets of the encounters, e.g. from
+        an EncounterStore."""
+        index = MinHashLSHIndex(**kwargs)
+        index.add(
+            keys, [[] if values is None else values for values in value_sets]
+        )
+        return index
+
 
 class NumericalComparator(BaseComparator):
     def __init__(self):
@@ -0,0 +1,153 @@
+import fcntl
+import hashlib
+import logging
+import os
+from typing import Iterable, Optional
+
+import numpy as np
+
+from simpa.src.ontology_index import OntologyIndex
+
+logger = logging.getLogger(__name__)
+
+# bump when the file layout or the similarity computation changes
+STORE_VERSION = 1
+STORE_DTYPE = np.dtype([("key", "<u8"), ("value", "<f8")])
+DEFAULT_STORE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "simpa")
+# computed pairs that are kept in memory before they are flushed to the store
+FLUSH_THRESHOLD = 1_000_000
+
+
+def ontology_checksum(index: OntologyIndex) -> str:
+    """Checksum of the graph structure and node ordering of an OntologyIndex."""
+    checksum = hashlib.sha256()
+    checksum.update("\n".join(str(node) for node in index.nodes).encode())
+    checksum.update(np.ascontiguousarray(index.ancestors).tobytes())
+    return checksum.hexdigest()
+
+
+class CodePairSimilarityStore:
+    """On-disk store of code pair similarities in front of an OntologyIndex.
+
+    One file per (ic_metric, cs_metric) holds the sorted pair keys and
+    similarities of all pairs computed so far. The file name contains the store
+    version and the checksum of the graph, so a changed graph never reads stale
+    values. Files are memory-mapped for lookups, misses are computed with the
+    index and written back on flush(), or once flush_threshold of them are
+    pending. Processes may share a store, flush() merges with the pairs that
+    others flushed meanwhile.
+    """
+
+    def __init__(
+        self,
+        index: OntologyIndex,
+        path: Optional[str] = None,
+        flush_threshold: int = FLUSH_THRESHOLD,
+    ):
+        self.index = index
+        self.path = path or os.getenv("SIMPA_CACHE_DIR", DEFAULT_STORE_DIR)
+        self.checksum = ontology_checksum(index)
+        self.n_nodes = len(index.nodes)
+        self.hits = 0
+        self.misses = 0
+        self.flush_threshold = flush_threshold
+        self._tables: dict[tuple[str, str], np.ndarray] = {}
+        self._pending: dict[tuple[str, str], list[np.ndarray]] = {}
+        self._n_pending = 0
+
+    def get_ids(self, nodes: Iterable) -> np.ndarray:
+        return self.index.get_ids(nodes)
+
+    def similarity_matrix(
+        self,
+        nodes_0: Iterable,
+        nodes_1: Iterable,
+        ic_metric: str = "intrinsic_ic_sanchez",
+        cs_metric: str = "lin",
+    ) -> np.ndarray:
+        """Similarity of all node pairs, shape (len(nodes_0), len(nodes_1))."""
+        ids_0, ids_1 = np.meshgrid(
+            self.get_ids(nodes_0), self.get_ids(nodes_1), indexing="ij"
+        )
+        result = self.similarity_by_id(
+            ids_0.ravel(), ids_1.ravel(), ic_metric, cs_metric
+        )
+        return result.reshape(ids_0.shape)
+
+    def similarity_by_id(
+        self,
+        ids_0: np.ndarray,
+        ids_1: np.ndarray,
+        ic_metric: str = "intrinsic_ic_sanchez",
+        cs_metric: str = "lin",
+    ) -> np.ndarray:
+        table = self._get_table(ic_metric, cs_metric)
+        keys = self._keys(ids_0, ids_1)
+        result = np.empty(len(keys), dtype=np.float64)
+
+        positions = np.searchsorted(table["key"], keys)
+        found = positions < len(table)
+        found[found] = table["key"][positions[found]] == keys[found]
+        result[found] = table["value"][positions[found]]
+
+        missing = ~found
+        if missing.any():
+            result[missing] = self.index.similarity_by_id(
+                ids_0[missing], ids_1[missing], ic_metric, cs_metric
+            )
+            pending = np.empty(int(missing.sum()), dtype=STORE_DTYPE)
+            pending["key"] = keys[missing]
+            pending["value"] = result[missing]
+            self._pending.setdefault((ic_metric, cs_metric), []).append(pending)
+            self._n_pending += len(pending)
+        self.hits += int(found.sum())
+        self.misses += int(missing.sum())
+        if self._n_pending >= self.flush_threshold:
+            self.flush()
+        return result
+
+    def flush(self):
+        """Merge the computed misses into the store files.
+
+        A file is re-read and replaced while holding a lock on it, so pairs
+        that other processes flushed since it was opened are kept.
+        """
+        for (ic_metric, cs_metric), pending in self._pending.items():
+            file_path = self._file_path(ic_metric, cs_metric)
+            os.makedirs(self.path, exist_ok=True)
+            with open(f"{file_path}.lock", "w") as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                stored = self._load_table(file_path)
+                table = np.concatenate([stored, *pending])
+                _, unique = np.unique(table["key"], return_index=True)
+                table = table[unique]
+
+                tmp_path = f"{file_path}.{os.getpid()}.tmp"
+                with open(tmp_path, "wb") as f:
+                    np.save(f, table)
+                os.replace(tmp_path, file_path)
+            self._tables[(ic_metric, cs_metric)] = np.load(file_path, mmap_mode="r")
+            logger.info(f"Stored {len(table)} code pair similarities in {file_path}.")
+        self._pending = {}
+        self._n_pending = 0
+
+    def _keys(self, ids_0: np.ndarray, ids_1: np.ndarray) -> np.ndarray:
+        # all supported metrics are symmetric, so (a, b) and (b, a) share a key
+        low = np.minimum(ids_0, ids_1).astype(np.uint64)
+        high = np.maximum(ids_0, ids_1).astype(np.uint64)
+        return low * np.uint64(self.n_nodes) + high
+
+    def _file_path(self, ic_metric: str, cs_metric: str) -> str:
+        name = f"code_pairs_v{STORE_VERSION}_{self.checksum[:16]}_{ic_metric}_{cs_metric}.npy"
+        return os.path.join(self.path, name)
+
+    def _get_table(self, ic_metric: str, cs_metric: str) -> np.ndarray:
+        key = (ic_metric, cs_metric)
+        if key not in self._tables:
+            self._tables[key] = self._load_table(self._file_path(ic_metric, cs_metric))
+        return self._tables[key]
+
+    def _load_table(self, file_path: str) -> np.ndarray:
+        if os.path.exists(file_path):
+            return np.load(file_path, mmap_mode="r")
+        return np.empty(0, dtype=STORE_DTYPE)
@@ -1,13 +1,16 @@
-import json
 import time
 from typing import Optional
 import math
 import logging
 
-from simpa.src.helper import scale_to_range
+from simpa.src.helper import scale_to_range, tile_pairs, upper_triangle_tiles
 from simpa.src.db import PostgresDB
-from simpa.src.icd_diagnoses import ICDComparator, ICDDiagnosis, load_icd10_graph
-from simpa.src.import_similarities import ICD_MAP_PATH
+from simpa.src.icd_diagnoses import (
+    CodeSimilarityCache,
+    ICDComparator,
+    ICDDiagnosis,
+    get_icd_code_normalizer,
+)
 from simpa.src.labevents import LabEventComparator
 from simpa.src.demographics import DemographicsComparator
 from simpa.src.prescriptions import PrescriptionComparator
@@ -28,30 +31,19 @@ logger = logging.getLogger(__name__)
 def clean_diagnoses_records(diagnoses: list[ICDDiagnosis]):
     logger.info("Cleaning diagnoses.")
     result = []
-    G = load_icd10_graph()
-    good_c = 0
-    bad_c = 0
-    with open("../sql/icd9_to_icd10_map.json") as f:
-        map = json.load(f)
-        map = map["data"]
-        for d in diagnoses:
-            d.icd_code = d.icd_code.strip()
-            icd_version = d.icd_version
-            icd_code = d.icd_code
-            if icd_version == 9:
-                if icd_code in [m["code"] for m in map]:  # code in map
-                    new_code = [m["icd10_code"] for m in map if m["code"] == icd_code]
-                    d.icd_code = new_code[0]
-                    d.icd_version = 10
-                else:  # code not in map
-                    d.icd_code = None
-                    d.icd_version = None
-            if d.icd_code in G.graph.nodes:
-                good_c += 1
-                result.append(d)
-            else:
-                bad_c += 1
-    print(f"Cleaned {bad_c} bad diagnoses records, {good_c} good diagnoses records")
+    codes, dropped = get_icd_code_normalizer().normalize(
+        [d.icd_code for d in diagnoses], [d.icd_version for d in diagnoses]
+    )
+    for d, icd_code in zip(diagnoses, codes.tolist()):
+        if icd_code is not None:
+            d.icd_code = icd_code
+            d.icd_version = "10"
+            result.append(d)
+    print(
+        f"Cleaned {sum(dropped.values())} bad diagnoses records "
+        f"({dropped['unmapped']} unmapped ICD9 codes, {dropped['not_in_graph']} "
+        f"codes not in the ICD10 graph), {len(result)} good diagnoses records"
+    )
     return result
 
 def get_count_of_encounters_with_diagnosis(
@@ -92,6 +84,7 @@ class Cohort:
         self.demographics = self.db.get_patient_demographics(self.hadm_ids)
         self.diagnoses = self.db.get_icd_diagnoses(self.hadm_ids)
         self.diagnoses = clean_diagnoses_records(self.diagnoses)
+        self.code_similarity_cache = CodeSimilarityCache.from_diagnoses(self.diagnoses)
         labevents = self.db.get_mean_labevents(self.hadm_ids)
         self.labevents = [l for l in labevents if l.value is not None]
         self.vitalsigns = self.db.get_mean_vitalsigns(self.hadm_ids)
@@ -110,42 +103,46 @@ class Cohort:
         aggregate_method: str = None,
         normalize_categories: bool = True,
         scale_by_distribution: bool = True,
+        backend=None,
+        tile_size: int = 100,
     ):
-        result = []
-        result_cache = {}
-        comparator = EncounterComparator(db=self.db)
-        for encounter_a in self.similarity_encounters:
-            for encounter_b in self.similarity_encounters:
-                if (
-                    tuple(sorted([encounter_a.hadm_id, encounter_b.hadm_id]))
-                    in result_cache
-                ):
-                    result.append(
-                        {
-                            "encounter_a": encounter_a.hadm_id,
-                            "encounter_b": encounter_b.hadm_id,
-                            "similarity": result_cache[
-                                tuple(
-                                    sorted([encounter_a.hadm_id, encounter_b.hadm_id])
-                                )
-                            ],
-                        }
-                    )
-                else:
-                    similarity = comparator.compare(
-                        encounter_a,
-                        encounter_b,
-                        demographics_weight=demographics_weight,
-                        diagnoses_weight=diagnoses_weight,
-                        labevents_weight=labevents_weight,
-                        vitalsigns_weight=vitalsigns_weight,
-                        inputevents_weight=inputevents_weight,
-                        scale_by_distribution=scale_by_distribution,
-                        prescriptions_weight=prescription_weight,
-                        aggregate_method=aggregate_method
-                        if not normalize_categories
-                        else None,
-                    )
+        """Compare all pairs of similarity encounters, in the order of a double
+        loop over them.
+
+        With a backend from simpa.src.backends.make_backend, the pairs are
+        compared in tiles of tile_size encounters per side across its workers,
+        which receive the encounters once.
+        """
+        compare_kwargs = dict(
+            demographics_weight=demographics_weight,
+            diagnoses_weight=diagnoses_weight,
+            labevents_weight=labevents_weight,
+            vitalsigns_weight=vitalsigns_weight,
+            inputevents_weight=inputevents_weight,
+            scale_by_distribution=scale_by_distribution,
+            prescriptions_weight=prescription_weight,
+            aggregate_method=aggregate_method if not normalize_categories else None,
+        )
+        if backend is not None:
+            result = self._compare_encounters_on_backend(
+                backend, compare_kwargs, tile_size
+            )
+        else:
+            result = []
+            result_cache = {}
+            comparator = EncounterComparator(
+                db=self.db, code_similarity_cache=self.code_similarity_cache
+            )
+            for encounter_a in self.similarity_encounters:
+                for encounter_b in self.similarity_encounters:
+                    pair = tuple(sorted([encounter_a.hadm_id, encounter_b.hadm_id]))
+                    if pair in result_cache:
+                        similarity = result_cache[pair]
+                    else:
+                        similarity = comparator.compare(
+                            encounter_a, encounter_b, **compare_kwargs
+                        )
+                        result_cache[pair] = similarity
                     result.append(
                         {
                             "encounter_a": encounter_a.hadm_id,
@@ -153,10 +150,7 @@ class Cohort:
                             "similarity": similarity,
                         }
                     )
-                    result_cache[
-                        tuple(sorted([encounter_a.hadm_id, encounter_b.hadm_id]))
-                    ] = similarity
-            print(f"Finished encounter {encounter_a.hadm_id}")
+                print(f"Finished encounter {encounter_a.hadm_id}")
 
         if normalize_categories:
             print("Normalizing categories by scaling to range 0..1")
@@ -194,6 +188,28 @@ class Cohort:
                     )
         return result
 
+    def _compare_encounters_on_backend(
+        self, backend, compare_kwargs: dict, tile_size: int
+    ) -> list[dict]:
+        encounters = self.similarity_encounters
+        similarities = {}
+        initargs = (encounters, self.code_similarity_cache, compare_kwargs)
+        with backend.start(_init_compare_worker, initargs):
+            tiles = upper_triangle_tiles(len(encounters), tile_size)
+            for tile, tile_result in backend.imap_unordered(_compare_tile, tiles):
+                for i, j, similarity in tile_result:
+                    similarities[i, j] = similarity
+                print(f"Finished tile {tile}")
+        return [
+            {
+                "encounter_a": encounter_a.hadm_id,
+                "encounter_b": encounter_b.hadm_id,
+                "similarity": similarities[min(i, j), max(i, j)],
+            }
+            for i, encounter_a in enumerate(encounters)
+            for j, encounter_b in enumerate(encounters)
+        ]
+
     def _create_similarity_encounters(self):
         result = []
         for patient in self.participants:
@@ -400,12 +416,52 @@ class Cohort:
         return [p.subject_id for p in self.participants]
 
 
+# cohort of a backend worker of Cohort.compare_encounters
+_worker_encounters = []
+_worker_comparator = None
+_worker_compare_kwargs = {}
+
+
+def _init_compare_worker(
+    encounters: list[SimilarityEncounter],
+    code_similarity_cache: Optional[CodeSimilarityCache],
+    compare_kwargs: dict,
+):
+    global _worker_encounters, _worker_comparator, _worker_compare_kwargs
+    _worker_encounters = encounters
+    _worker_comparator = EncounterComparator(
+        code_similarity_cache=code_similarity_cache
+    )
+    _worker_compare_kwargs = compare_kwargs
+
+
+def _compare_tile(tile: tuple[int, int, int, int]) -> tuple[tuple, list[tuple]]:
+    """(i, j, similarity) of the pairs i <= j of a tile from upper_triangle_tiles,
+    including the pairs of an encounter with itself on the diagonal."""
+    i_start, i_end, j_start, _ = tile
+    pairs = list(tile_pairs(tile))
+    if i_start == j_start:
+        pairs += [(i, i) for i in range(i_start, i_end)]
+    return tile, [
+        (
+            i,
+            j,
+            _worker_comparator.compare(
+                _worker_encounters[i], _worker_encounters[j], **_worker_compare_kwargs
+            ),
+        )
+        for i, j in pairs
+    ]
+
+
 class EncounterComparator:
     def __init__(
         self,
         db: PostgresDB = None,
+        code_similarity_cache: Optional[CodeSimilarityCache] = None,
     ):
         self.db = db
+        self.icd_comparator = ICDComparator(cache=code_similarity_cache)
 
     def compare(
         self,
@@ -489,8 +545,9 @@ class EncounterComparator:
         diagnoses_a: list[ICDDiagnosis],
         diagnoses_b: list[ICDDiagnosis],
     ) -> float:
-        comparator = ICDComparator()
-        return comparator.compare(diagnoses_a=diagnoses_a, diagnoses_b=diagnoses_b)
+        return self.icd_comparator.compare(
+            diagnoses_a=diagnoses_a, diagnoses_b=diagnoses_b
+        )
 
     def _compare_labevents(
         self,
@@ -739,3 +739,17 @@ IMP_ITEM_IDS = {
     "Thrombin": "51297",
     "Potassium, Whole Blood": "50822",
 }
+
+# similarity categories of import_similarities, in the column order of the
+# similarity tables. The similarity dicts use the key f"{category}_sim", the
+# tables the column f"{category}_similarity".
+SIMILARITY_CATEGORIES = [
+    "demographics",
+    "diagnoses",
+    "labevents",
+    "labevents_first24h",
+    "vitalsigns",
+    "vitalsigns_first24h",
+    "inputevents",
+    "prescriptions",
+]
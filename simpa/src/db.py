@@ -1,26 +1,47 @@
+from typing import Optional
+
 import psycopg2
-from simpa.src.helper import labevent_is_abnormal, vitalsign_is_abnormal
+from simpa.src.encounter_store import (
+    CategoryColumns,
+    EncounterStore,
+    decode_inputevents,
+    decode_labevents,
+    decode_prescriptions,
+    decode_vitalsigns,
+)
+from simpa.src.feature_cache import FeatureCache, data_source
 
 from simpa.src.schemas import (
     Demographics,
     ICDDiagnosis,
     LabEvent,
-    Prescription,
-    Vitalsign,
-    InputEvent,
 )
 import simpa.src.sql_queries as sq
-from simpa.src.constants import VITAL_SIGN_NAMES, VITALSIGN_STATISTICS
+from simpa.src.constants import SIMILARITY_CATEGORIES
 
 
 class PostgresDB:
-    def __init__(self, db_name, host="localhost", port=5432, user=None, password=None):
+    def __init__(
+        self,
+        db_name,
+        host="localhost",
+        port=5432,
+        user=None,
+        password=None,
+        feature_cache: bool = False,
+        feature_cache_dir: Optional[str] = None,
+    ):
         self.db_name = db_name
         self.host = host
         self.port = port
         self.user = user
         self.password = password
         self.connect()
+        self.feature_cache: Optional[FeatureCache] = None
+        if feature_cache:
+            self.feature_cache = FeatureCache(
+                feature_cache_dir, source=self.feature_cache_source()
+            )
 
     def connect(self):
         try:
@@ -50,6 +71,44 @@ class PostgresDB:
             self.conn.rollback()
             print(f"Error executing query: {e}")
 
+    def feature_cache_source(self) -> str:
+        """source of the FeatureCache of this database, see data_source."""
+        result = self.execute_query(sq.labevent_statistics_checksum)
+        statistics = result[0][0] if result else None
+        return data_source(f"{self.host}:{self.port}/{self.db_name}", statistics)
+
+    def query_records(self, name: str, query: str, hadm_ids: list[int]):
+        """Rows of the feature query of category name for hadm_ids as dicts by
+        column, only the hadm_ids missing from the feature cache are queried if
+        there is one."""
+        if self.feature_cache is None:
+            columns, rows = self._fetch_with_columns(query, (hadm_ids,))
+            return [dict(zip(columns, row)) for row in rows]
+        missing = self.feature_cache.missing(name, query, hadm_ids)
+        if missing:
+            columns, rows = self._fetch_with_columns(query, (missing,))
+            self.feature_cache.store(name, query, missing, columns, rows)
+        return self.feature_cache.load(name, query, hadm_ids)
+
+    def query_features(self, name: str, query: str, hadm_ids: list[int]):
+        """Like query_records, the rows as tuples."""
+        return [
+            tuple(record.values())
+            for record in self.query_records(name, query, hadm_ids)
+        ]
+
+    def _fetch_with_columns(self, query, parameters):
+        cursor = self.conn.cursor()
+        try:
+            cursor.execute(query, parameters)
+            columns = [column.name for column in cursor.description]
+            return columns, cursor.fetchall()
+        except Exception:
+            self.conn.rollback()
+            raise
+        finally:
+            cursor.close()
+
     def get_random_hadm_ids(self, n: int):
         """Get n random hadm_ids."""
         query = sq.random_hadm_ids
@@ -58,159 +117,125 @@ class PostgresDB:
     # Get categories
     def get_patient_demographics(self, hadm_ids: list[int]):
         """Get age, gender and race for a list of subject_ids."""
-        result = []
         query = sq.get_demographics
-        db_result = self.execute_query(query, (hadm_ids,))
-        for subject_id, hadm_id, age, gender, ethnicity in db_result:
-            result.append(
-                Demographics(
-                    subject_id=subject_id,
-                    hadm_id=hadm_id,
-                    age=age,
-                    gender=gender,
-                    ethnicity=ethnicity,
-                )
-            )
-        return result
+        db_result = self.query_features("demographics", query, hadm_ids)
+        return Demographics.from_records(
+            {
+                "subject_id": subject_id,
+                "hadm_id": hadm_id,
+                # the derived age is numeric
+                "age": int(age) if age is not None else None,
+                "gender": gender,
+                "ethnicity": ethnicity,
+            }
+            for subject_id, hadm_id, age, gender, ethnicity in db_result
+        )
 
     def get_mean_vitalsigns(self, hadm_ids: list[int]):
         """Get mean vital signs for a list of hadm_ids."""
-        result = []
-        vital_sign_names = VITAL_SIGN_NAMES
-        query = sq.get_mean_vitalsigns_first_24h_icu
-        db_result = self.execute_query(query, (hadm_ids,))
-        for values in db_result:
-            subject_id = values[0]
-            hadm_id = values[1]
-            for name, value in zip(vital_sign_names, values[2:]):
-                mean = VITALSIGN_STATISTICS[name]["mean"]
-                std_dev = VITALSIGN_STATISTICS[name]["std"]
-                is_abnormal = vitalsign_is_abnormal(name=name, value=value)
-                result.append(
-                    Vitalsign(
-                        id=name,
-                        subject_id=subject_id,
-                        hadm_id=hadm_id,
-                        name=name,
-                        value=value,
-                        id_mean=mean,
-                        id_std_dev=std_dev,
-                        abnormal=is_abnormal,
-                    )
-                )
-        return result
+        return self.get_mean_vitalsign_columns(hadm_ids).items()
 
     def get_mean_labevents(self, hadm_ids: list[int]):
-        result = []
-        query = sq.get_mean_labevents_first_24h_icu
-        db_result = self.execute_query(query, (hadm_ids,))
-        for (
-            itemid,
-            subject_id,
-            hadm_id,
-            valuenum,
-            valueuom,
-            mean_value,
-            std_dev,
-            label,
-            lower_ref,
-            upper_ref,
-        ) in db_result:
-            is_abnormal = labevent_is_abnormal(
-                valuenum=valuenum,
-                lower_ref=lower_ref,
-                upper_ref=upper_ref,
-                mean=mean_value,
-                std_dev=std_dev,
-            )
-            result.append(
-                LabEvent(
-                    id=itemid,
-                    itemid=itemid,
-                    subject_id=subject_id,
-                    hadm_id=hadm_id,
-                    value=valuenum,
-                    valueuom=valueuom,
-                    id_mean=mean_value,
-                    id_std_dev=std_dev,
-                    label=label,
-                    abnormal=is_abnormal,
-                    upper_ref=upper_ref,
-                    lower_ref=lower_ref,
-                    valuenum=valuenum,
-                )
-            )
-        return result
+        return self.get_mean_labevent_columns(hadm_ids).items()
 
     def get_icd_diagnoses(self, hadm_ids: list[int]):
-        result = []
         query = sq.get_icd_diagnoses
-        db_result = self.execute_query(query, (hadm_ids,))
-        for subject_id, hadm_id, seq_num, icd_code, icd_version in db_result:
-            icd_code = icd_code.strip()  # icd_codes have trailing whitespace
-            result.append(
-                ICDDiagnosis(
-                    subject_id=subject_id,
-                    hadm_id=hadm_id,
-                    seq_num=seq_num,
-                    icd_code=icd_code,
-                    icd_version=icd_version,
-                )
-            )
-        return result
+        db_result = self.query_features("diagnoses", query, hadm_ids)
+        return ICDDiagnosis.from_records(
+            {
+                "subject_id": subject_id,
+                "hadm_id": hadm_id,
+                "seq_num": seq_num,
+                "icd_code": icd_code.strip(),  # icd_codes have trailing whitespace
+                "icd_version": str(icd_version),
+            }
+            for subject_id, hadm_id, seq_num, icd_code, icd_version in db_result
+        )
 
     def get_inputevents(self, hadm_ids: list[int]):
-        result = []
-        query = sq.get_inputevents_first_24h_icu
-        db_result = self.execute_query(query, (hadm_ids,))
-        for (
-            subject_id,
-            hadm_id,
-            itemid,
-            amount,
-            amountuom,
-            ordercategoryname,
-            label
-        ) in db_result:
-            result.append(
-                InputEvent(
-                    value=itemid,
-                    subject_id=subject_id,
-                    hadm_id=hadm_id,
-                    itemid=itemid,
-                    amount=amount,
-                    amountuom=amountuom,
-                    ordercategoryname=ordercategoryname,
-                    label=label,
-                )
-            )
-        return result
+        return self.get_inputevent_columns(hadm_ids).items()
 
     def get_prescriptions(self, hadm_ids: list[int]):
-        result = []
+        return self.get_prescription_columns(hadm_ids).items()
+
+    # Get item categories as the columns of an EncounterStore, the objects of
+    # the methods above are created from them
+    def get_encounter_store(self, hadm_ids: list[int]) -> EncounterStore:
+        """The item categories of hadm_ids, under the names that
+        import_similarities gives them."""
+        store = EncounterStore()
+        store.add("labevents_first24h", self.get_mean_labevent_columns(hadm_ids))
+        store.add("vitalsigns_first24h", self.get_mean_vitalsign_columns(hadm_ids))
+        store.add("inputevents", self.get_inputevent_columns(hadm_ids))
+        store.add("prescriptions", self.get_prescription_columns(hadm_ids))
+        return store
+
+    def get_mean_labevent_columns(self, hadm_ids: list[int]) -> CategoryColumns:
+        """Mean lab values of the first 24h in the ICU, without missing values."""
+        query = sq.get_mean_labevents_first_24h_icu
+        records = self.query_records("labevents_first24h", query, hadm_ids)
+        return decode_labevents(records)
+
+    def get_mean_vitalsign_columns(self, hadm_ids: list[int]) -> CategoryColumns:
+        """Mean vital signs of the first 24h in the ICU, without missing values."""
+        query = sq.get_mean_vitalsigns_first_24h_icu
+        records = self.query_records("vitalsigns_first24h", query, hadm_ids)
+        return decode_vitalsigns(records)
+
+    def get_inputevent_columns(self, hadm_ids: list[int]) -> CategoryColumns:
+        query = sq.get_inputevents_first_24h_icu
+        records = self.query_records("inputevents", query, hadm_ids)
+        return decode_inputevents(records)
+
+    def get_prescription_columns(self, hadm_ids: list[int]) -> CategoryColumns:
+        """Prescriptions of the first 24h in the ICU, without the ones that have
+        no value."""
         query = sq.get_prescriptions_first_24h_icu
-        db_result = self.execute_query(query, (hadm_ids,))
-        for subject_id, hadm_id, drug, pharmacy_id, gsn, value in db_result:
-            if not value:
-                print("No value for prescription", drug, pharmacy_id, gsn, value)
-            if value:
-                result.append(
-                    Prescription(
-                        subject_id=subject_id,
-                        hadm_id=hadm_id,
-                        drug=drug,
-                        pharmacy_id=pharmacy_id,
-                        gsn=gsn,
-                        value=value,
-                    )
-                )
-        return result
+        records = self.query_records("prescriptions", query, hadm_ids)
+        return decode_prescriptions([r for r in records if r["value"]])
 
     # Get from similarity tables
-    def get_all_similarity_values(self):
-        query = sq.all_scaled_similarity_values
-        db_result = self.execute_query(query)
-        return db_result
+    def get_all_similarity_values(self, table_name: str, scaled: bool = True):
+        """(hadm_id_a, hadm_id_b, *similarities in the order of
+        SIMILARITY_CATEGORIES). With scaled, every category is min-max scaled
+        by the database while reading, using get_similarity_statistics."""
+        if not scaled:
+            columns = ", ".join(f"{c}_similarity" for c in SIMILARITY_CATEGORIES)
+            query = sq.all_similarity_values.format(
+                columns=columns, table_name=table_name
+            )
+            return self.execute_query(query)
+
+        statistics = self.get_similarity_statistics(table_name)
+        columns = ", ".join(
+            f"({c}_similarity - %s) / NULLIF(%s - %s, 0)" for c in SIMILARITY_CATEGORIES
+        )
+        parameters = []
+        for category in SIMILARITY_CATEGORIES:
+            low, high = statistics[category]
+            parameters.extend([low, high, low])
+        query = sq.all_similarity_values.format(columns=columns, table_name=table_name)
+        return self.execute_query(query, parameters)
+
+    def get_similarity_statistics(self, table_name: str) -> dict:
+        """category -> (min, max) of a similarity table. Tables imported before
+        the statistics were stored are aggregated instead."""
+        query = sq.similarity_statistics
+        db_result = self.execute_query(query, (table_name,))
+        if db_result:
+            return {category: (low, high) for category, low, high in db_result}
+
+        columns = ", ".join(
+            f"min({c}_similarity), max({c}_similarity)" for c in SIMILARITY_CATEGORIES
+        )
+        query = sq.min_max_similarity_values.format(
+            columns=columns, table_name=table_name
+        )
+        db_result = self.execute_query(query)[0]
+        return {
+            category: (db_result[2 * i], db_result[2 * i + 1])
+            for i, category in enumerate(SIMILARITY_CATEGORIES)
+        }
 
     # Get statistics
     def get_labevent_mean_std_for_itemid(self, itemid: int):
@@ -272,30 +297,28 @@ class PostgresDB:
     def get_labevent_by_id_for_hadm_ids(self, hadm_ids: list[int], item_id: int):
         query = sq.labevent_by_id_for_hadm_ids
         db_result = self.execute_query(query, (hadm_ids, item_id))
-        result = []
-        for (
-            itemid,
-            subject_id,
-            hadm_id,
-            valuenum,
-            valueuom,
-            id_mean,
-            id_std_dev,
-        ) in db_result:
-            result.append(
-                LabEvent(
-                    value=itemid,
-                    id=itemid,
-                    itemid=itemid,
-                    subject_id=subject_id,
-                    hadm_id=hadm_id,
-                    valueuom=valueuom,
-                    valuenum=valuenum,
-                    id_mean=id_mean,
-                    id_std_dev=id_std_dev,
-                )
-            )
-        return result
+        return LabEvent.from_records(
+            {
+                "value": itemid,
+                "id": itemid,
+                "itemid": itemid,
+                "subject_id": subject_id,
+                "hadm_id": hadm_id,
+                "valueuom": valueuom,
+                "valuenum": valuenum,
+                "id_mean": id_mean,
+                "id_std_dev": id_std_dev,
+            }
+            for (
+                itemid,
+                subject_id,
+                hadm_id,
+                valuenum,
+                valueuom,
+                id_mean,
+                id_std_dev,
+            ) in db_result
+        )
 
     def get_labevent_label(self, id: int):
         query = sq.labevent_label
@@ -0,0 +1,246 @@
+from typing import Optional, Type
+
+import numpy as np
+from pydantic import BaseModel
+from scipy.stats import norm
+
+from simpa.src.base_comparators import DistributionItems, to_float_array
+from simpa.src.constants import VITAL_SIGN_NAMES, VITALSIGN_STATISTICS
+from simpa.src.helper import labevent_is_abnormal, vitalsign_is_abnormal
+from simpa.src.schemas import InputEvent, LabEvent, Prescription, Vitalsign
+
+
+def _python_value(value):
+    return value.item() if isinstance(value, np.generic) else value
+
+
+def _float_column(column: np.ndarray) -> np.ndarray:
+    if column.dtype.kind in "biuf":
+        return column.astype(np.float64)
+    return to_float_array(column)
+
+
+class CategoryColumns:
+    """The rows of one category as NumPy columns, grouped by hadm_id.
+
+    Rows are sorted by hadm_id and, within an encounter, by the order_by
+    column. The rows of hadm_ids[k] are offsets[k]:offsets[k + 1], like the
+    rows of a CSR matrix. model is the schema of a row, for creating the
+    pydantic objects of an encounter on demand.
+    """
+
+    __slots__ = ("hadm_ids", "offsets", "columns", "model")
+
+    def __init__(
+        self,
+        hadm_ids: np.ndarray,
+        offsets: np.ndarray,
+        columns: dict[str, np.ndarray],
+        model: Optional[Type[BaseModel]] = None,
+    ):
+        self.hadm_ids = hadm_ids
+        self.offsets = offsets
+        self.columns = columns
+        self.model = model
+
+    @classmethod
+    def from_lists(
+        cls,
+        columns: dict[str, list],
+        order_by: Optional[str] = None,
+        model: Optional[Type[BaseModel]] = None,
+    ) -> "CategoryColumns":
+        """Columns from lists of row values, with a "hadm_id" column."""
+        hadm_id = np.array(columns["hadm_id"], dtype=np.int64)
+        keys = (hadm_id,) if order_by is None else (columns[order_by], hadm_id)
+        order = np.lexsort(keys)
+        arrays = {name: np.array(values)[order] for name, values in columns.items()}
+        hadm_ids, counts = np.unique(arrays["hadm_id"], return_counts=True)
+        offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+        return cls(hadm_ids.astype(np.int64), offsets, arrays, model)
+
+    def rows(self, hadm_id: int) -> range:
+        """Rows of hadm_id, empty if it has none."""
+        k = np.searchsorted(self.hadm_ids, hadm_id)
+        if k == len(self.hadm_ids) or self.hadm_ids[k] != hadm_id:
+            return range(0)
+        return range(int(self.offsets[k]), int(self.offsets[k + 1]))
+
+    def items(self, rows: Optional[range] = None) -> list[BaseModel]:
+        """The rows (all by default) as objects of model."""
+        rows = range(len(self)) if rows is None else rows
+        return [
+            self.model(
+                **{
+                    name: _python_value(column[row])
+                    for name, column in self.columns.items()
+                }
+            )
+            for row in rows
+        ]
+
+    def __len__(self) -> int:
+        return int(self.offsets[-1])
+
+
+class EncounterStore:
+    """Columnar store of the item categories of a cohort, e.g. lab events.
+
+    Encounters refer to their items by the range of their rows in a category,
+    so that they stay small to pickle. Comparators read the columns directly,
+    pydantic objects are only created by items(), e.g. for inspection.
+    """
+
+    def __init__(self):
+        self.categories: dict[str, CategoryColumns] = {}
+        self._percentiles: dict[str, np.ndarray] = {}
+
+    def add(self, category: str, columns: CategoryColumns):
+        self.categories[category] = columns
+        self._percentiles.pop(category, None)
+
+    def rows(self, category: str, hadm_id: int) -> range:
+        return self.categories[category].rows(hadm_id)
+
+    def column(self, category: str, name: str) -> np.ndarray:
+        return self.categories[category].columns[name]
+
+    def percentiles(self, category: str) -> np.ndarray:
+        """Percentile of every value in its item distribution, NaN if the value
+        or the distribution is missing, computed once for the whole category."""
+        if category not in self._percentiles:
+            values = _float_column(self.column(category, "value"))
+            means = _float_column(self.column(category, "id_mean"))
+            std_devs = _float_column(self.column(category, "id_std_dev"))
+            std_devs[std_devs == 0] = np.nan
+            self._percentiles[category] = norm.cdf((values - means) / std_devs)
+        return self._percentiles[category]
+
+    def distribution_items(
+        self, category: str, rows: Optional[range]
+    ) -> Optional[DistributionItems]:
+        """DistributionItems of the rows of an encounter, views of the columns.
+        The rows of a category are sorted by id within each encounter."""
+        if rows is None:
+            return None
+        rows = slice(rows.start, rows.stop)
+        hadm_ids = self.column(category, "hadm_id")[rows]
+        return DistributionItems(
+            int(hadm_ids[0]) if len(hadm_ids) > 0 else None,
+            self.column(category, "id")[rows],
+            self.percentiles(category)[rows],
+            self.column(category, "abnormal")[rows].astype(bool),
+        )
+
+    def values(self, category: str, rows: Optional[range]) -> Optional[np.ndarray]:
+        """Item values of the rows of an encounter, e.g. for a BinaryComparator."""
+        if rows is None:
+            return None
+        return self.column(category, "value")[rows.start : rows.stop]
+
+    def items(self, category: str, hadm_id: int) -> list[BaseModel]:
+        """The rows of hadm_id as objects of the model of the category."""
+        columns = self.categories[category]
+        return columns.items(columns.rows(hadm_id))
+
+
+# columns of the EncounterStore categories, fields of their schemas
+LABEVENT_COLUMNS = [
+    "id",
+    "subject_id",
+    "itemid",
+    "value",
+    "valueuom",
+    "hadm_id",
+    "id_mean",
+    "id_std_dev",
+    "abnormal",
+]
+VITALSIGN_COLUMNS = [
+    "id",
+    "subject_id",
+    "hadm_id",
+    "name",
+    "value",
+    "id_mean",
+    "id_std_dev",
+    "abnormal",
+]
+INPUTEVENT_COLUMNS = [
+    "subject_id",
+    "hadm_id",
+    "value",
+    "itemid",
+    "amount",
+    "amountuom",
+    "ordercategoryname",
+]
+PRESCRIPTION_COLUMNS = ["subject_id", "hadm_id", "drug", "pharmacy_id", "gsn", "value"]
+
+
+def decode_labevents(records, column: str = "valuenum") -> CategoryColumns:
+    """Lab events of the mean values in column of the records, records without
+    one are skipped."""
+    columns = {name: [] for name in LABEVENT_COLUMNS}
+    for i in records:
+        valuenum = i[column]
+        if valuenum is None:
+            continue
+        mean = i["mean_value"]
+        std_dev = i["std_dev"]
+        lower_ref = i["ref_range_lower"]
+        upper_ref = i["ref_range_upper"]
+        is_abnormal = labevent_is_abnormal(
+            valuenum, lower_ref, upper_ref, mean, std_dev
+        )
+        columns["id"].append(i["itemid"])
+        columns["subject_id"].append(i["subject_id"])
+        columns["itemid"].append(i["itemid"])
+        columns["value"].append(float(valuenum))
+        columns["valueuom"].append(i["valueuom"])
+        columns["hadm_id"].append(i["hadm_id"])
+        columns["id_mean"].append(mean)
+        columns["id_std_dev"].append(std_dev)
+        columns["abnormal"].append(is_abnormal)
+    return CategoryColumns.from_lists(columns, order_by="id", model=LabEvent)
+
+
+def decode_vitalsigns(records, suffix: str = "") -> CategoryColumns:
+    """Vital signs of the mean values in the columns {name}{suffix} of the
+    records."""
+    columns = {name: [] for name in VITALSIGN_COLUMNS}
+    for i in records:
+        for name in VITAL_SIGN_NAMES:
+            value = i[f"{name}{suffix}"]
+            if value is None:
+                continue
+            columns["id"].append(name)
+            columns["subject_id"].append(i["subject_id"])
+            columns["hadm_id"].append(i["hadm_id"])
+            columns["name"].append(name)
+            columns["value"].append(float(value))
+            columns["id_mean"].append(VITALSIGN_STATISTICS[name]["mean"])
+            columns["id_std_dev"].append(VITALSIGN_STATISTICS[name]["std"])
+            columns["abnormal"].append(vitalsign_is_abnormal(value, name))
+    return CategoryColumns.from_lists(columns, order_by="id", model=Vitalsign)
+
+
+def decode_inputevents(records) -> CategoryColumns:
+    columns = {name: [] for name in INPUTEVENT_COLUMNS}
+    for i in records:
+        columns["subject_id"].append(i["subject_id"])
+        columns["hadm_id"].append(i["hadm_id"])
+        columns["value"].append(i["itemid"])
+        columns["itemid"].append(i["itemid"])
+        columns["amount"].append(i["amount"])
+        columns["amountuom"].append(i["amountuom"])
+        columns["ordercategoryname"].append(i["ordercategoryname"])
+    return CategoryColumns.from_lists(columns, model=InputEvent)
+
+
+def decode_prescriptions(records) -> CategoryColumns:
+    columns = {name: [] for name in PRESCRIPTION_COLUMNS}
+    for i in records:
+        for name in PRESCRIPTION_COLUMNS:
+            columns[name].append(i[name])
+    return CategoryColumns.from_lists(columns, model=Prescription)
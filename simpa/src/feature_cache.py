@@ -0,0 +1,128 @@
+import hashlib
+import logging
+import os
+import shutil
+import uuid
+from typing import Iterable, Optional
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from simpa.src.code_pair_store import DEFAULT_STORE_DIR
+
+logger = logging.getLogger(__name__)
+
+# bump when the file layout changes
+CACHE_VERSION = 1
+
+
+def query_checksum(query: str, source: str = "") -> str:
+    key = f"v{CACHE_VERSION}\n{source}\n{query}"
+    return hashlib.sha256(key.encode()).hexdigest()[:16]
+
+
+def data_source(database: str, labevent_statistics: Optional[str]) -> str:
+    """source of a FeatureCache of the queries of database, which join the
+    labevent_statistics table with the given checksum."""
+    return f"{database}\nlabevent_statistics {labevent_statistics}"
+
+
+class FeatureCache:
+    """On-disk cache of the records of the feature queries, keyed by hadm_id.
+
+    The records of a category are stored as Parquet partitions in
+    {path}/{name}/{checksum}/, every partition next to the hadm_ids it was
+    queried for, including hadm_ids without records. Only hadm_ids missing from
+    all partitions have to be queried. The checksum covers the query text and
+    source, which identifies the data the queries read, e.g. the database and
+    a checksum of the labevent_statistics table they join.
+
+    Processes may share a cache. When two of them query the same hadm_ids,
+    only the records of the first partition of a hadm_id are loaded. The
+    partitions of other versions of a query are kept, as other processes may
+    still read them, see remove_stale.
+    """
+
+    def __init__(self, path: Optional[str] = None, source: str = ""):
+        self.path = path or os.path.join(
+            os.getenv("SIMPA_CACHE_DIR", DEFAULT_STORE_DIR), "features"
+        )
+        self.source = source
+
+    def missing(self, name: str, query: str, hadm_ids: Iterable[int]) -> list[int]:
+        """hadm_ids whose records of the query are not in the cache."""
+        cached = set()
+        for ids_file in self._partition_files(name, query, ".hadm_ids.npy"):
+            cached.update(np.load(ids_file).tolist())
+        return [hadm_id for hadm_id in hadm_ids if hadm_id not in cached]
+
+    def store(
+        self,
+        name: str,
+        query: str,
+        hadm_ids: Iterable[int],
+        columns: list[str],
+        rows: list[tuple],
+    ):
+        """Add the rows of the query for hadm_ids as a new partition."""
+        if len(set(columns)) != len(columns):
+            raise ValueError(f"The columns of {name} are not unique: {columns}")
+        directory = self._directory(name, query)
+        os.makedirs(directory, exist_ok=True)
+        partition = os.path.join(directory, f"part-{uuid.uuid4().hex}")
+        if rows:
+            table = pa.Table.from_pylist([dict(zip(columns, row)) for row in rows])
+            pq.write_table(table, f"{partition}.parquet.tmp")
+            os.replace(f"{partition}.parquet.tmp", f"{partition}.parquet")
+        # written last, a partition without it is ignored and queried again
+        with open(f"{partition}.hadm_ids.npy.tmp", "wb") as f:
+            np.save(f, np.asarray(list(hadm_ids), dtype=np.int64))
+        os.replace(f"{partition}.hadm_ids.npy.tmp", f"{partition}.hadm_ids.npy")
+        logger.info(f"Cached {len(rows)} {name} records in {directory}.")
+
+    def load(self, name: str, query: str, hadm_ids: Iterable[int]) -> list[dict]:
+        """Cached records of the query for hadm_ids, as dicts in column order.
+
+        The records of a hadm_id are read from the first partition that lists
+        it, partitions of the same hadm_ids stored by other processes are
+        skipped.
+        """
+        remaining = set(hadm_ids)
+        result = []
+        for ids_file in self._partition_files(name, query, ".hadm_ids.npy"):
+            owned = remaining.intersection(np.load(ids_file).tolist())
+            if not owned:
+                continue
+            remaining -= owned
+            data_file = ids_file[: -len(".hadm_ids.npy")] + ".parquet"
+            if not os.path.exists(data_file):
+                continue
+            table = pq.read_table(data_file, filters=[("hadm_id", "in", sorted(owned))])
+            result.extend(table.to_pylist())
+        return result
+
+    def remove_stale(self, name: str, query: str):
+        """Remove the records of the other versions of the query of name, e.g.
+        after the query changed. No other process may use them meanwhile."""
+        category_path = os.path.join(self.path, name)
+        if not os.path.isdir(category_path):
+            return
+        checksum = query_checksum(query, self.source)
+        for entry in os.listdir(category_path):
+            if entry != checksum:
+                shutil.rmtree(os.path.join(category_path, entry))
+                logger.info(f"Removed cached {name} records of another query.")
+
+    def _directory(self, name: str, query: str) -> str:
+        return os.path.join(self.path, name, query_checksum(query, self.source))
+
+    def _partition_files(self, name: str, query: str, suffix: str) -> list[str]:
+        directory = self._directory(name, query)
+        if not os.path.isdir(directory):
+            return []
+        return sorted(
+            os.path.join(directory, f)
+            for f in os.listdir(directory)
+            if f.endswith(suffix)
+        )
@@ -1,3 +1,6 @@
+import heapq
+from itertools import islice
+
 from simpa.src.constants import VITALSIGN_NORM_RANGE
 
 
@@ -28,6 +31,58 @@ def batch(iterable, n=1):
         yield iterable[ndx : min(ndx + n, l)]
 
 
+def chunked(iterable, n=1):
+    """Like batch, but for iterables without a length, e.g. generators."""
+    iterator = iter(iterable)
+    while chunk := list(islice(iterator, n)):
+        yield chunk
+
+
+def upper_triangle_tiles(n: int, tile_size: int):
+    """Lazily yield tiles (i_start, i_end, j_start, j_end) covering all index pairs
+    i < j of an n x n matrix. Tiles on the diagonal have j_start == i_start."""
+    for i_start in range(0, n, tile_size):
+        i_end = min(i_start + tile_size, n)
+        for j_start in range(i_start, n, tile_size):
+            yield i_start, i_end, j_start, min(j_start + tile_size, n)
+
+
+def tile_pairs(tile: tuple[int, int, int, int]):
+    """Index pairs i < j of a tile from upper_triangle_tiles."""
+    i_start, i_end, j_start, j_end = tile
+    for i in range(i_start, i_end):
+        for j in range(max(j_start, i + 1), j_end):
+            yield i, j
+
+
+def tile_pair_count(tile: tuple[int, int, int, int]) -> int:
+    i_start, i_end, j_start, j_end = tile
+    if i_start == j_start:
+        return (i_end - i_start) * (i_end - i_start - 1) // 2
+    return (i_end - i_start) * (j_end - j_start)
+
+
+def shard_tiles(tiles: list[tuple], shard: int, n_shards: int) -> list[tuple]:
+    """Tiles of shard out of n_shards, in the order of tiles.
+
+    Tiles are assigned largest first to the shard with the fewest pairs so far,
+    which balances the pair counts of the shards. The assignment only depends
+    on tiles, so every shard process computes the same partition.
+    """
+    if not 0 <= shard < n_shards:
+        raise ValueError(f"Shard {shard} is not in 0..{n_shards - 1}.")
+    counts = [tile_pair_count(tile) for tile in tiles]
+    order = sorted(range(len(tiles)), key=lambda t: (-counts[t], t))
+    loads = [(0, s) for s in range(n_shards)]
+    assigned = []
+    for t in order:
+        load, s = heapq.heappop(loads)
+        if s == shard:
+            assigned.append(t)
+        heapq.heappush(loads, (load + counts[t], s))
+    return [tiles[t] for t in sorted(assigned)]
+
+
 def normalize_value(value: float, mean: float, std: float) -> float:
     return (value - mean) / std
 
@@ -1,19 +1,36 @@
+import json
 import os
-from typing import Optional, Union
+from typing import Iterable, Optional, Union
 import requests
 from pydantic import BaseModel
 from dotenv import load_dotenv
 from nxontology import NXOntology
 import networkx as nx
+import numpy as np
 
 from simpa.src.base_comparators import BaseComparator
+from simpa.src.code_pair_store import CodePairSimilarityStore
+from simpa.src.ontology_index import OntologyIndex
 from simpa.src.schemas import ICDDiagnosis
 from simpa.src.schemas import SimilarityNode
 
 load_dotenv()
 
+ICD10_GRAPH_PATH = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "graphs", "icd10_nx.gpickle"
+)
+ICD9_TO_ICD10_MAP_PATH = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "sql", "icd9_to_icd10_map.json"
+)
 
-def load_icd10_graph(path: str = "simpa/src/graphs/icd10_nx.gpickle"):
+# process-wide ontology and index, see get_icd10_graph and get_icd10_index
+_icd10_graph: Optional[NXOntology] = None
+_icd10_index: Optional[OntologyIndex] = None
+# process-wide normalizers by map path, see get_icd_code_normalizer
+_icd_code_normalizers: dict[str, "IcdCodeNormalizer"] = {}
+
+
+def load_icd10_graph(path: str = ICD10_GRAPH_PATH):
     try:
         G_default = nx.read_gpickle(path)
     except Exception:
@@ -24,10 +41,211 @@ def load_icd10_graph(path: str = "simpa/src/graphs/icd10_nx.gpickle"):
     return G
 
 
+def get_icd10_graph() -> NXOntology:
+    """Return the shared ICD10 ontology, loading it on first use.
+
+    The graph is loaded once per process. Load it before creating a fork based
+    multiprocessing pool so that the workers inherit it instead of reloading it.
+    """
+    global _icd10_graph
+    if _icd10_graph is None:
+        _icd10_graph = load_icd10_graph()
+    return _icd10_graph
+
+
+def get_icd10_index() -> OntologyIndex:
+    """Return the shared OntologyIndex of the ICD10 graph, building it on first use."""
+    global _icd10_index
+    if _icd10_index is None:
+        _icd10_index = OntologyIndex.from_ontology(get_icd10_graph())
+    return _icd10_index
+
+
+class IcdCodeNormalizer:
+    """Maps the ICD codes of diagnoses to nodes of the ICD10 graph.
+
+    ICD9 codes are replaced by their ICD10 code of the icd9_to_icd10_map table,
+    codes without one and codes that are not nodes of the graph are dropped.
+    The map and the node set are built once, see get_icd_code_normalizer.
+    """
+
+    def __init__(self, icd9_map: dict[str, str], nodes: Iterable[str]):
+        self.icd9_map = icd9_map
+        self.nodes = frozenset(nodes)
+
+    @classmethod
+    def from_file(
+        cls, path: str = ICD9_TO_ICD10_MAP_PATH, G: Optional[NXOntology] = None
+    ) -> "IcdCodeNormalizer":
+        """Normalizer of the map exported by sql/icd_conversion_to_json.sql."""
+        with open(path) as f:
+            records = json.load(f)["data"]
+        icd9_map = {}
+        for m in records:
+            # the first ICD10 code of an ICD9 code is used
+            icd9_map.setdefault(m["code"], m["icd10_code"])
+        G = G if G is not None else get_icd10_graph()
+        return cls(icd9_map, G.graph.nodes)
+
+    def normalize(
+        self, codes: Iterable[str], versions: Iterable[Union[int, str]]
+    ) -> tuple[np.ndarray, dict[str, int]]:
+        """ICD10 codes of a column of codes and their ICD versions, None where a
+        code is dropped, and the number of dropped codes by reason: "unmapped"
+        ICD9 codes without ICD10 code and codes "not_in_graph".
+
+        Every distinct code is looked up once.
+        """
+        codes = np.char.strip(np.asarray(list(codes), dtype=str))
+        icd9 = np.asarray(list(versions)).astype(str) == "9"
+        result = np.full(len(codes), None, dtype=object)
+        unmapped = np.zeros(len(codes), dtype=bool)
+        for rows, is_icd9 in ((icd9, True), (~icd9, False)):
+            unique, inverse = np.unique(codes[rows], return_inverse=True)
+            unique = unique.tolist()
+            mapped = [self.icd9_map.get(c) for c in unique] if is_icd9 else unique
+            icd10 = np.array(
+                [c if c in self.nodes else None for c in mapped], dtype=object
+            )
+            result[rows] = icd10[inverse]
+            unmapped[rows] = np.array([c is None for c in mapped], dtype=bool)[inverse]
+        dropped = int(np.equal(result, None).sum())
+        return result, {
+            "unmapped": int(unmapped.sum()),
+            "not_in_graph": dropped - int(unmapped.sum()),
+        }
+
+
+def get_icd_code_normalizer(path: str = ICD9_TO_ICD10_MAP_PATH) -> IcdCodeNormalizer:
+    """Return the shared IcdCodeNormalizer of the map at path, building it on
+    first use."""
+    if path not in _icd_code_normalizers:
+        _icd_code_normalizers[path] = IcdCodeNormalizer.from_file(path)
+    return _icd_code_normalizers[path]
+
+
+class CodeSimilarityCache:
+    """Dense code x code similarity matrices for the distinct codes of a cohort.
+
+    A matrix is computed once per (ic_metric, cs_metric) combination, after that
+    the code similarities of an encounter pair are a lookup into it. With a
+    store, code pairs computed in earlier runs are read from disk.
+    """
+
+    def __init__(
+        self,
+        codes: Iterable[str],
+        index: Optional[OntologyIndex] = None,
+        store: Optional[CodePairSimilarityStore] = None,
+        block_size: int = 1024,
+    ):
+        self.codes = sorted(set(codes))
+        self.code_ids = {code: i for i, code in enumerate(self.codes)}
+        self.index = index if index is not None else get_icd10_index()
+        self.store = store
+        self.block_size = block_size
+        self.matrices: dict[tuple[str, str], np.ndarray] = {}
+
+    @classmethod
+    def from_diagnoses(
+        cls, diagnoses: list[Union[ICDDiagnosis, dict]], **kwargs
+    ) -> "CodeSimilarityCache":
+        """Collect the distinct codes of cleaned diagnoses records or dicts."""
+        codes = [
+            d["icd_code"] if isinstance(d, dict) else d.icd_code for d in diagnoses
+        ]
+        return cls(codes, **kwargs)
+
+    def __contains__(self, code: str) -> bool:
+        return code in self.code_ids
+
+    def __len__(self) -> int:
+        return len(self.codes)
+
+    def matrix(
+        self, ic_metric: str = "intrinsic_ic_sanchez", cs_metric: str = "lin"
+    ) -> np.ndarray:
+        key = (ic_metric, cs_metric)
+        if key not in self.matrices:
+            self.matrices[key] = self._compute_matrix(ic_metric, cs_metric)
+        return self.matrices[key]
+
+    def submatrix(
+        self,
+        codes_a: list[str],
+        codes_b: list[str],
+        ic_metric: str = "intrinsic_ic_sanchez",
+        cs_metric: str = "lin",
+    ) -> np.ndarray:
+        """Similarity of all code pairs, raises KeyError for unknown codes."""
+        ids_a = [self.code_ids[code] for code in codes_a]
+        ids_b = [self.code_ids[code] for code in codes_b]
+        return self.matrix(ic_metric, cs_metric)[np.ix_(ids_a, ids_b)]
+
+    def _compute_matrix(self, ic_metric: str, cs_metric: str) -> np.ndarray:
+        # all supported metrics are symmetric, compute the upper triangle in
+        # row blocks and mirror it
+        n = len(self.codes)
+        node_ids = self.index.get_ids(self.codes)
+        source = self.store if self.store is not None else self.index
+        result = np.empty((n, n), dtype=np.float64)
+        for start in range(0, n, self.block_size):
+            end = min(start + self.block_size, n)
+            ids_0, ids_1 = np.meshgrid(
+                node_ids[start:end], node_ids[start:], indexing="ij"
+            )
+            block = source.similarity_by_id(
+                ids_0.ravel(), ids_1.ravel(), ic_metric, cs_metric
+            ).reshape(ids_0.shape)
+            result[start:end, start:] = block
+            result[start:, start:end] = block.T
+        return result
+
+
 class ICDComparator(BaseComparator):
-    def __init__(self, G: Optional[NXOntology] = None):
-        if not G:
-            self.G = load_icd10_graph()
+    """Compares ICD10 diagnoses by their semantic similarity in the ICD10 graph.
+
+    backend "index" (default) computes code similarities with the vectorized
+    OntologyIndex, backend "nxontology" queries the NXOntology pair by pair.
+    If a CodeSimilarityCache is given, code similarities are looked up in it,
+    otherwise a CodePairSimilarityStore is read before the index is queried.
+    The graph and the index are only loaded once they are needed.
+    """
+
+    def __init__(
+        self,
+        G: Optional[NXOntology] = None,
+        index: Optional[OntologyIndex] = None,
+        backend: str = "index",
+        cache: Optional[CodeSimilarityCache] = None,
+        store: Optional[CodePairSimilarityStore] = None,
+    ):
+        if backend not in ("index", "nxontology"):
+            raise ValueError(f"Unknown backend {backend}")
+        self._G = G
+        self.backend = backend
+        self.cache = cache
+        self.store = store
+        self._index = index
+
+    @property
+    def G(self) -> NXOntology:
+        """The graph, the shared ICD10 ontology if none was given, loaded on
+        first use so that a comparator whose codes are all in its cache never
+        loads it."""
+        if self._G is None:
+            self._G = get_icd10_graph()
+        return self._G
+
+    @property
+    def index(self) -> Optional[OntologyIndex]:
+        """The OntologyIndex of G for the index backend, built on first use."""
+        if self._index is None and self.backend == "index":
+            if self._G is None or self._G is _icd10_graph:
+                self._index = get_icd10_index()
+            else:
+                self._index = OntologyIndex.from_ontology(self._G)
+        return self._index
 
     def compare(
         self,
@@ -100,36 +318,48 @@ class ICDComparator(BaseComparator):
         ic_metric: str = "intrinsic_ic_sanchez",
     ):
         """Derived from https://bmcmedinformdecismak.biomedcentral.com/articles/10.1186/s12911-019-0807-y"""
-        lhs = 0
-        rhs = 0
-        node_sim_ba = []
-        node_sim_ab = []
-
-        for diagnosis_a in diagnoses_a:
-            code_a = diagnosis_a.icd_code
-            node_sim_ab = []
-            for diagnosis_b in diagnoses_b:
-                code_b = diagnosis_b.icd_code
-                similarity = self.G.similarity(code_a, code_b, ic_metric)
-                similarity = getattr(similarity, cs_metric)
-                similarity *= (diagnosis_a.tfidf_score + diagnosis_b.tfidf_score) / 2
-                node_sim_ab.append(similarity)
-            lhs += max(node_sim_ab, default=0)
-
-        for diagnosis_b in diagnoses_b:
-            code_b = diagnosis_b.icd_code
-            node_sim_ba = []
-            for diagnosis_a in diagnoses_a:
-                code_a = diagnosis_a.icd_code
-                similarity = self.G.similarity(code_b, code_a, ic_metric)
-                similarity = getattr(similarity, cs_metric)
-                similarity *= (diagnosis_a.tfidf_score + diagnosis_b.tfidf_score) / 2
-                node_sim_ba.append(similarity)
-            rhs += max(node_sim_ba, default=0)
-
-        if len(node_sim_ab) == 0 or len(node_sim_ba) == 0:
+        if len(diagnoses_a) == 0 or len(diagnoses_b) == 0:
             return 0
 
-        factor = 1 / (len(node_sim_ab) + len(node_sim_ba))
-        result = factor * (lhs + rhs)
+        similarities = self.code_similarity_matrix(
+            [d.icd_code for d in diagnoses_a],
+            [d.icd_code for d in diagnoses_b],
+            ic_metric=ic_metric,
+            cs_metric=cs_metric,
+        )
+        tfidf_a = np.array([d.tfidf_score for d in diagnoses_a], dtype=np.float64)
+        tfidf_b = np.array([d.tfidf_score for d in diagnoses_b], dtype=np.float64)
+        similarities = similarities * (tfidf_a[:, None] + tfidf_b[None, :]) / 2
+
+        lhs = similarities.max(axis=1).sum()
+        rhs = similarities.max(axis=0).sum()
+        factor = 1 / (len(diagnoses_a) + len(diagnoses_b))
+        return float(factor * (lhs + rhs))
+
+    def code_similarity_matrix(
+        self,
+        codes_a: list[str],
+        codes_b: list[str],
+        ic_metric: str = "intrinsic_ic_sanchez",
+        cs_metric: str = "lin",
+    ) -> np.ndarray:
+        """Similarity of all code pairs, shape (len(codes_a), len(codes_b))."""
+        if self.cache is not None:
+            try:
+                return self.cache.submatrix(codes_a, codes_b, ic_metric, cs_metric)
+            except KeyError:
+                pass
+        if self.store is not None:
+            return self.store.similarity_matrix(
+                codes_a, codes_b, ic_metric=ic_metric, cs_metric=cs_metric
+            )
+        if self.backend == "index":
+            return self.index.similarity_matrix(
+                codes_a, codes_b, ic_metric=ic_metric, cs_metric=cs_metric
+            )
+        result = np.empty((len(codes_a), len(codes_b)), dtype=np.float64)
+        for i, code_a in enumerate(codes_a):
+            for j, code_b in enumerate(codes_b):
+                similarity = self.G.similarity(code_a, code_b, ic_metric)
+                result[i, j] = getattr(similarity, cs_metric)
         return result
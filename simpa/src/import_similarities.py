@@ -1,3 +1,5 @@
+import argparse
+import gc
 import os
 import sys
 
@@ -7,44 +9,74 @@ import asyncio
 import asyncpg
 from asyncpg import Connection
 import time
-from multiprocessing import Pool
+import multiprocessing
+import threading
 import json
+from typing import Optional
 from datetime import datetime
 
+import numpy as np
+
 import simpa.src.sql_queries as sq
 from simpa.src.helper import (
-    batch,
-    labevent_is_abnormal,
     psycop_to_asyncpg_string,
-    scale_to_range,
-    vitalsign_is_abnormal,
-)
-from simpa.src.schemas import (
-    Demographics,
-    LabEvent,
-    ICDDiagnosis,
-    InputEvent,
-    Vitalsign,
-    Prescription,
+    shard_tiles,
+    tile_pairs,
+    upper_triangle_tiles,
 )
-from simpa.src.constants import (
-    VITAL_SIGN_NAMES,
-    VITALSIGN_STATISTICS,
-    VITALSIGN_NORM_RANGE,
+from simpa.src.schemas import Demographics, ICDDiagnosis
+from simpa.src.constants import VITALSIGN_NORM_RANGE, SIMILARITY_CATEGORIES
+from simpa.src.encounter_store import (
+    CategoryColumns,
+    EncounterStore,
+    decode_inputevents,
+    decode_labevents,
+    decode_prescriptions,
+    decode_vitalsigns,
 )
 from simpa.src.labevents import LabEventComparator
 from simpa.src.demographics import DemographicsComparator
-from simpa.src.icd_diagnoses import ICDComparator
+from simpa.src.icd_diagnoses import CodeSimilarityCache, ICDComparator
 from simpa.src.inputevents import InputEventComparator
 from simpa.src.vitalsigns import VitalsignComparator
-from simpa.src.icd_diagnoses import load_icd10_graph
+from simpa.src.icd_diagnoses import (
+    get_icd10_index,
+    get_icd_code_normalizer,
+)
+from simpa.src.code_pair_store import CodePairSimilarityStore
 from simpa.src.prescriptions import PrescriptionComparator
+from simpa.src.similarity_files import (
+    SimilarityFileWriter,
+    SimilarityPairWriter,
+    SimilarityStatistics,
+)
+from simpa.src.backends import BACKENDS, make_backend
+from simpa.src.feature_cache import FeatureCache, data_source
 
 ########## PARAMETERS ##########
 MIN_AGE = 18
 MAX_AGE = 65
 LIMIT = None
-BATCH_SIZE = 400
+TILE_SIZE = 100  # encounters per side of a tile of the upper triangle
+TILES_PER_BATCH = 64  # tiles whose results are inserted at once
+QUEUE_SIZE = 2 * TILES_PER_BATCH  # computed tiles waiting for the writer
+# tiles submitted but not yet inserted, raised to TILES_PER_BATCH if lower
+MAX_PENDING_TILES = 4 * TILES_PER_BATCH
+DEFER_INDEXES = True  # build the similarity table indexes after the load
+SINK = "postgres"  # "postgres" for a similarity table, "files" for SIMILARITY_DIR
+SIMILARITY_DIR = "similarities"  # file sink output, one directory per run
+# MinHashLSHIndex arguments, e.g. {"num_perm": 128, "threshold": 0.5}, to compare
+# the binary categories only for their LSH candidate pairs, the similarity of
+# the other pairs is 0. None compares all pairs
+BINARY_LSH = None
+BACKEND = "multiprocessing"  # "multiprocessing" for a local pool or "dask"
+DASK_SCHEDULER = None  # address of a dask scheduler, a LocalCluster if None
+DB_POOL_SIZE = 8  # connections for the concurrent category queries
+# windows of the windowed lab and vital sign categories, suffix -> hours after
+# the first ICU intime, see sq.icu_window. main rejects windows without their
+# similarity categories, see check_feature_windows
+FEATURE_WINDOWS = {"first24h": 24}
+FEATURE_CACHE = True  # reuse the category records of earlier runs, see FeatureCache
 GENDER = "F"
 
 ICD_MAP_PATH = "simpa/src/sql/icd9_to_icd10_map.json"
@@ -55,10 +87,38 @@ logger = logging.getLogger(__name__)
 
 labevent_comp = LabEventComparator()
 demographic_comp = DemographicsComparator()
-icd_comp = ICDComparator()
 inputevent_comp = InputEventComparator()
 vitalsign_comp = VitalsignComparator()
 prescriptions_comp = PrescriptionComparator()
+distribution_comps = {
+    "labevents": labevent_comp,
+    "labevents_first24h": labevent_comp,
+    "vitalsigns": vitalsign_comp,
+    "vitalsigns_first24h": vitalsign_comp,
+}
+binary_comps = {
+    "inputevents": inputevent_comp,
+    "prescriptions": prescriptions_comp,
+}
+
+# encounter dicts of the cohort and the store of their item categories, set up
+# in the workers by init_worker
+encounters: list[dict] = []
+cohort_store = EncounterStore()
+# ICDComparator of the process, see get_icd_comparator, the workers create
+# theirs around the code similarity cache of init_worker
+icd_comp: Optional[ICDComparator] = None
+# binary category -> candidate keys of the cohort, see binary_lsh_candidates
+lsh_candidates: dict[str, np.ndarray] = {}
+
+
+def get_icd_comparator() -> ICDComparator:
+    """The ICDComparator of this process, created on first use so that importing
+    the module does not load the ICD10 graph."""
+    global icd_comp
+    if icd_comp is None:
+        icd_comp = ICDComparator()
+    return icd_comp
 
 
 def remove_empty_data(hadm_data):
@@ -66,195 +126,572 @@ def remove_empty_data(hadm_data):
     for k, v in hadm_data.items():
         empty = True
         for k2, v2 in v.items():
-            if isinstance(v2, list) and len(v2) > 0:
+            # lists of items or the rows of an EncounterStore category
+            if isinstance(v2, (list, range)) and len(v2) > 0:
                 empty = False
         if not empty:
             result[k] = v
     return result
 
 
-async def insert_similarities(conn: Connection, similarites, table_name: str):
-    """Insert similarities into database."""
-    insert_list = [
-        (
-            s["encounter_a"],
-            s["encounter_b"],
-            s["similarity"]["demographics_sim"],
-            s["similarity"]["diagnoses_sim"],
-            s["similarity"]["labevents_sim"],
-            s["similarity"]["labevents_first24h_sim"],
-            s["similarity"]["vitalsigns_sim"],
-            s["similarity"]["vitalsigns_first24h_sim"],
-            s["similarity"]["inputevents_sim"],
-            s["similarity"]["prescriptions_sim"],
-        )
-        for s in similarites
-    ]
+# similarity table column -> key of the similarity dicts of compare_encounters
+SIMILARITY_COLUMNS = {
+    f"{category}_similarity": f"{category}_sim" for category in SIMILARITY_CATEGORIES
+}
+
+
+async def create_similarity_table(
+    conn: Connection, table_name: str, with_indexes: bool = True
+):
+    """Create the similarity table, without its indexes if with_indexes is False
+    so that a bulk load does not maintain them row by row."""
+    columns = ",\n".join(f"{c} float" for c in SIMILARITY_COLUMNS)
     await conn.execute(
         f"""
             CREATE TABLE IF NOT EXISTS {table_name} (
                 hadm_id_a integer,
                 hadm_id_b integer,
-                demographics_similarity float,
-                diagnoses_similarity float,
-                labevents_similarity float,
-                labevents_first24h_similarity float,
-                vitalsigns_similarity float,
-                vitalsigns_first24h_similarity float,
-                inputevents_similarity float,
-                prescriptions_similarity float,
-                PRIMARY KEY (hadm_id_a, hadm_id_b)
+                {columns}
             );
+        """
+    )
+    if with_indexes:
+        await create_similarity_indexes(conn, table_name)
+
+
+async def create_similarity_indexes(conn: Connection, table_name: str):
+    await conn.execute(
+        f"""
+            CREATE UNIQUE INDEX IF NOT EXISTS {table_name}_pkey ON {table_name} (hadm_id_a, hadm_id_b);
 
-            CREATE INDEX IF NOT EXISTS similarity_hadm_id_a ON {table_name} (hadm_id_a);
+            CREATE INDEX IF NOT EXISTS {table_name}_hadm_id_a ON {table_name} (hadm_id_a);
 
-            CREATE INDEX IF NOT EXISTS similarity_hadm_id_b ON {table_name} (hadm_id_b);
+            CREATE INDEX IF NOT EXISTS {table_name}_hadm_id_b ON {table_name} (hadm_id_b);
         """
     )
+
+
+async def insert_similarities(conn: Connection, similarites, table_name: str):
+    """Insert similarities into an existing table with a binary COPY."""
+    records = [
+        (
+            s["encounter_a"],
+            s["encounter_b"],
+            *(s["similarity"][key] for key in SIMILARITY_COLUMNS.values()),
+        )
+        for s in similarites
+    ]
+    await conn.copy_records_to_table(
+        table_name,
+        records=records,
+        columns=["hadm_id_a", "hadm_id_b", *SIMILARITY_COLUMNS],
+    )
+
+
+async def store_similarity_statistics(
+    conn: Connection, table_name: str, statistics: SimilarityStatistics
+):
+    """Store the min and max of every category in similarity_statistics, where
+    PostgresDB.get_all_similarity_values reads them for scaling."""
+    await conn.execute(sq.create_similarity_statistics_table)
     await conn.executemany(
-        f"""
-            INSERT INTO 
-                {table_name} (hadm_id_a, hadm_id_b, demographics_similarity, diagnoses_similarity, labevents_similarity,
-                labevents_first24h_similarity, vitalsigns_similarity, vitalsigns_first24h_similarity, inputevents_similarity, prescriptions_similarity)
-            VALUES 
-            ( $1 , $2 , $3 , $4 , $5 , $6 , $7, $8, $9, $10 );
-        """,
-        insert_list,
+        psycop_to_asyncpg_string(sq.upsert_similarity_statistics),
+        [
+            (table_name, category, values["min"], values["max"])
+            for category, values in statistics.to_dict().items()
+        ],
     )
 
 
-def normalize_categories(result: list[dict]) -> list[dict]:
-    demographics_sims = [
-        r["similarity"]["demographics_sim"]
-        for r in result
-        if r["encounter_a"] != r["encounter_b"]
-    ]
-    demographics_sims = [0 if d is None else d for d in demographics_sims]
+class PostgresSink:
+    """Writes similarities into a new similarity table and their statistics
+    into similarity_statistics.
 
-    diagnoses_sims = [
-        r["similarity"]["diagnoses_sim"]
-        for r in result
-        if r["encounter_a"] != r["encounter_b"]
-    ]
-    diagnoses_sims = [0 if d is None else d for d in diagnoses_sims]
+    The manifest of the run is stored in similarity_runs and every written
+    tile in similarity_tiles, in the same transaction as its similarities.
+    """
 
-    labevents_sims = [
-        r["similarity"]["labevents_sim"]
-        for r in result
-        if r["encounter_a"] != r["encounter_b"]
-    ]
-    labevents_sims = [0 if d is None else d for d in labevents_sims]
+    def __init__(
+        self, conn: Connection, table_name: str, defer_indexes: bool = DEFER_INDEXES
+    ):
+        self.conn = conn
+        self.table_name = table_name
+        self.defer_indexes = defer_indexes
+        self.statistics = SimilarityStatistics()
+        # set once the running statistics miss pairs that were written before
+        self.partial_statistics = False
 
-    labevents_first24h_sims = [
-        r["similarity"]["labevents_first24h_sim"]
-        for r in result
-        if r["encounter_a"] != r["encounter_b"]
-    ]
-    labevents_sims = [0 if d is None else d for d in labevents_first24h_sims]
+    async def load_manifest(self) -> Optional[dict]:
+        await self.conn.execute(sq.create_similarity_run_tables)
+        records = await self.conn.fetch(
+            psycop_to_asyncpg_string(sq.similarity_run), self.table_name
+        )
+        if not records:
+            return None
+        return {
+            "hadm_ids": list(records[0]["hadm_ids"]),
+            "parameters": json.loads(records[0]["parameters"]),
+        }
 
-    vitalsigns_sims = [
-        r["similarity"]["vitalsigns_sim"]
-        for r in result
-        if r["encounter_a"] != r["encounter_b"]
-    ]
-    vitalsigns_sims = [0 if d is None else d for d in vitalsigns_sims]
+    async def save_manifest(self, manifest: dict):
+        await self.conn.execute(sq.create_similarity_run_tables)
+        await self.conn.execute(
+            psycop_to_asyncpg_string(sq.insert_similarity_run),
+            self.table_name,
+            manifest["hadm_ids"],
+            json.dumps(manifest["parameters"]),
+        )
 
-    vitalsigns_first24h_sims = [
-        r["similarity"]["vitlasigns_first24h_sim"]
-        for r in result
-        if r["encounter_a"] != r["encounter_b"]
-    ]
-    vitalsigns_sims = [0 if d is None else d for d in vitalsigns_first24h_sims]
+    async def completed_tiles(self) -> set[tuple[int, int]]:
+        records = await self.conn.fetch(
+            psycop_to_asyncpg_string(sq.similarity_tiles), self.table_name
+        )
+        return {(r["i_start"], r["j_start"]) for r in records}
 
-    inputevents_sims = [
-        r["similarity"]["inputevents_sim"]
-        for r in result
-        if r["encounter_a"] != r["encounter_b"]
-    ]
-    inputevents_sims = [0 if d is None else d for d in inputevents_sims]
+    async def open(self, hadm_ids: list[int], resume: bool = False):
+        self.partial_statistics = resume
+        await create_similarity_table(
+            self.conn, self.table_name, with_indexes=not self.defer_indexes
+        )
 
-    prescriptions_sims = [
-        r["similarity"]["prescriptions_sim"]
-        for r in result
-        if r["encounter_a"] != r["encounter_b"]
-    ]
-    prescriptions_sims = [0 if d is None else d for d in prescriptions_sims]
+    async def write(self, similarities: list[dict], tiles: list[tuple]):
+        async with self.conn.transaction():
+            await insert_similarities(self.conn, similarities, self.table_name)
+            await self.conn.executemany(
+                psycop_to_asyncpg_string(sq.insert_similarity_tile),
+                [(self.table_name, tile[0], tile[2]) for tile in tiles],
+            )
+        self.statistics.update(similarities)
 
-    normalized_demographics_sims = scale_to_range(
-        input_list=demographics_sims, range_start=0, range_end=1
-    )
-    normalized_diagnoses_sims = scale_to_range(
-        input_list=diagnoses_sims, range_start=0, range_end=1
-    )
-    normalized_labevents_sims = scale_to_range(
-        input_list=labevents_sims, range_start=0, range_end=1
-    )
-    normalized_labevents_first24h_sims = scale_to_range(
-        input_list=labevents_first24h_sims, range_start=0, range_end=1
+    async def merge(self, shards: list["PostgresSink"]):
+        """Copy the similarities of the shards of a run into this table."""
+        for shard in shards:
+            logger.info(f"Merging {shard.table_name} into {self.table_name}.")
+            await self.conn.execute(
+                f"INSERT INTO {self.table_name} SELECT * FROM {shard.table_name};"
+            )
+        self.partial_statistics = True
+
+    async def close(self):
+        if self.defer_indexes:
+            logger.info(f"Creating indexes of {self.table_name}.")
+            await create_similarity_indexes(self.conn, self.table_name)
+        if self.partial_statistics:
+            self.statistics = await self.table_statistics()
+        await store_similarity_statistics(self.conn, self.table_name, self.statistics)
+
+    async def table_statistics(self) -> SimilarityStatistics:
+        columns = ", ".join(
+            f"min({column}), max({column})" for column in SIMILARITY_COLUMNS
+        )
+        record = await self.conn.fetchrow(
+            sq.min_max_similarity_values.format(
+                columns=columns, table_name=self.table_name
+            )
+        )
+        return SimilarityStatistics.from_dict(
+            {
+                category: {"min": record[2 * i], "max": record[2 * i + 1]}
+                for i, category in enumerate(SIMILARITY_CATEGORIES)
+            }
+        )
+
+
+class FileSink:
+    """Writes similarities into condensed matrix files, see SimilarityFileWriter.
+    The sink of a shard only writes the pairs of its tiles, see
+    SimilarityPairWriter, which merge() scatters into the files of the run.
+
+    The manifest of the run is stored in manifest.json and the written tiles
+    are appended to tiles.txt once their similarities are flushed.
+    """
+
+    def __init__(self, path: str, shard: bool = False):
+        self.path = path
+        self.shard = shard
+        self.writer = None
+
+    async def load_manifest(self) -> Optional[dict]:
+        manifest_path = os.path.join(self.path, "manifest.json")
+        if not os.path.exists(manifest_path):
+            return None
+        with open(manifest_path) as f:
+            return json.load(f)
+
+    async def save_manifest(self, manifest: dict):
+        with open(os.path.join(self.path, "manifest.json"), "w") as f:
+            json.dump(manifest, f)
+
+    async def completed_tiles(self) -> set[tuple[int, int]]:
+        tiles_path = os.path.join(self.path, "tiles.txt")
+        if not os.path.exists(tiles_path):
+            return set()
+        with open(tiles_path) as f:
+            return {tuple(int(x) for x in line.split()) for line in f if line.strip()}
+
+    async def open(self, hadm_ids: list[int], resume: bool = False):
+        writer = SimilarityPairWriter if self.shard else SimilarityFileWriter
+        self.writer = await asyncio.to_thread(
+            writer, self.path, hadm_ids, resume=resume
+        )
+
+    async def write(self, similarities: list[dict], tiles: list[tuple]):
+        await asyncio.to_thread(self._write, similarities, tiles)
+
+    def _write(self, similarities: list[dict], tiles: list[tuple]):
+        self.writer.write(similarities)
+        self.writer.flush()
+        with open(os.path.join(self.path, "tiles.txt"), "a") as f:
+            f.writelines(f"{tile[0]} {tile[2]}\n" for tile in tiles)
+            f.flush()
+            os.fsync(f.fileno())
+
+    async def merge(self, shards: list["FileSink"]):
+        """Copy the similarities of the shards of a run into these files."""
+        await asyncio.to_thread(self.writer.merge, [shard.path for shard in shards])
+
+    async def close(self):
+        await asyncio.to_thread(self.writer.close)
+        logger.info(f"Wrote {self.writer.rows} similarities to {self.path}.")
+
+
+def make_sink(table_name: str, conn: Optional[Connection] = None, shard: bool = False):
+    """Sink of SINK for table_name, shard for the sink of a shard of a run."""
+    if SINK == "files":
+        return FileSink(os.path.join(SIMILARITY_DIR, table_name), shard)
+    return PostgresSink(conn, table_name)
+
+
+def shard_table_name(table_name: str, shard: tuple[int, int]) -> str:
+    return f"{table_name}_shard{shard[0]}of{shard[1]}"
+
+
+def run_parameters() -> dict:
+    """Parameters that a resumed run must share with the run it continues. The
+    shard of a run is part of its table name, see shard_table_name."""
+    parameters = {
+        "MIN_AGE": MIN_AGE,
+        "MAX_AGE": MAX_AGE,
+        "LIMIT": LIMIT,
+        "GENDER": GENDER,
+        "TILE_SIZE": TILE_SIZE,
+    }
+    if BINARY_LSH is not None:
+        parameters["BINARY_LSH"] = BINARY_LSH
+    return parameters
+
+
+def manifest_parameters(manifest: dict) -> dict:
+    """Parameters of a manifest, without the shard that the manifests of
+    sharded runs used to store."""
+    return {k: v for k, v in manifest["parameters"].items() if k != "SHARD"}
+
+
+def resume_cohort(
+    manifest: Optional[dict], hadm_ids: list[int], table_name: str, parameters: dict
+):
+    """hadm_ids in the order of the manifest of the run that is resumed, tiles
+    refer to encounters by their position."""
+    if manifest is None:
+        raise ValueError(f"No manifest found for run {table_name}.")
+    if manifest_parameters(manifest) != parameters:
+        raise ValueError(
+            f"Parameters {parameters} differ from the parameters "
+            f"{manifest['parameters']} of run {table_name}."
+        )
+    if set(manifest["hadm_ids"]) != set(hadm_ids):
+        raise ValueError(f"The cohort differs from the cohort of run {table_name}.")
+    return manifest["hadm_ids"]
+
+
+def database_url() -> str:
+    return f"postgresql://{os.getenv('DB_USER')}:{os.getenv('DB_PASSWORD')}@{os.getenv('DB_HOST')}:{os.getenv('DB_PORT')}/{os.getenv('DB_NAME')}"
+
+
+def database_address() -> str:
+    """The database of database_url, without the credentials."""
+    return f"{os.getenv('DB_HOST')}:{os.getenv('DB_PORT')}/{os.getenv('DB_NAME')}"
+
+
+async def open_feature_cache(pool: asyncpg.Pool) -> FeatureCache:
+    """FeatureCache of the records of the database, see data_source."""
+    statistics = await pool.fetchval(sq.labevent_statistics_checksum)
+    return FeatureCache(source=data_source(database_address(), statistics))
+
+
+def clean_diagnoses_records(diagnoses):
+    """The diagnoses records as dicts with their code normalized to the ICD10
+    graph, see IcdCodeNormalizer. Records of dropped codes are removed."""
+    logger.info("Cleaning diagnoses.")
+    result = []
+    diagnoses = [dict(d_record) for d_record in diagnoses]
+    codes, dropped = get_icd_code_normalizer(ICD_MAP_PATH).normalize(
+        [d["icd_code"] for d in diagnoses], [d["icd_version"] for d in diagnoses]
     )
-    normalized_vitalsigns_sims = scale_to_range(
-        input_list=vitalsigns_sims, range_start=0, range_end=1
+    for d, icd_code in zip(diagnoses, codes.tolist()):
+        if icd_code is not None:
+            d["icd_code"] = icd_code
+            d["icd_version"] = 10
+            result.append(d)
+    logger.info(
+        f"Cleaned {sum(dropped.values())} bad diagnoses records "
+        f"({dropped['unmapped']} unmapped ICD9 codes, {dropped['not_in_graph']} "
+        f"codes not in the ICD10 graph), {len(result)} good diagnoses records"
     )
-    normalized_vitalsigns_first24h_sims = scale_to_range(
-        input_list=vitalsigns_first24h_sims, range_start=0, range_end=1
+    return result
+
+
+def decode_demographics(records) -> dict[int, Demographics]:
+    demographics = Demographics.from_records(
+        {
+            "subject_id": i["subject_id"],
+            "hadm_id": i["hadm_id"],
+            # the derived age is numeric
+            "age": int(i["age"]) if i["age"] is not None else None,
+            "gender": i["gender"],
+            "ethnicity": i["race"],
+        }
+        for i in records
     )
-    normalized_inputevents_sims = scale_to_range(
-        input_list=inputevents_sims, range_start=0, range_end=1
+    return {d.hadm_id: d for d in demographics}
+
+
+def decode_diagnoses(records) -> dict[int, list[ICDDiagnosis]]:
+    """Cleaned diagnoses of the records. Also sets up the code similarity cache
+    of the ICD comparator for their codes, see get_icd_comparator."""
+    diagnoses_dicts = clean_diagnoses_records(
+        records
+    )  # turns the records into dicts and removes bad records
+
+    # computed before the workers are forked, so they share one matrix. code
+    # pairs known from earlier runs are read from the on-disk store
+    code_pair_store = CodePairSimilarityStore(get_icd10_index())
+    cache = CodeSimilarityCache.from_diagnoses(diagnoses_dicts, store=code_pair_store)
+    cache.matrix()
+    code_pair_store.flush()
+    get_icd_comparator().cache = cache
+    logger.info(
+        f"Computed similarity matrix for {len(cache)} distinct ICD10 codes "
+        f"({code_pair_store.hits} stored, {code_pair_store.misses} new code pairs)."
     )
-    normalized_prescriptions_sims = scale_to_range(
-        input_list=prescriptions_sims, range_start=0, range_end=1
+    diagnoses = ICDDiagnosis.from_records(
+        {**i, "icd_version": str(i["icd_version"])} for i in diagnoses_dicts
     )
+    result = {}
+    for d in diagnoses:
+        result.setdefault(d.hadm_id, []).append(d)
+    return result
+
 
-    for i, r in enumerate([r for r in result if r["encounter_a"] != r["encounter_b"]]):
-        r["similarity"]["demographics_sim"] = normalized_demographics_sims[i]
-        r["similarity"]["diagnoses_sim"] = normalized_diagnoses_sims[i]
-        r["similarity"]["labevents_sim"] = normalized_labevents_sims[i]
-        r["similarity"]["labevents_first24h_sim"] = normalized_labevents_first24h_sims[
-            i
-        ]
-        r["similarity"]["vitalsigns_sim"] = normalized_vitalsigns_sims[i]
-        r["similarity"][
-            "vitalsigns_first24h_sim"
-        ] = normalized_vitalsigns_first24h_sims[i]
-        r["similarity"]["inputevents_sim"] = normalized_inputevents_sims[i]
-        r["similarity"]["prescriptions_sim"] = normalized_prescriptions_sims[i]
+def decode_windowed_labevents(records) -> dict[str, CategoryColumns]:
+    """Split the records of sq.windowed_labevents into labevents and a
+    labevents_{window} category per window of FEATURE_WINDOWS."""
+    result = {"labevents": decode_labevents(records)}
+    for window in FEATURE_WINDOWS:
+        result[f"labevents_{window}"] = decode_labevents(records, f"valuenum_{window}")
     return result
 
 
-def clean_diagnoses_records(diagnoses):
-    logger.info("Cleaning diagnoses.")
-    result = []
-    G = load_icd10_graph()
-    good_c = 0
-    bad_c = 0
-    with open(ICD_MAP_PATH) as f:
-        map = json.load(f)
-        map = map["data"]
-        for d_record in diagnoses:
-            d = dict(d_record)
-            d["icd_code"] = d["icd_code"].strip()
-            icd_version = d["icd_version"]
-            icd_code = d["icd_code"]
-            if icd_version == 9:
-                if icd_code in [m["code"] for m in map]:  # code in map
-                    new_code = [m["icd10_code"] for m in map if m["code"] == icd_code]
-                    d["icd_code"] = new_code[0]
-                    d["icd_version"] = 10
-                else:  # code not in map
-                    d["icd_code"] = None
-                    d["icd_version"] = None
-            if d["icd_code"] in G.graph.nodes:
-                good_c += 1
-                result.append(d)
-            else:
-                bad_c += 1
+def decode_windowed_vitalsigns(records) -> dict[str, CategoryColumns]:
+    """Split the records of sq.windowed_vitalsigns into vitalsigns and a
+    vitalsigns_{window} category per window of FEATURE_WINDOWS."""
+    result = {"vitalsigns": decode_vitalsigns(records)}
+    for window in FEATURE_WINDOWS:
+        result[f"vitalsigns_{window}"] = decode_vitalsigns(records, f"_{window}")
+    return result
+
+
+# category -> (query of the cohort's hadm_ids, decoder of its records into
+# hadm_id -> value of the category)
+FEATURE_QUERIES = {
+    "demographics": (sq.get_demographics, decode_demographics),
+    "diagnoses": (sq.get_icd_diagnoses, decode_diagnoses),
+    "inputevents": (sq.get_inputevents_first_24h_icu, decode_inputevents),
+    "prescriptions": (sq.get_prescriptions_first_24h_icu, decode_prescriptions),
+}
+# source -> (query builder for FEATURE_WINDOWS, decoder of its records into
+# category -> hadm_id -> value), a single scan for all windows of a source
+WINDOWED_FEATURE_QUERIES = {
+    "labevents": (sq.windowed_labevents, decode_windowed_labevents),
+    "vitalsigns": (sq.windowed_vitalsigns, decode_windowed_vitalsigns),
+}
+
+
+def check_feature_windows():
+    """Raise a ValueError for windows of FEATURE_WINDOWS whose categories are not
+    compared, their records would be fetched and decoded for nothing."""
+    for source in WINDOWED_FEATURE_QUERIES:
+        for window in FEATURE_WINDOWS:
+            category = f"{source}_{window}"
+            compared = category in distribution_comps
+            if not compared or category not in SIMILARITY_CATEGORIES:
+                raise ValueError(
+                    f"The window {window} of FEATURE_WINDOWS has no similarity "
+                    f"category {category}."
+                )
+
+
+async def fetch_records(
+    pool: asyncpg.Pool,
+    name: str,
+    query: str,
+    hadm_ids: list[int],
+    cache: Optional[FeatureCache] = None,
+) -> list:
+    """Records of query for hadm_ids. With a cache, only the hadm_ids missing
+    from it are queried and the records are read from the cache."""
+    if cache is not None:
+        missing = await asyncio.to_thread(cache.missing, name, query, hadm_ids)
+        logger.info(f"{len(hadm_ids) - len(missing)} cached hadm_ids for {name}.")
+        hadm_ids, cached_ids = missing, hadm_ids
+    start = time.perf_counter()
+    records = []
+    if hadm_ids:
+        records = await pool.fetch(psycop_to_asyncpg_string(query), hadm_ids)
     logger.info(
-        f"Cleaned {bad_c} bad diagnoses records, {good_c} good diagnoses records"
+        f"Finished downloading {len(records)} {name} records for cohort from "
+        f"db in {time.perf_counter() - start:.1f}s."
     )
+    if cache is None:
+        return records
+    if hadm_ids:
+        columns = list(records[0].keys()) if records else []
+        rows = [tuple(record) for record in records]
+        await asyncio.to_thread(cache.store, name, query, hadm_ids, columns, rows)
+    return await asyncio.to_thread(cache.load, name, query, cached_ids)
+
+
+async def fetch_category(
+    pool: asyncpg.Pool,
+    category: str,
+    hadm_ids: list[int],
+    cache: Optional[FeatureCache] = None,
+) -> dict[str, dict]:
+    """{category: hadm_id -> value} for hadm_ids, queried on a connection of
+    pool and decoded in a thread, so that the event loop keeps receiving the
+    records of the other categories."""
+    query, decode = FEATURE_QUERIES[category]
+    records = await fetch_records(pool, category, query, hadm_ids, cache)
+    return {category: await asyncio.to_thread(decode, records)}
+
+
+async def fetch_windowed(
+    pool: asyncpg.Pool,
+    source: str,
+    hadm_ids: list[int],
+    cache: Optional[FeatureCache] = None,
+) -> dict[str, dict]:
+    """Like fetch_category, for the categories of a windowed source."""
+    build_query, decode = WINDOWED_FEATURE_QUERIES[source]
+    query = build_query(FEATURE_WINDOWS)
+    records = await fetch_records(pool, source, query, hadm_ids, cache)
+    return await asyncio.to_thread(decode, records)
+
+
+def init_worker(
+    cohort_encounters: list[dict],
+    encounter_store: EncounterStore,
+    code_similarity_cache: CodeSimilarityCache,
+    binary_candidates: Optional[dict[str, np.ndarray]] = None,
+):
+    """Backend initializer that hands the cohort to a worker once.
+
+    With a forked pool the arguments are inherited instead of pickled, with
+    spawn they are pickled once per worker instead of once per task. The dask
+    backend scatters them to every worker once.
+    """
+    global encounters, cohort_store, lsh_candidates, icd_comp
+    encounters = cohort_encounters
+    cohort_store = encounter_store
+    lsh_candidates = binary_candidates or {}
+    # the graph and index are only loaded for codes that miss the cache
+    icd_comp = ICDComparator(cache=code_similarity_cache)
+
+
+def binary_lsh_candidates(
+    store: EncounterStore, cohort_encounters: list[dict]
+) -> dict[str, np.ndarray]:
+    """binary category -> sorted keys i * N + j of the pairs of cohort positions
+    that are LSH candidates in a MinHashLSHIndex with the arguments of
+    BINARY_LSH, see MinHashLSHIndex.candidate_keys."""
+    result = {}
+    for category, comparator in binary_comps.items():
+        if category not in store.categories:
+            continue
+        index = comparator.build_lsh_index_values(
+            list(range(len(cohort_encounters))),
+            [store.values(category, e.get(category)) for e in cohort_encounters],
+            **BINARY_LSH,
+        )
+        result[category] = index.candidate_keys()
+        logger.info(f"{len(result[category])} LSH candidate pairs for {category}.")
     return result
 
 
-def compare_encounters(encounter_pair: tuple[dict, dict]):
+def tile_candidates(
+    keys: np.ndarray, tile: tuple[int, int, int, int], n: int
+) -> tuple[np.ndarray, np.ndarray]:
+    """Rows and columns within a tile of the candidate pairs of keys, see
+    binary_lsh_candidates, for a cohort of n encounters."""
+    i_start, i_end, j_start, j_end = tile
+    keys = keys[np.searchsorted(keys, i_start * n) : np.searchsorted(keys, i_end * n)]
+    rows, columns = keys // n, keys % n
+    inside = (columns >= j_start) & (columns < j_end)
+    return rows[inside] - i_start, columns[inside] - j_start
+
+
+def tile_similarities(tile: tuple[int, int, int, int]) -> dict[str, np.ndarray]:
+    """category -> similarity block of the rows i_start:i_end against the
+    columns j_start:j_end of a tile, computed from the columns of the store for
+    the distribution and binary categories. Binary categories with LSH
+    candidates are compared only for the candidate pairs of the tile."""
+    i_start, i_end, j_start, j_end = tile
+    blocks = {}
+    for category, comparator in distribution_comps.items():
+        if category not in cohort_store.categories:
+            continue
+        blocks[category] = comparator.compare_block(
+            [
+                cohort_store.distribution_items(category, e.get(category))
+                for e in encounters[i_start:i_end]
+            ],
+            [
+                cohort_store.distribution_items(category, e.get(category))
+                for e in encounters[j_start:j_end]
+            ],
+            scale_by_distribution=True,
+        )
+    for category, comparator in binary_comps.items():
+        if category not in cohort_store.categories:
+            continue
+        blocks[category] = comparator.compare_block_values(
+            [
+                cohort_store.values(category, e.get(category))
+                for e in encounters[i_start:i_end]
+            ],
+            [
+                cohort_store.values(category, e.get(category))
+                for e in encounters[j_start:j_end]
+            ],
+            pairs=(
+                tile_candidates(lsh_candidates[category], tile, len(encounters))
+                if category in lsh_candidates
+                else None
+            ),
+        )
+    return blocks
+
+
+def compare_category(category: str, similarities: dict[str, float]):
+    """Similarity of a category from the similarities of a pair, see
+    tile_similarities."""
+    similarity = similarities[category]
+    return None if np.isnan(similarity) else float(similarity)
+
+
+def compare_encounters(
+    encounter_pair: tuple[dict, dict], similarities: dict[str, float]
+):
     encounter_a = encounter_pair[0]
     encounter_b = encounter_pair[1]
     lab_sim = None
@@ -267,39 +704,25 @@ def compare_encounters(encounter_pair: tuple[dict, dict]):
     prescriptions_sim = None
 
     if "labevents" in encounter_a and "labevents" in encounter_b:
-        lab_sim = labevent_comp.compare(
-            encounter_a["labevents"],
-            encounter_b["labevents"],
-            scale_by_distribution=True,
-        )
+        lab_sim = compare_category("labevents", similarities)
     if "labevents_first24h" in encounter_a and "labevents_first24h" in encounter_b:
-        lab_first24h_sim = labevent_comp.compare(
-            encounter_a["labevents_first24h"],
-            encounter_b["labevents_first24h"],
-            scale_by_distribution=True,
-        )
+        lab_first24h_sim = compare_category("labevents_first24h", similarities)
     if "demographics" in encounter_a and "demographics" in encounter_b:
         demo_sim = demographic_comp.compare(
             encounter_a["demographics"], encounter_b["demographics"]
         )
     if "diagnoses" in encounter_a and "diagnoses" in encounter_b:
-        icd_sim = icd_comp.compare(encounter_a["diagnoses"], encounter_b["diagnoses"])
-    if "inputevents" in encounter_a and "inputevents" in encounter_b:
-        inputevent_sim = inputevent_comp.compare(
-            encounter_a["inputevents"], encounter_b["inputevents"]
+        icd_sim = get_icd_comparator().compare(
+            encounter_a["diagnoses"], encounter_b["diagnoses"]
         )
+    if "inputevents" in encounter_a and "inputevents" in encounter_b:
+        inputevent_sim = compare_category("inputevents", similarities)
     if "vitalsigns" in encounter_a and "vitalsigns" in encounter_b:
-        vitalsign_sim = vitalsign_comp.compare(
-            encounter_a["vitalsigns"], encounter_b["vitalsigns"]
-        )
+        vitalsign_sim = compare_category("vitalsigns", similarities)
     if "vitalsigns_first24h" in encounter_a and "vitalsigns_first24h" in encounter_b:
-        vitalsign_first24h_sim = vitalsign_comp.compare(
-            encounter_a["vitalsigns_first24h"], encounter_b["vitalsigns_first24h"]
-        )
+        vitalsign_first24h_sim = compare_category("vitalsigns_first24h", similarities)
     if "prescriptions" in encounter_a and "prescriptions" in encounter_b:
-        prescriptions_sim = prescriptions_comp.compare(
-            encounter_a["prescriptions"], encounter_b["prescriptions"]
-        )
+        prescriptions_sim = compare_category("prescriptions", similarities)
 
     sims = {
         "labevents_sim": lab_sim,
@@ -319,253 +742,366 @@ def compare_encounters(encounter_pair: tuple[dict, dict]):
     }
 
 
-async def main(table_name: str):
-    logger.info(f"Started similarity import for table {table_name}.")
-    conn = await asyncpg.connect(
-        f"postgresql://{os.getenv('DB_USER')}:{os.getenv('DB_PASSWORD')}@{os.getenv('DB_HOST')}:{os.getenv('DB_PORT')}/{os.getenv('DB_NAME')}"
-    )
+def compare_tile(tile: tuple[int, int, int, int]) -> tuple[tuple, list[dict], float]:
+    """Compare all encounter pairs of a tile from upper_triangle_tiles, returns
+    the tile with its results and the seconds it took to compare them."""
+    start = time.perf_counter()
+    i_start, _, j_start, _ = tile
+    blocks = tile_similarities(tile)
+    result = []
+    for i, j in tile_pairs(tile):
+        similarities = {
+            category: block[i - i_start, j - j_start]
+            for category, block in blocks.items()
+        }
+        encounter_a = encounters[i]
+        encounter_b = encounters[j]
+        if encounter_b["hadm_id"] < encounter_a["hadm_id"]:
+            encounter_a, encounter_b = encounter_b, encounter_a
+        result.append(compare_encounters((encounter_a, encounter_b), similarities))
+    return tile, result, time.perf_counter() - start
 
-    logger.info("Connected to databases, starting to download categories.")
 
-    hadm_ids = await conn.fetch(
-        psycop_to_asyncpg_string(sq.sepsis_cohort), MIN_AGE, MAX_AGE, LIMIT
-    )
-    # kdigo_cohort = await conn.fetch(psycop_to_asyncpg_string(sq.kdigo_cohort))
-    # meld_cohort = await conn.fetch(psycop_to_asyncpg_string(sq.meld_cohort))
-    # cardiac_cohort = await conn.fetch(psycop_to_asyncpg_string(sq.cardiac_query))
-    # cardiac_cohort = await conn.fetch(psycop_to_asyncpg_string(sq.cardiac_query_2))
-    # icp_cohort = await conn.fetch(psycop_to_asyncpg_string(sq.icp_cohort))
-    # hadm_ids = meld_cohort + cardiac_cohort
-
-    logger.info("Finished downloading hadm_ids for cohort from db.")
-    demographics_records = await conn.fetch(
-        psycop_to_asyncpg_string(sq.get_demographics), hadm_ids
-    )
-    logger.info("Finished downloading demographics for cohort from db.")
-    diagnoses_records = await conn.fetch(
-        psycop_to_asyncpg_string(sq.get_icd_diagnoses), hadm_ids
-    )
-    logger.info("Finished downloading diagnoses for cohort from db.")
-    labevents_records = await conn.fetch(
-        psycop_to_asyncpg_string(sq.get_mean_labevents), hadm_ids
-    )
-    logger.info("Finished downloading labevents for cohort from db.")
-    labevents_first24h_records = await conn.fetch(
-        psycop_to_asyncpg_string(sq.get_mean_labevents_first_24h_icu), hadm_ids
-    )
-    logger.info("Finished downloading labevents first 24h for cohort from db.")
-    vitalsigns_records = await conn.fetch(
-        psycop_to_asyncpg_string(sq.get_mean_vitalsigns), hadm_ids
-    )
-    logger.info("Finished downloading vitalsigns for cohort from db.")
-    vitalsigns_first24h_records = await conn.fetch(
-        psycop_to_asyncpg_string(sq.get_mean_vitalsigns_first_24h_icu), hadm_ids
-    )
-    logger.info("Finished downloading vitalsigns first 24h for cohort from db.")
-    inputevents_records = await conn.fetch(
-        psycop_to_asyncpg_string(sq.get_inputevents_first_24h_icu), hadm_ids
-    )
-    logger.info("Finished downloading inputevents for cohort from db.")
-    prescription_records = await conn.fetch(
-        psycop_to_asyncpg_string(sq.get_prescriptions_first_24h_icu), hadm_ids
-    )
-    logger.info("Finished downloading prescriptions for cohort from db.")
+class StageThroughput:
+    """Rows and busy time of a pipeline stage, for throughput logging. Busy time
+    only counts the work on the rows, not waiting for them, and is summed over
+    the workers of a stage."""
 
-    logger.info("Starting to build similarity encounter for hadm_ids.")
-    hadm_ids = [i["hadm_id"] for i in hadm_ids]
-    hadm_data = {i: {"hadm_id": i} for i in hadm_ids}
+    def __init__(self, stage: str):
+        self.stage = stage
+        self.rows = 0
+        self.busy = 0.0
+        self.start = time.perf_counter()
 
-    for i in demographics_records:
-        hadm_data[i["hadm_id"]]["demographics"] = Demographics(
-            subject_id=i["subject_id"],
-            hadm_id=i["hadm_id"],
-            age=i["age"],
-            gender=i["gender"],
-            ethnicity=i["race"],
-        )
+    def add(self, rows: int, seconds: float):
+        self.rows += rows
+        self.busy += seconds
 
-    diagnoses_dicts = clean_diagnoses_records(
-        diagnoses_records
-    )  # turns the records into dicts and removes bad records
-    for i in diagnoses_dicts:
-        if "diagnoses" not in hadm_data[i["hadm_id"]]:
-            hadm_data[i["hadm_id"]]["diagnoses"] = []
-        hadm_data[i["hadm_id"]]["diagnoses"].append(
-            ICDDiagnosis(
-                subject_id=i["subject_id"],
-                hadm_id=i["hadm_id"],
-                icd_version=i["icd_version"],
-                icd_code=i["icd_code"],
-                seq_num=i["seq_num"],
-            )
+    def log(self):
+        elapsed = time.perf_counter() - self.start
+        logger.info(
+            f"{self.stage}: {self.rows} rows in {elapsed:.1f}s "
+            f"({self.rows / max(elapsed, 1e-9):.0f} rows/s, {self.busy:.1f}s busy)."
         )
 
-    for i in labevents_records:
-        valuenum = i["valuenum"]
-        if valuenum is None:
-            continue
-        if "labevents" not in hadm_data[i["hadm_id"]]:
-            hadm_data[i["hadm_id"]]["labevents"] = []
-        mean = i["mean_value"]
-        std_dev = i["std_dev"]
-        lower_ref = i["ref_range_lower"]
-        upper_ref = i["ref_range_upper"]
-        is_abnormal = labevent_is_abnormal(
-            valuenum, lower_ref, upper_ref, mean, std_dev
-        )
-        hadm_data[i["hadm_id"]]["labevents"].append(
-            LabEvent(
-                id=i["itemid"],
-                subject_id=i["subject_id"],
-                itemid=i["itemid"],
-                value=valuenum,
-                valueuom=i["valueuom"],
-                hadm_id=i["hadm_id"],
-                id_mean=mean,
-                id_std_dev=std_dev,
-                abnormal=is_abnormal,
-            )
-        )
 
-    for i in labevents_first24h_records:
-        valuenum = i["valuenum"]
-        if valuenum is None:
-            continue
-        if "labevents_first24h" not in hadm_data[i["hadm_id"]]:
-            hadm_data[i["hadm_id"]]["labevents_first24h"] = []
-        mean = i["mean_value"]
-        std_dev = i["std_dev"]
-        lower_ref = i["ref_range_lower"]
-        upper_ref = i["ref_range_upper"]
-        is_abnormal = labevent_is_abnormal(
-            valuenum, lower_ref, upper_ref, mean, std_dev
-        )
-        hadm_data[i["hadm_id"]]["labevents_first24h"].append(
-            LabEvent(
-                id=i["itemid"],
-                subject_id=i["subject_id"],
-                itemid=i["itemid"],
-                value=i["valuenum"],
-                valueuom=i["valueuom"],
-                hadm_id=i["hadm_id"],
-                id_mean=i["mean_value"],
-                id_std_dev=i["std_dev"],
-                abnormal=is_abnormal,
-            )
-        )
+def acquire_each(iterable, semaphore: threading.Semaphore, stop: threading.Event):
+    """Yield the items of iterable, acquiring semaphore before each one. Ends
+    early once stop is set, so that a stopped pool is not kept waiting."""
+    for item in iterable:
+        while not semaphore.acquire(timeout=1.0):
+            if stop.is_set():
+                return
+        yield item
 
-    for i in vitalsigns_records:
-        if "vitalsigns" not in hadm_data[i["hadm_id"]]:
-            hadm_data[i["hadm_id"]]["vitalsigns"] = []
-        subject_id = i[0]
-        hadm_id = i[1]
-        for name, value in zip(VITAL_SIGN_NAMES, i[2:]):
-            if value is None:
-                continue
-            id_mean = VITALSIGN_STATISTICS[name]["mean"]
-            id_std_dev = VITALSIGN_STATISTICS[name]["std"]
-            is_abnormal = vitalsign_is_abnormal(value, name)
-            hadm_data[i["hadm_id"]]["vitalsigns"].append(
-                Vitalsign(
-                    id=name,
-                    subject_id=subject_id,
-                    hadm_id=hadm_id,
-                    name=name,
-                    value=value,
-                    id_mean=id_mean,
-                    id_std_dev=id_std_dev,
-                    abnormal=is_abnormal,
-                )
-            )
-    for i in vitalsigns_first24h_records:
-        if "vitalsigns_first24h" not in hadm_data[i["hadm_id"]]:
-            hadm_data[i["hadm_id"]]["vitalsigns_first24h"] = []
-        subject_id = i[0]
-        hadm_id = i[1]
-        for name, value in zip(VITAL_SIGN_NAMES, i[2:]):
-            if value is None:
+
+_PENDING = object()
+
+
+def next_result(results, timeout: float = 1.0):
+    """Next result of an imap iterator, _PENDING if none arrived within timeout,
+    so that a waiting thread never blocks the shutdown of the event loop."""
+    try:
+        return results.next(timeout=timeout)
+    except multiprocessing.TimeoutError:
+        return _PENDING
+    except StopIteration:
+        return None
+
+
+async def compute_similarities(
+    backend,
+    tiles,
+    queue: asyncio.Queue,
+    semaphore: threading.Semaphore,
+    stop: threading.Event,
+    throughput: StageThroughput,
+):
+    """Producer, streams (tile, results) of the tiles into queue, ends with None.
+
+    The backend only takes a new tile after acquiring semaphore, which the
+    writer releases once the tile is inserted, so a slow database throttles the
+    workers instead of piling up results in memory.
+    """
+    results = backend.imap_unordered(compare_tile, acquire_each(tiles, semaphore, stop))
+    try:
+        while True:
+            tile_result = await asyncio.to_thread(next_result, results)
+            if tile_result is _PENDING:
                 continue
-            id_mean = VITALSIGN_STATISTICS[name]["mean"]
-            id_std_dev = VITALSIGN_STATISTICS[name]["std"]
-            is_abnormal = vitalsign_is_abnormal(value, name)
-            hadm_data[i["hadm_id"]]["vitalsigns_first24h"].append(
-                Vitalsign(
-                    id=name,
-                    subject_id=subject_id,
-                    hadm_id=hadm_id,
-                    name=name,
-                    value=value,
-                    id_mean=id_mean,
-                    id_std_dev=id_std_dev,
-                    abnormal=is_abnormal,
-                )
-            )
+            if tile_result is None:
+                break
+            tile, similarities, seconds = tile_result
+            # the time the worker spent on the tile, not the wait for it
+            throughput.add(len(similarities), seconds)
+            await queue.put((tile, similarities))
+    finally:
+        # also ends the writer if a tile failed
+        await queue.put(None)
+
 
-    for i in inputevents_records:
-        if "inputevents" not in hadm_data[i["hadm_id"]]:
-            hadm_data[i["hadm_id"]]["inputevents"] = []
-        hadm_data[i["hadm_id"]]["inputevents"].append(
-            InputEvent(
-                subject_id=i["subject_id"],
-                hadm_id=i["hadm_id"],
-                value=i["itemid"],
-                itemid=i["itemid"],
-                amount=i["amount"],
-                amountuom=i["amountuom"],
-                ordercategoryname=i["ordercategoryname"],
+async def write_similarities(
+    sink,
+    queue: asyncio.Queue,
+    semaphore: threading.Semaphore,
+    throughput: StageThroughput,
+):
+    """Consumer, writes the tile results of queue to sink in batches of
+    TILES_PER_BATCH tiles."""
+    batch = []
+    batch_tiles = []
+    while True:
+        tile_result = await queue.get()
+        if tile_result is not None:
+            batch_tiles.append(tile_result[0])
+            batch.extend(tile_result[1])
+        if batch_tiles and (tile_result is None or len(batch_tiles) >= TILES_PER_BATCH):
+            logger.info(
+                f"Writing a batch of {len(batch)} similarities "
+                f"({queue.qsize()} tiles queued)."
             )
+            start = time.perf_counter()
+            await sink.write(batch, batch_tiles)
+            throughput.add(len(batch), time.perf_counter() - start)
+            for _ in batch_tiles:
+                semaphore.release()
+            batch = []
+            batch_tiles = []
+        if tile_result is None:
+            break
+
+
+async def main(
+    table_name: str,
+    resume: bool = False,
+    shard: Optional[tuple[int, int]] = None,
+    backend: Optional[str] = None,
+    scheduler: Optional[str] = None,
+):
+    """Import the similarities of the cohort into table_name, or of shard
+    (k, n_shards) of its tiles into shard_table_name(table_name, shard).
+
+    The tiles are computed by backend (BACKEND if None), see
+    simpa.src.backends, the dask backend on the cluster of scheduler
+    (DASK_SCHEDULER if None).
+    """
+    check_feature_windows()
+    if shard:
+        table_name = shard_table_name(table_name, shard)
+    logger.info(
+        f"{'Resumed' if resume else 'Started'} similarity import for table {table_name}."
+    )
+    conn = await asyncpg.connect(database_url())
+
+    logger.info("Connected to databases, starting to download categories.")
+
+    async with asyncpg.create_pool(
+        database_url(), min_size=1, max_size=DB_POOL_SIZE
+    ) as pool:
+        cohort_records = await pool.fetch(
+            psycop_to_asyncpg_string(sq.sepsis_cohort), MIN_AGE, MAX_AGE, LIMIT
         )
+        # kdigo_cohort = await conn.fetch(psycop_to_asyncpg_string(sq.kdigo_cohort))
+        # meld_cohort = await conn.fetch(psycop_to_asyncpg_string(sq.meld_cohort))
+        # cardiac_cohort = await conn.fetch(psycop_to_asyncpg_string(sq.cardiac_query))
+        # cardiac_cohort = await conn.fetch(psycop_to_asyncpg_string(sq.cardiac_query_2))
+        # icp_cohort = await conn.fetch(psycop_to_asyncpg_string(sq.icp_cohort))
+        # hadm_ids = meld_cohort + cardiac_cohort
+        hadm_ids = [i["hadm_id"] for i in cohort_records]
+        logger.info("Finished downloading hadm_ids for cohort from db.")
 
-    for i in prescription_records:
-        if "prescriptions" not in hadm_data[i["hadm_id"]]:
-            hadm_data[i["hadm_id"]]["prescriptions"] = []
-        hadm_data[i["hadm_id"]]["prescriptions"].append(
-            Prescription(
-                subject_id=i["subject_id"],
-                hadm_id=i["hadm_id"],
-                drug=i["drug"],
-                pharmacy_id=i["pharmacy_id"],
-                gsn=i["gsn"],
-                value=i["value"],
-            )
+        # every category is decoded as soon as its query returns, while the
+        # queries of the others are still running
+        cache = await open_feature_cache(pool) if FEATURE_CACHE else None
+        sources = await asyncio.gather(
+            *(
+                fetch_category(pool, category, hadm_ids, cache)
+                for category in FEATURE_QUERIES
+            ),
+            *(
+                fetch_windowed(pool, source, hadm_ids, cache)
+                for source in WINDOWED_FEATURE_QUERIES
+            ),
         )
 
+    logger.info("Starting to build similarity encounter for hadm_ids.")
+    hadm_data = {i: {"hadm_id": i} for i in hadm_ids}
+    store = EncounterStore()
+    for categories in sources:
+        for category, category_data in categories.items():
+            if isinstance(category_data, CategoryColumns):
+                # encounters only keep the range of their rows in the store
+                store.add(category, category_data)
+                for hadm_id in category_data.hadm_ids.tolist():
+                    hadm_data[hadm_id][category] = category_data.rows(hadm_id)
+                continue
+            for hadm_id, value in category_data.items():
+                hadm_data[hadm_id][category] = value
+
     logger.info("Finished building similarity encounters.")
 
     hadm_data = remove_empty_data(hadm_data)
-    hadm_ids = list(hadm_data.keys())
-    encounter_pairs = []
-    n = len(hadm_ids)
-    batch_size = BATCH_SIZE
-    for idx, data_batch in enumerate(batch(list(range(n)), batch_size)):
-        for i in range(len(data_batch)):
-            i = i + idx * batch_size
-            hadm_id_i = hadm_ids[i]
-            for j in range(i + 1, n):
-                hadm_id_j = hadm_ids[j]
-                pair = (
-                    (hadm_data[hadm_id_i], hadm_data[hadm_id_j])
-                    if hadm_id_i < hadm_id_j
-                    else (hadm_data[hadm_id_j], hadm_data[hadm_id_i])
-                )
-                encounter_pairs.append(pair)
+    # sorted, so that the processes of all shards tile the same cohort order
+    hadm_ids = sorted(hadm_data.keys())
+
+    sink = make_sink(table_name, conn, shard=bool(shard))
+    parameters = run_parameters()
+    completed_tiles = set()
+    if resume:
+        hadm_ids = resume_cohort(
+            await sink.load_manifest(), hadm_ids, table_name, parameters
+        )
+        await sink.open(hadm_ids, resume=True)
+        completed_tiles = await sink.completed_tiles()
+        logger.info(f"Resuming after {len(completed_tiles)} completed tiles.")
+    else:
+        await sink.open(hadm_ids)
+        await sink.save_manifest({"hadm_ids": hadm_ids, "parameters": parameters})
+
+    # the workers compare the item categories tile by tile from the columns of
+    # the store, the percentiles of a category are computed once for all of its
+    # rows here
+    for category in distribution_comps:
+        if category in store.categories:
+            store.percentiles(category)
 
-        with Pool() as pool:
-            logger.info(f"Batch of {len(encounter_pairs)} created.")
-            logger.info("Starting multiprocesses to calculate similarities")
-            result = pool.map(compare_encounters, encounter_pairs)
-        logger.info(f"Inserting a batch of {len(result)} into database.")
-        await insert_similarities(conn=conn, similarites=result, table_name=table_name)
-        encounter_pairs = []
+    # keep the cohort out of the gc so that forked workers do not touch (and
+    # copy) its pages
+    gc.freeze()
+    # one pool or cluster for the whole run, the workers receive the cohort
+    # once through init_worker and tasks only carry tile coordinates
+    cohort_encounters = [hadm_data[hadm_id] for hadm_id in hadm_ids]
+    candidates = None
+    if BINARY_LSH is not None:
+        candidates = binary_lsh_candidates(store, cohort_encounters)
+    tiles = upper_triangle_tiles(len(cohort_encounters), TILE_SIZE)
+    if shard:
+        tiles = shard_tiles(list(tiles), *shard)
+        logger.info(f"Shard {shard[0]}/{shard[1]} has {len(tiles)} tiles.")
+    tiles = (tile for tile in tiles if (tile[0], tile[2]) not in completed_tiles)
+    backend = make_backend(backend or BACKEND, scheduler or DASK_SCHEDULER)
+    with backend.start(
+        init_worker,
+        (cohort_encounters, store, get_icd_comparator().cache, candidates),
+    ):
+        logger.info(f"Started {type(backend).__name__} to calculate similarities.")
+        queue = asyncio.Queue(maxsize=QUEUE_SIZE)
+        # the writer releases tiles after writing their batch, with fewer
+        # pending tiles than a batch the producer would wait forever
+        semaphore = threading.Semaphore(max(MAX_PENDING_TILES, TILES_PER_BATCH))
+        stop = threading.Event()
+        compute_throughput = StageThroughput("Compute")
+        write_throughput = StageThroughput("Write")
+        producer = asyncio.create_task(
+            compute_similarities(
+                backend, tiles, queue, semaphore, stop, compute_throughput
+            )
+        )
+        try:
+            await write_similarities(sink, queue, semaphore, write_throughput)
+            await producer
+        finally:
+            stop.set()
+            producer.cancel()
+        compute_throughput.log()
+        write_throughput.log()
+        await sink.close()
 
     logger.info(f"Finished insertion, closing database conncetion.")
     await conn.close()
 
 
+async def merge_shards(table_name: str, n_shards: int):
+    """Assemble the similarities of the n_shards shards of a run in table_name,
+    once every shard has completed all of its tiles."""
+    conn = None
+    if SINK != "files":
+        conn = await asyncpg.connect(database_url())
+    shards = [
+        make_sink(shard_table_name(table_name, (k, n_shards)), conn, shard=True)
+        for k in range(n_shards)
+    ]
+    manifests = [await shard.load_manifest() for shard in shards]
+    for k, manifest in enumerate(manifests):
+        if manifest is None:
+            raise ValueError(f"No manifest found for shard {k}/{n_shards}.")
+        if manifest["hadm_ids"] != manifests[0]["hadm_ids"]:
+            raise ValueError(f"The cohort of shard {k}/{n_shards} differs.")
+        if manifest_parameters(manifest) != manifest_parameters(manifests[0]):
+            raise ValueError(f"The parameters of shard {k}/{n_shards} differ.")
+    hadm_ids = manifests[0]["hadm_ids"]
+    parameters = manifest_parameters(manifests[0])
+
+    tiles = list(upper_triangle_tiles(len(hadm_ids), parameters["TILE_SIZE"]))
+    for k, shard in enumerate(shards):
+        expected = len(shard_tiles(tiles, k, n_shards))
+        completed = len(await shard.completed_tiles())
+        if completed < expected:
+            raise ValueError(
+                f"Shard {k}/{n_shards} is incomplete, {completed} of {expected} "
+                "tiles are done."
+            )
+
+    sink = make_sink(table_name, conn)
+    await sink.open(hadm_ids)
+    await sink.save_manifest({"hadm_ids": hadm_ids, "parameters": parameters})
+    await sink.merge(shards)
+    await sink.close()
+    logger.info(f"Merged {n_shards} shards into {table_name}.")
+    if conn is not None:
+        await conn.close()
+
+
+def parse_shard(value: str) -> tuple[int, int]:
+    shard, n_shards = (int(x) for x in value.split("/"))
+    if not 0 <= shard < n_shards:
+        raise argparse.ArgumentTypeError(f"{value} is not of the form k/N, 0 <= k < N")
+    return shard, n_shards
+
+
 if __name__ == "__main__":
-    table_name = "similarities_" + datetime.now().strftime("%Y%m%d%H%M%S")
+    parser = argparse.ArgumentParser(description="Import encounter similarities.")
+    parser.add_argument("--table", help="name of the similarity table of the run")
+    parser.add_argument(
+        "--resume",
+        metavar="TABLE",
+        help="continue the interrupted run of a similarity table",
+    )
+    parser.add_argument(
+        "--shard",
+        type=parse_shard,
+        metavar="k/N",
+        help="compute shard k (from 0) of N of the tiles of --table",
+    )
+    parser.add_argument(
+        "--merge",
+        type=int,
+        metavar="N",
+        help="merge the N completed shards of --table",
+    )
+    parser.add_argument(
+        "--backend",
+        choices=BACKENDS,
+        default=BACKEND,
+        help="execution backend for the tiles",
+    )
+    parser.add_argument(
+        "--scheduler",
+        metavar="ADDRESS",
+        default=DASK_SCHEDULER,
+        help="dask scheduler of the dask backend, a local cluster if not given",
+    )
+    args = parser.parse_args()
+    table_name = (
+        args.resume
+        or args.table
+        or ("similarities_" + datetime.now().strftime("%Y%m%d%H%M%S"))
+    )
+    if (args.shard or args.merge) and not (args.table or args.resume):
+        parser.error("--shard and --merge need the shared --table of the run")
+    log_name = shard_table_name(table_name, args.shard) if args.shard else table_name
     logging.basicConfig(
-        filename=f"logs/{table_name}.log",
+        filename=f"logs/{log_name}.log",
         filemode="a",
         format="%(asctime)s,%(msecs)d %(name)s %(levelname)s %(message)s",
         datefmt="%H:%M:%S",
@@ -577,6 +1113,17 @@ if __name__ == "__main__":
     )
 
     start_time = time.time()
-    asyncio.run(main(table_name))
+    if args.merge:
+        asyncio.run(merge_shards(table_name, args.merge))
+    else:
+        asyncio.run(
+            main(
+                table_name,
+                resume=args.resume is not None,
+                shard=args.shard,
+                backend=args.backend,
+                scheduler=args.scheduler,
+            )
+        )
     async_time = time.time()
     logger.info(f"Total time: {async_time - start_time}")
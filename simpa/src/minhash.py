@@ -0,0 +1,194 @@
+import math
+import zlib
+from collections import defaultdict
+from typing import Hashable, Iterable, Optional
+
+import numpy as np
+
+# (a * x + b) % PRIME stays below 2**64 for 32 bit value hashes
+PRIME = np.uint64((1 << 31) - 1)
+# number of sets whose signatures are computed at once
+SIGNATURE_BLOCK_SIZE = 4096
+
+
+def hash_value(value) -> int:
+    """Deterministic 32 bit hash, unlike hash() it does not change between processes."""
+    return zlib.crc32(str(value).encode())
+
+
+def num_perm_for_error(epsilon: float, delta: float = 0.05) -> int:
+    """Signature length for which an estimated Jaccard similarity is off by more
+    than epsilon with a probability of at most delta (Hoeffding bound)."""
+    return math.ceil(math.log(2 / delta) / (2 * epsilon**2))
+
+
+def lsh_parameters(num_perm: int, threshold: float) -> tuple[int, int]:
+    """Number of bands and rows per band whose LSH threshold (1 / bands) ** (1 / rows)
+    is closest to threshold, preferring to use more of the signature."""
+    best = None
+    for rows in range(1, num_perm + 1):
+        bands = num_perm // rows
+        distance = abs((1 / bands) ** (1 / rows) - threshold)
+        key = (round(distance, 3), -bands * rows)
+        if best is None or key < best[0]:
+            best = (key, bands, rows)
+    return best[1], best[2]
+
+
+class MinHashLSHIndex:
+    """MinHash signatures of value sets with banded LSH for candidate pairs.
+
+    Sets sharing the signature of at least one band are candidates, which finds
+    pairs with a Jaccard similarity above threshold with high probability
+    without comparing all pairs. Similarities of candidates are estimated from
+    the signatures, see error_bound. Empty sets are not bucketed, so they are
+    never candidates, and their estimated similarity is NaN.
+    """
+
+    def __init__(
+        self,
+        num_perm: int = 128,
+        threshold: float = 0.5,
+        bands: Optional[int] = None,
+        rows: Optional[int] = None,
+        seed: int = 1,
+    ):
+        if bands is None or rows is None:
+            bands, rows = lsh_parameters(num_perm, threshold)
+        if bands * rows > num_perm:
+            raise ValueError(f"{bands} bands of {rows} rows exceed {num_perm}")
+        self.num_perm = num_perm
+        self.threshold = threshold
+        self.bands = bands
+        self.rows = rows
+        rng = np.random.default_rng(seed)
+        self.a = rng.integers(1, PRIME, num_perm, dtype=np.uint64)
+        self.b = rng.integers(0, PRIME, num_perm, dtype=np.uint64)
+        self.keys: list[Hashable] = []
+        self.key_ids: dict[Hashable, int] = {}
+        self.signatures = np.empty((0, num_perm), dtype=np.uint64)
+        self.empty = np.empty(0, dtype=bool)
+        self.buckets = [defaultdict(list) for _ in range(bands)]
+
+    @classmethod
+    def from_error_bounds(
+        cls, epsilon: float, delta: float = 0.05, threshold: float = 0.5, **kwargs
+    ) -> "MinHashLSHIndex":
+        return cls(
+            num_perm=num_perm_for_error(epsilon, delta), threshold=threshold, **kwargs
+        )
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def error_bound(self, delta: float = 0.05) -> float:
+        """Estimates are within this distance of the true Jaccard similarity with
+        probability 1 - delta."""
+        return math.sqrt(math.log(2 / delta) / (2 * self.num_perm))
+
+    def compute_signatures(self, value_sets: list[Iterable]) -> np.ndarray:
+        """MinHash signatures of value_sets, all PRIME for empty sets."""
+        result = np.empty((len(value_sets), self.num_perm), dtype=np.uint64)
+        for start in range(0, len(value_sets), SIGNATURE_BLOCK_SIZE):
+            block = [
+                set(values)
+                for values in value_sets[start : start + SIGNATURE_BLOCK_SIZE]
+            ]
+            sizes = np.array([len(values) for values in block])
+            hashes = np.array(
+                [hash_value(v) for values in block for v in values], dtype=np.uint64
+            )
+            permuted = (hashes[:, None] * self.a[None, :] + self.b[None, :]) % PRIME
+            signatures = np.full((len(block), self.num_perm), PRIME, dtype=np.uint64)
+            non_empty = sizes > 0
+            if non_empty.any():
+                offsets = (np.cumsum(sizes) - sizes)[non_empty]
+                signatures[non_empty] = np.minimum.reduceat(permuted, offsets, axis=0)
+            result[start : start + len(block)] = signatures
+        return result
+
+    def add(self, keys: list[Hashable], value_sets: list[Iterable]):
+        value_sets = [set(values) for values in value_sets]
+        signatures = self.compute_signatures(value_sets)
+        empty = np.array([len(values) == 0 for values in value_sets], dtype=bool)
+        first_id = len(self.keys)
+        for i, key in enumerate(keys):
+            if key in self.key_ids:
+                raise ValueError(f"Key {key} is already in the index")
+            self.key_ids[key] = first_id + i
+        self.keys.extend(keys)
+        self.signatures = np.concatenate([self.signatures, signatures])
+        self.empty = np.concatenate([self.empty, empty])
+        non_empty = np.flatnonzero(~empty)
+        for band, buckets in enumerate(self.buckets):
+            columns = signatures[:, band * self.rows : (band + 1) * self.rows]
+            for i in non_empty:
+                buckets[columns[i].tobytes()].append(first_id + int(i))
+
+    def estimate(self, key_a: Hashable, key_b: Hashable) -> float:
+        """Estimated Jaccard similarity of two indexed sets, NaN if one is empty."""
+        id_a, id_b = self.key_ids[key_a], self.key_ids[key_b]
+        if self.empty[id_a] or self.empty[id_b]:
+            return math.nan
+        return float(np.mean(self.signatures[id_a] == self.signatures[id_b]))
+
+    def candidate_keys(self) -> np.ndarray:
+        """Sorted keys i * len(self) + j of the pairs (i, j), i < j, of positions
+        in keys that share a bucket."""
+        n = len(self.keys)
+        result = np.empty(0, dtype=np.int64)
+        for buckets in self.buckets:
+            band_keys = []
+            for members in buckets.values():
+                if len(members) < 2:
+                    continue
+                # members are added in ascending order, so x < y gives i < j
+                members = np.asarray(members, dtype=np.int64)
+                x, y = np.triu_indices(len(members), k=1)
+                band_keys.append(members[x] * n + members[y])
+            if band_keys:
+                result = np.union1d(result, np.concatenate(band_keys))
+        return result
+
+    def candidate_pairs(self) -> np.ndarray:
+        """(M, 2) array of the pairs (i, j), i < j, of positions in keys that
+        share a bucket, sorted."""
+        keys = self.candidate_keys()
+        return np.stack([keys // len(self.keys), keys % len(self.keys)], axis=1)
+
+    def similar_pairs(self, threshold: Optional[float] = None):
+        """(key_a, key_b, estimate) of candidate pairs with an estimated Jaccard
+        similarity of at least threshold (the index threshold by default)."""
+        threshold = self.threshold if threshold is None else threshold
+        pairs = self.candidate_pairs()
+        estimates = np.mean(
+            self.signatures[pairs[:, 0]] == self.signatures[pairs[:, 1]], axis=1
+        )
+        for (i, j), estimate in zip(pairs, estimates):
+            if estimate >= threshold:
+                yield self.keys[i], self.keys[j], float(estimate)
+
+    def query(self, values: Iterable, k: int = 10) -> list[tuple[Hashable, float]]:
+        """Top k indexed sets by estimated Jaccard similarity among the sets that
+        share a bucket with values, none for empty values."""
+        values = set(values)
+        if not values:
+            return []
+        signature = self.compute_signatures([values])[0]
+        return self._top_k(signature, k)
+
+    def top_k(self, key: Hashable, k: int = 10) -> list[tuple[Hashable, float]]:
+        """Top k other indexed sets for an indexed key, see query."""
+        own_id = self.key_ids[key]
+        return self._top_k(self.signatures[own_id], k, exclude=own_id)
+
+    def _top_k(self, signature: np.ndarray, k: int, exclude: Optional[int] = None):
+        candidates = set()
+        for band, buckets in enumerate(self.buckets):
+            band_key = signature[band * self.rows : (band + 1) * self.rows].tobytes()
+            candidates.update(buckets.get(band_key, []))
+        candidates.discard(exclude)
+        candidates = np.array(sorted(candidates), dtype=np.int64)
+        estimates = np.mean(self.signatures[candidates] == signature[None, :], axis=1)
+        order = np.argsort(-estimates, kind="stable")[:k]
+        return [(self.keys[candidates[i]], float(estimates[i])) for i in order]
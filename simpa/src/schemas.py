@@ -1,7 +1,23 @@
-from typing import Optional, Union, Any
+from typing import Optional, Union, Any, Iterable, Mapping
 from pydantic import BaseModel, validator
 
 
+class RecordModel(BaseModel):
+    """BaseModel with a constructor for trusted records, e.g. the rows of our own
+    SQL queries, whose values already have the types of the fields."""
+
+    @classmethod
+    def from_records(cls, records: Iterable[Mapping[str, Any]]) -> list:
+        """Objects of the records created by construct(), without validation.
+        Keys that are not fields are ignored and missing fields get their
+        defaults. External input has to use the validating constructor."""
+        fields = cls.__fields__.keys()
+        return [
+            cls.construct(**{name: r[name] for name in fields if name in r})
+            for r in records
+        ]
+
+
 class Numerical(BaseModel):
     value: float
     max_value: float
@@ -17,7 +33,7 @@ class CodedConcept(BaseModel):
     code: str
 
 
-class CodedNumerical(BaseModel):
+class CodedNumerical(RecordModel):
     id: Union[int, str]
     value: Optional[float]
     id_mean: Optional[float]
@@ -29,7 +45,7 @@ class CategoricalString(BaseModel):
     value: Any
 
 
-class Demographics(BaseModel):
+class Demographics(RecordModel):
     subject_id: int
     hadm_id: int
     age: Optional[int]
@@ -75,7 +91,7 @@ class Prescription(CategoricalString):
     gsn: Optional[str]
 
 
-class ICDDiagnosis(BaseModel):
+class ICDDiagnosis(RecordModel):
     subject_id: int
     hadm_id: int
     seq_num: int
@@ -4,23 +4,25 @@ import sys
 sys.path.insert(0, os.path.abspath(".."))
 print(sys.path)
 
-from pathlib import Path
 from dotenv import load_dotenv
-import pandas as pd
 import numpy as np
 
+from simpa.src.constants import SIMILARITY_CATEGORIES
 from simpa.src.db import PostgresDB
+from simpa.src.similarity_files import open_square_matrices, scatter_pairs
 
 load_dotenv()
 
 
 # generation of sim value calculation
 EXP_PATH = "simpa/src/scripts/groups"
+# rows of the similarity table converted to arrays at once
+ROW_BLOCK_SIZE = 1_000_000
+# similarity table read with PostgresDB.get_all_similarity_values, min-max scaled
+SIMILARITY_TABLE = "similarities_20230517102646"
 
 
 def main():
-    Path(EXP_PATH).mkdir(parents=True, exist_ok=True)
-
     db = PostgresDB(
         db_name=os.getenv("DB_NAME"),
         host=os.getenv("DB_HOST"),
@@ -29,115 +31,29 @@ def main():
         password=os.getenv("DB_PASSWORD"),
     )
 
-    similarity_values = (
-        db.get_all_similarity_values()
-    )  # (hadm_id_a, hadm_id_b, demo, icd, lab, vitals, input, lab_24h, vitals_24h, prescription)
-
-    matrix_skel = {}
-    hadm_ids = list(set([i[0] for i in similarity_values]))
-
-    for sim in similarity_values:
-        hadm_a = sim[0]
-        hadm_b = sim[1]
-        if hadm_a not in matrix_skel:
-            matrix_skel[tuple(sorted([hadm_a, hadm_b]))] = sim[2:]
-
-    demo_sims = np.zeros((len(hadm_ids), len(hadm_ids)))
-    icd_sims = np.zeros((len(hadm_ids), len(hadm_ids)))
-    lab_sims = np.zeros((len(hadm_ids), len(hadm_ids)))
-    lab_first_24h_sims = np.zeros((len(hadm_ids), len(hadm_ids)))
-    vital_sims = np.zeros((len(hadm_ids), len(hadm_ids)))
-    vital_first24h_sims = np.zeros((len(hadm_ids), len(hadm_ids)))
-    input_sims = np.zeros((len(hadm_ids), len(hadm_ids)))
-    prescription_sims = np.zeros((len(hadm_ids), len(hadm_ids)))
-
-    for i in range(len(hadm_ids)):
-        for j in range(len(hadm_ids)):
-            m_key = tuple(sorted([hadm_ids[i], hadm_ids[j]]))
-            if i == j:
-                demo_sims[i][j] = 1
-                icd_sims[i][j] = 1
-                lab_sims[i][j] = 1
-                lab_first_24h_sims[i][j] = 1
-                vital_sims[i][j] = 1
-                vital_first24h_sims[i][j] = 1
-                input_sims[i][j] = 1
-                prescription_sims[i][j] = 1
-            else:
-                demo_sims[i][j] = matrix_skel[m_key][0] if matrix_skel[m_key][0] else 0
-                icd_sims[i][j] = matrix_skel[m_key][1] if matrix_skel[m_key][1] else 0
-                lab_sims[i][j] = matrix_skel[m_key][2] if matrix_skel[m_key][2] else 0
-                vital_sims[i][j] = matrix_skel[m_key][3] if matrix_skel[m_key][3] else 0
-                input_sims[i][j] = matrix_skel[m_key][4] if matrix_skel[m_key][4] else 0
-                lab_first_24h_sims[i][j] = (
-                    matrix_skel[m_key][5] if matrix_skel[m_key][2] else 0
-                )
-                vital_first24h_sims[i][j] = (
-                    matrix_skel[m_key][6] if matrix_skel[m_key][3] else 0
-                )
-                prescription_sims[i][j] = (
-                    matrix_skel[m_key][7] if matrix_skel[m_key][5] else 0
-                )
-
-    demo_df = pd.DataFrame(demo_sims, index=hadm_ids, columns=hadm_ids)
-    icd_df = pd.DataFrame(icd_sims, index=hadm_ids, columns=hadm_ids)
-    lab_df = pd.DataFrame(lab_sims, index=hadm_ids, columns=hadm_ids)
-    lab_first24h_df = pd.DataFrame(lab_first_24h_sims, index=hadm_ids, columns=hadm_ids)
-    vital_df = pd.DataFrame(vital_sims, index=hadm_ids, columns=hadm_ids)
-    vital_first24h_df = pd.DataFrame(
-        vital_first24h_sims, index=hadm_ids, columns=hadm_ids
-    )
-    input_df = pd.DataFrame(input_sims, index=hadm_ids, columns=hadm_ids)
-    prescription_df = pd.DataFrame(prescription_sims, index=hadm_ids, columns=hadm_ids)
-
-    demo_df.to_pickle(
-        f"./{EXP_PATH}/demographics.pickle",
-        compression="infer",
-        protocol=5,
-        storage_options=None,
-    )
-    icd_df.to_pickle(
-        f"./{EXP_PATH}/icd.pickle",
-        compression="infer",
-        protocol=5,
-        storage_options=None,
-    )
-    lab_df.to_pickle(
-        f"./{EXP_PATH}/lab.pickle",
-        compression="infer",
-        protocol=5,
-        storage_options=None,
-    )
-    lab_first24h_df.to_pickle(
-        f"./{EXP_PATH}/lab_first_24h.pickle",
-        compression="infer",
-        protocol=5,
-        storage_options=None,
-    )
-    vital_df.to_pickle(
-        f"./{EXP_PATH}/vitals.pickle",
-        compression="infer",
-        protocol=5,
-        storage_options=None,
-    )
-    vital_first24h_df.to_pickle(
-        f"./{EXP_PATH}/vitals_first_24h.pickle",
-        compression="infer",
-        protocol=5,
-        storage_options=None,
-    )
-    input_df.to_pickle(
-        f"./{EXP_PATH}/input.pickle",
-        compression="infer",
-        protocol=5,
-        storage_options=None,
-    )
-    prescription_df.to_pickle(
-        f"./{EXP_PATH}/prescription.pickle",
-        compression="infer",
-        protocol=5,
-        storage_options=None,
-    )
+    similarity_values = db.get_all_similarity_values(
+        SIMILARITY_TABLE, scaled=True
+    )  # (hadm_id_a, hadm_id_b, *values in the order of SIMILARITY_CATEGORIES)
+
+    hadm_ids = {sim[0] for sim in similarity_values}
+    hadm_ids.update(sim[1] for sim in similarity_values)
+    hadm_ids = np.array(sorted(hadm_ids), dtype=np.int64)
+
+    # missing similarities are 0, every encounter is equal to itself
+    matrices = open_square_matrices(
+        EXP_PATH, hadm_ids, SIMILARITY_CATEGORIES, fill=0.0, diagonal=1.0
+    )
+    for start in range(0, len(similarity_values), ROW_BLOCK_SIZE):
+        # None becomes NaN and is filled with 0
+        block = np.array(
+            similarity_values[start : start + ROW_BLOCK_SIZE], dtype=np.float64
+        )
+        index_a = np.searchsorted(hadm_ids, block[:, 0].astype(np.int64))
+        index_b = np.searchsorted(hadm_ids, block[:, 1].astype(np.int64))
+        scatter_pairs(matrices, index_a, index_b, block[:, 2:], fill=0.0)
+    for matrix in matrices.values():
+        matrix.flush()
+    print(f"Wrote {len(SIMILARITY_CATEGORIES)} matrices of {len(hadm_ids)} encounters.")
 
 
 if __name__ == "__main__":
@@ -1,3 +1,5 @@
+import argparse
+import json
 import os
 import sys
 
@@ -5,52 +7,80 @@ sys.path.insert(0, os.path.abspath(".."))
 print(sys.path)
 
 from dotenv import load_dotenv
-import pandas as pd
+
+from simpa.src.similarity_files import AGGREGATE_METHODS, aggregate_square_matrices
 
 load_dotenv()
 
-# Path to pickle files
+# Path to the category matrices of create_sim_matrix
 DIR_PATH = "simpa/src/scripts/groups"
 
 # generation of sim value calculation
 GENERATION = 1
 
 # SIMILARITY SCORE
-DEMO_WEIGHT = 0.15
-ICD_WEIGHT = 0.15
-LAB_WEIGHT = 0.0
-LAB_F24H_WEIGHT = 0.2
-VITALS_WEIGHT = 0.0
-VITALS_F24H_WEIGHT = 0.2
-INPUT_WEIGHT = 0.15
-PRESCRIPTION_WEIGHT = 0.15
+WEIGHTS = {
+    "demographics": 0.15,
+    "diagnoses": 0.15,
+    "labevents": 0.0,
+    "labevents_first24h": 0.2,
+    "vitalsigns": 0.0,
+    "vitalsigns_first24h": 0.2,
+    "inputevents": 0.15,
+    "prescriptions": 0.15,
+}
 AGGREGATE = "mean"
+# matrix rows aggregated at once, bounds the memory use
+BLOCK_SIZE = 1024
 
 
-def main():
-    demo_df = pd.read_pickle(os.path.join(DIR_PATH, f"demographics.pickle"))
-    icd_df = pd.read_pickle(os.path.join(DIR_PATH, f"icd.pickle"))
-    lab_df = pd.read_pickle(os.path.join(DIR_PATH, f"lab.pickle"))
-    lab_first_24h_df = pd.read_pickle(os.path.join(DIR_PATH, f"lab_first_24h.pickle"))
-    vital_df = pd.read_pickle(os.path.join(DIR_PATH, f"vitals.pickle"))
-    vital_first_24h_df = pd.read_pickle(
-        os.path.join(DIR_PATH, f"vitals_first_24h.pickle")
+def parse_args(args=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Aggregate the category similarity matrices into sim_matrix.npy."
     )
-    input_df = pd.read_pickle(os.path.join(DIR_PATH, f"input.pickle"))
-    prescription_df = pd.read_pickle(os.path.join(DIR_PATH, f"prescription.pickle"))
-
-    result_df = (
-        demo_df * DEMO_WEIGHT
-        + icd_df * ICD_WEIGHT
-        + lab_df * LAB_WEIGHT
-        + lab_first_24h_df * LAB_F24H_WEIGHT
-        + vital_df * VITALS_WEIGHT
-        + vital_first_24h_df * VITALS_F24H_WEIGHT
-        + input_df * INPUT_WEIGHT
-        + prescription_df * PRESCRIPTION_WEIGHT
+    parser.add_argument("--dir", default=DIR_PATH, help="directory of the matrices")
+    parser.add_argument(
+        "--config",
+        help='JSON file with "weights" (category -> weight) and/or "aggregate"',
     )
+    parser.add_argument(
+        "--weight",
+        action="append",
+        default=[],
+        metavar="CATEGORY=WEIGHT",
+        help="weight of a category, overrides the config file",
+    )
+    parser.add_argument("--aggregate", choices=AGGREGATE_METHODS)
+    parser.add_argument("--block-size", type=int, default=BLOCK_SIZE)
+    return parser.parse_args(args)
+
 
-    result_df.to_pickle(os.path.join(DIR_PATH, f"sim_matrix.pickle"))
+def get_weights_and_aggregate(args: argparse.Namespace) -> tuple[dict, str]:
+    weights = dict(WEIGHTS)
+    aggregate = AGGREGATE
+    if args.config:
+        with open(args.config) as f:
+            config = json.load(f)
+        weights.update(config.get("weights", {}))
+        aggregate = config.get("aggregate", aggregate)
+    for weight in args.weight:
+        category, value = weight.split("=")
+        weights[category] = float(value)
+    if args.aggregate:
+        aggregate = args.aggregate
+    unknown = set(weights) - set(WEIGHTS)
+    if unknown:
+        raise ValueError(f"Unknown categories {', '.join(sorted(unknown))}")
+    return weights, aggregate
+
+
+def main():
+    args = parse_args()
+    weights, aggregate = get_weights_and_aggregate(args)
+    print(f"Aggregating with {aggregate} and weights {weights}")
+    aggregate_square_matrices(
+        args.dir, weights, aggregate, output="sim", block_size=args.block_size
+    )
 
 
 if __name__ == "__main__":
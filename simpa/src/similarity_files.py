@@ -0,0 +1,422 @@
+import json
+import os
+import shutil
+from typing import Iterable, Optional
+
+import numpy as np
+from scipy.spatial.distance import squareform
+
+from simpa.src.constants import SIMILARITY_CATEGORIES
+
+HADM_IDS_FILE = "hadm_ids.npy"
+METADATA_FILE = "metadata.json"
+# directory of the segments of a SimilarityPairWriter
+PAIRS_DIR = "pairs"
+SIMILARITY_DTYPE = np.float32
+AGGREGATE_METHODS = ["mean", "rmse"]
+# condensed values read at once when merging files or computing statistics
+CONDENSED_BLOCK_SIZE = 1 << 24
+
+
+def condensed_size(n: int) -> int:
+    return n * (n - 1) // 2
+
+
+def condensed_index(i: np.ndarray, j: np.ndarray, n: int) -> np.ndarray:
+    """Position of the pairs (i, j), i != j, in a condensed upper triangle of an
+    (n, n) matrix, in the row-major order of scipy's squareform."""
+    low = np.minimum(i, j).astype(np.int64)
+    high = np.maximum(i, j).astype(np.int64)
+    return n * low - low * (low + 1) // 2 + (high - low - 1)
+
+
+class SimilarityStatistics:
+    """Running minimum and maximum of the similarities of every category.
+
+    They are collected while a run writes its similarities and stored next to
+    them, so that the min-max scaling to [0, 1] is applied when the
+    similarities are read instead of writing a scaled copy.
+    """
+
+    def __init__(self, categories: list[str] = SIMILARITY_CATEGORIES):
+        self.categories = categories
+        self.min: dict[str, Optional[float]] = {c: None for c in categories}
+        self.max: dict[str, Optional[float]] = {c: None for c in categories}
+
+    def update(self, similarities: list[dict]):
+        """Update with results of compare_encounters."""
+        for category in self.categories:
+            self.update_values(
+                category,
+                np.array(
+                    [s["similarity"][f"{category}_sim"] for s in similarities],
+                    dtype=np.float64,
+                ),
+            )
+
+    def update_values(self, category: str, values: np.ndarray):
+        values = values[~np.isnan(values)]
+        if len(values) == 0:
+            return
+        low = float(values.min())
+        high = float(values.max())
+        if self.min[category] is not None:
+            low = min(low, self.min[category])
+            high = max(high, self.max[category])
+        self.min[category] = low
+        self.max[category] = high
+
+    def scale(self, category: str, values: np.ndarray) -> np.ndarray:
+        """Min-max scale values of category, NaN if all of its similarities are
+        equal or missing."""
+        low = self.min[category]
+        high = self.max[category]
+        if low is None or high == low:
+            return np.full_like(values, np.nan)
+        return (values - low) / (high - low)
+
+    def to_dict(self) -> dict:
+        return {c: {"min": self.min[c], "max": self.max[c]} for c in self.categories}
+
+    @classmethod
+    def from_dict(cls, statistics: dict) -> "SimilarityStatistics":
+        result = cls(list(statistics))
+        for category, values in statistics.items():
+            result.min[category] = values["min"]
+            result.max[category] = values["max"]
+        return result
+
+
+def pair_dtype(categories: list[str]) -> np.dtype:
+    """Segment rows of a SimilarityPairWriter, the condensed index of a pair and
+    its similarity per category."""
+    return np.dtype(
+        [("index", "<i8")] + [(category, SIMILARITY_DTYPE) for category in categories]
+    )
+
+
+def _write_metadata(path: str, n_encounters: int, categories: list[str], statistics):
+    with open(os.path.join(path, METADATA_FILE), "w") as f:
+        json.dump(
+            {
+                "n_encounters": n_encounters,
+                "categories": categories,
+                "dtype": np.dtype(SIMILARITY_DTYPE).name,
+                "statistics": statistics.to_dict(),
+            },
+            f,
+            indent=2,
+        )
+
+
+def _condensed_values(
+    similarities: list[dict], positions: dict[int, int], categories: list[str]
+) -> np.ndarray:
+    """Results of compare_encounters as rows of pair_dtype, None becomes NaN."""
+    rows = np.empty(len(similarities), dtype=pair_dtype(categories))
+    i = np.array([positions[s["encounter_a"]] for s in similarities])
+    j = np.array([positions[s["encounter_b"]] for s in similarities])
+    rows["index"] = condensed_index(i, j, len(positions))
+    for category in categories:
+        rows[category] = np.array(
+            [s["similarity"][f"{category}_sim"] for s in similarities],
+            dtype=np.float64,
+        )
+    return rows
+
+
+class SimilarityFileWriter:
+    """File sink for the similarities of a cohort.
+
+    Every category is written to a memory-mapped .npy file holding the condensed
+    upper triangle of its (N, N) similarity matrix as float32, with NaN for
+    pairs without a similarity. hadm_ids.npy holds the hadm_id of every row,
+    metadata.json the SimilarityStatistics of the written similarities.
+
+    With resume, the files of an interrupted run over the same hadm_ids are
+    opened for writing the missing pairs instead of being recreated.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        hadm_ids: Iterable[int],
+        categories: list[str] = SIMILARITY_CATEGORIES,
+        resume: bool = False,
+    ):
+        self.path = path
+        self.hadm_ids = np.asarray(list(hadm_ids), dtype=np.int64)
+        self.categories = categories
+        self.positions = {int(h): i for i, h in enumerate(self.hadm_ids)}
+        self.rows = 0
+        self.statistics = SimilarityStatistics(categories)
+        # set once the running statistics miss pairs that were written before
+        self.partial_statistics = resume
+
+        if resume:
+            if not np.array_equal(load_hadm_ids(path), self.hadm_ids):
+                raise ValueError(f"The hadm_ids of {path} differ from the cohort.")
+            self.arrays = {
+                category: np.load(os.path.join(path, f"{category}.npy"), mmap_mode="r+")
+                for category in categories
+            }
+            return
+
+        os.makedirs(path, exist_ok=True)
+        np.save(os.path.join(path, HADM_IDS_FILE), self.hadm_ids)
+        self.arrays = {}
+        for category in categories:
+            array = np.lib.format.open_memmap(
+                os.path.join(path, f"{category}.npy"),
+                mode="w+",
+                dtype=SIMILARITY_DTYPE,
+                shape=(condensed_size(len(self.hadm_ids)),),
+            )
+            array[:] = np.nan
+            self.arrays[category] = array
+
+    def write(self, similarities: list[dict]):
+        """Write results of compare_encounters into the category files."""
+        if not similarities:
+            return
+        rows = _condensed_values(similarities, self.positions, self.categories)
+        for category, array in self.arrays.items():
+            array[rows["index"]] = rows[category]
+            self.statistics.update_values(category, rows[category])
+        self.rows += len(similarities)
+
+    def merge(self, paths: list[str]):
+        """Scatter the pairs that the SimilarityPairWriters of paths wrote over
+        the same hadm_ids into this one, e.g. of the shards of a run. Only the
+        written pairs are read; which pairs a writer covers is tracked by the
+        tiles of its run, see merge_shards."""
+        for path in paths:
+            if not np.array_equal(load_hadm_ids(path), self.hadm_ids):
+                raise ValueError(f"The hadm_ids of {path} differ from {self.path}.")
+            for segment in load_pair_segments(path):
+                for category, array in self.arrays.items():
+                    array[segment["index"]] = segment[category]
+                self.rows += len(segment)
+        self.partial_statistics = True
+
+    def flush(self):
+        for array in self.arrays.values():
+            array.flush()
+
+    def close(self):
+        if self.partial_statistics:
+            self.statistics = SimilarityStatistics(self.categories)
+            for category, array in self.arrays.items():
+                for start in range(0, len(array), CONDENSED_BLOCK_SIZE):
+                    self.statistics.update_values(
+                        category, array[start : start + CONDENSED_BLOCK_SIZE]
+                    )
+        self.flush()
+        self.arrays = {}
+        _write_metadata(self.path, len(self.hadm_ids), self.categories, self.statistics)
+
+
+class SimilarityPairWriter:
+    """File sink for a part of the pairs of a cohort, e.g. of a shard of a run.
+
+    Every write is stored as a segment in pairs/, an array of pair_dtype rows
+    with the condensed index of the written pairs, so that the files only grow
+    with the pairs of this writer instead of the whole cohort. A
+    SimilarityFileWriter merges them into the condensed arrays of the cohort.
+    hadm_ids.npy and metadata.json are written like by SimilarityFileWriter.
+
+    With resume, the segments of an interrupted run over the same hadm_ids are
+    kept and new ones are added.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        hadm_ids: Iterable[int],
+        categories: list[str] = SIMILARITY_CATEGORIES,
+        resume: bool = False,
+    ):
+        self.path = path
+        self.hadm_ids = np.asarray(list(hadm_ids), dtype=np.int64)
+        self.categories = categories
+        self.positions = {int(h): i for i, h in enumerate(self.hadm_ids)}
+        self.rows = 0
+        self.statistics = SimilarityStatistics(categories)
+        self.partial_statistics = resume
+        self.pairs_path = os.path.join(path, PAIRS_DIR)
+
+        if resume:
+            if not np.array_equal(load_hadm_ids(path), self.hadm_ids):
+                raise ValueError(f"The hadm_ids of {path} differ from the cohort.")
+            self.n_segments = len(_segment_files(path))
+            return
+
+        # segments of an earlier run would be merged with this one
+        shutil.rmtree(self.pairs_path, ignore_errors=True)
+        os.makedirs(self.pairs_path)
+        np.save(os.path.join(path, HADM_IDS_FILE), self.hadm_ids)
+        self.n_segments = 0
+
+    def write(self, similarities: list[dict]):
+        """Write results of compare_encounters as a new segment."""
+        if not similarities:
+            return
+        rows = _condensed_values(similarities, self.positions, self.categories)
+        for category in self.categories:
+            self.statistics.update_values(category, rows[category])
+        # a segment is complete once it has its name
+        file_path = os.path.join(self.pairs_path, f"{self.n_segments:08d}.npy")
+        with open(f"{file_path}.tmp", "wb") as f:
+            np.save(f, rows)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(f"{file_path}.tmp", file_path)
+        self.n_segments += 1
+        self.rows += len(similarities)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if self.partial_statistics:
+            self.statistics = SimilarityStatistics(self.categories)
+            for segment in load_pair_segments(self.path):
+                for category in self.categories:
+                    self.statistics.update_values(category, segment[category])
+        _write_metadata(self.path, len(self.hadm_ids), self.categories, self.statistics)
+
+
+def _segment_files(path: str) -> list[str]:
+    pairs_path = os.path.join(path, PAIRS_DIR)
+    return sorted(
+        os.path.join(pairs_path, name)
+        for name in os.listdir(pairs_path)
+        if name.endswith(".npy")
+    )
+
+
+def load_pair_segments(path: str) -> Iterable[np.ndarray]:
+    """The segments of a SimilarityPairWriter, arrays of pair_dtype rows."""
+    for file_path in _segment_files(path):
+        yield np.load(file_path)
+
+
+def load_hadm_ids(path: str) -> np.ndarray:
+    return np.load(os.path.join(path, HADM_IDS_FILE))
+
+
+def load_statistics(path: str) -> SimilarityStatistics:
+    with open(os.path.join(path, METADATA_FILE)) as f:
+        return SimilarityStatistics.from_dict(json.load(f)["statistics"])
+
+
+def load_condensed(path: str, category: str, mmap_mode: Optional[str] = "r"):
+    """Condensed upper triangle of a category, memory-mapped by default."""
+    return np.load(os.path.join(path, f"{category}.npy"), mmap_mode=mmap_mode)
+
+
+def load_similarity_matrix(
+    path: str, category: str, diagonal: float = 1.0, scaled: bool = False
+) -> np.ndarray:
+    """(N, N) similarity matrix of a category, rows and columns in the order of
+    load_hadm_ids. With scaled, the similarities are min-max scaled with the
+    statistics of the run."""
+    matrix = squareform(load_condensed(path, category), checks=False)
+    if scaled:
+        matrix = load_statistics(path).scale(category, matrix)
+    np.fill_diagonal(matrix, diagonal)
+    return matrix
+
+
+def square_matrix_file(path: str, category: str) -> str:
+    return os.path.join(path, f"{category}_matrix.npy")
+
+
+def open_square_matrices(
+    path: str,
+    hadm_ids: np.ndarray,
+    categories: list[str],
+    fill: float = 0.0,
+    diagonal: float = 1.0,
+) -> dict[str, np.memmap]:
+    """Create memory-mapped (N, N) float32 matrices of categories, filled with
+    fill and diagonal, and hadm_ids.npy for their rows and columns."""
+    os.makedirs(path, exist_ok=True)
+    np.save(os.path.join(path, HADM_IDS_FILE), np.asarray(hadm_ids, dtype=np.int64))
+    matrices = {}
+    for category in categories:
+        matrix = np.lib.format.open_memmap(
+            square_matrix_file(path, category),
+            mode="w+",
+            dtype=SIMILARITY_DTYPE,
+            shape=(len(hadm_ids), len(hadm_ids)),
+        )
+        matrix[:] = fill
+        np.fill_diagonal(matrix, diagonal)
+        matrices[category] = matrix
+    return matrices
+
+
+def scatter_pairs(
+    matrices: dict[str, np.ndarray],
+    index_a: np.ndarray,
+    index_b: np.ndarray,
+    values: np.ndarray,
+    fill: float = 0.0,
+):
+    """Write the similarities of the pairs (index_a, index_b) into both
+    triangles of matrices. values has one column per matrix, in the order of
+    matrices, NaN is replaced by fill."""
+    for column, matrix in enumerate(matrices.values()):
+        category_values = np.nan_to_num(values[:, column], nan=fill)
+        matrix[index_a, index_b] = category_values
+        matrix[index_b, index_a] = category_values
+
+
+def load_square_matrix(path: str, category: str, mmap_mode: Optional[str] = "r"):
+    """(N, N) matrix written by open_square_matrices, memory-mapped by default."""
+    return np.load(square_matrix_file(path, category), mmap_mode=mmap_mode)
+
+
+def aggregate_square_matrices(
+    path: str,
+    weights: dict[str, float],
+    aggregate_method: str = "mean",
+    output: str = "sim",
+    block_size: int = 1024,
+) -> np.memmap:
+    """Weighted aggregate of the category matrices of path, written into the
+    memory-mapped matrix output, block_size rows at a time.
+
+    "mean" is the weighted sum and "rmse" the root of the weighted sum of
+    squares of the similarities, like EncounterComparator.compare. Only one row
+    block per category is in memory at once.
+    """
+    if aggregate_method not in AGGREGATE_METHODS:
+        raise ValueError(f"Unknown aggregate method {aggregate_method}")
+    n = len(load_hadm_ids(path))
+    matrices = {
+        category: load_square_matrix(path, category)
+        for category, weight in weights.items()
+        if weight != 0
+    }
+    result = np.lib.format.open_memmap(
+        square_matrix_file(path, output),
+        mode="w+",
+        dtype=SIMILARITY_DTYPE,
+        shape=(n, n),
+    )
+    for start in range(0, n, block_size):
+        stop = min(start + block_size, n)
+        block_result = np.zeros((stop - start, n), dtype=np.float64)
+        for category, matrix in matrices.items():
+            block = np.asarray(matrix[start:stop], dtype=np.float64)
+            if aggregate_method == "rmse":
+                np.square(block, out=block)
+            block *= weights[category]
+            block_result += block
+        if aggregate_method == "rmse":
+            np.sqrt(block_result, out=block_result)
+        result[start:stop] = block_result
+    result.flush()
+    return result
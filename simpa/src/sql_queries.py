@@ -1,3 +1,5 @@
+from simpa.src.constants import VITAL_SIGN_NAMES
+
 random_hadm_ids = (
     "SELECT hadm_id FROM mimiciv_hosp.admissions ORDER BY RANDOM() LIMIT %s ;"
 )
@@ -14,23 +16,11 @@ WHERE
 """
 
 
-get_mean_vitalsigns = """
-SELECT
-    i.subject_id, i.hadm_id, AVG(v.heart_rate), AVG(v.sbp_ni), AVG(v.dbp_ni), 
-    AVG(v.mbp_ni), AVG(v.resp_rate), AVG(v.temperature), AVG(v.spo2), AVG(v.glucose)
-FROM 
-    mimiciv_derived.vitalsign v, mimiciv_icu.icustays i
-WHERE 
-    i.hadm_id = ANY( %s ) 
-    AND v.stay_id = i.stay_id
-GROUP BY 
-    i.hadm_id, i.subject_id;
-"""
-
 get_mean_vitalsigns_first_24h_icu = """
 SELECT
-    i.subject_id, i.hadm_id, AVG(v.heart_rate), AVG(v.sbp_ni), AVG(v.dbp_ni), 
-    AVG(v.mbp_ni), AVG(v.resp_rate), AVG(v.temperature), AVG(v.spo2), AVG(v.glucose)
+    i.subject_id, i.hadm_id, AVG(v.heart_rate) AS heart_rate, AVG(v.sbp_ni) AS sbp_ni,
+    AVG(v.dbp_ni) AS dbp_ni, AVG(v.mbp_ni) AS mbp_ni, AVG(v.resp_rate) AS resp_rate,
+    AVG(v.temperature) AS temperature, AVG(v.spo2) AS spo2, AVG(v.glucose) AS glucose
 FROM 
     mimiciv_derived.vitalsign v, mimiciv_icu.icustays i, mimiciv_icu.icustays ie, mimiciv_derived.icustay_detail id
 WHERE 
@@ -45,35 +35,82 @@ GROUP BY
     i.hadm_id, i.subject_id;
 """
 
-get_mean_labevents = """
+get_mean_labevents_first_24h_icu = """
 SELECT 
     le.itemid, le.subject_id, le.hadm_id, AVG(le.valuenum) as valuenum, le.valueuom,
     ls.mean_value, ls.std_dev, li.label, le.ref_range_lower, le.ref_range_upper
 FROM 
-    mimiciv_hosp.labevents le, labevent_statistics ls, mimiciv_hosp.d_labitems li
+    mimiciv_hosp.labevents le, labevent_statistics ls, mimiciv_hosp.d_labitems li, mimiciv_icu.icustays ie, mimiciv_derived.icustay_detail id 
 WHERE 
     le.hadm_id = ANY( %s ) 
     AND le.itemid = ls.itemid
     AND le.itemid = li.itemid
+    AND le.hadm_id = ie.hadm_id
+    AND le.hadm_id = id.hadm_id
+    AND le.charttime >= DATETIME_SUB(ie.intime, INTERVAL '6' HOUR)
+    AND le.charttime <= DATETIME_ADD(ie.intime, INTERVAL '1' DAY)
+    AND id.first_icu_stay = 'true'
 GROUP BY 
     le.itemid, le.hadm_id, le.subject_id, le.valueuom, ls.mean_value, ls.std_dev, li.label, le.ref_range_lower, le.ref_range_upper;
 """
 
-get_mean_labevents_first_24h_icu = """
+
+def icu_window(column: str, hours: int) -> str:
+    """Condition for column in the window from 6 hours before to hours after the
+    intime of the first ICU stay, joined as id.icustay_detail."""
+    return (
+        f"{column} >= DATETIME_SUB(id.icu_intime, INTERVAL '6' HOUR) "
+        f"AND {column} <= DATETIME_ADD(id.icu_intime, INTERVAL '{hours}' HOUR)"
+    )
+
+
+def windowed_vitalsigns(windows: dict[str, int]) -> str:
+    """Mean vital signs of the whole stay and, as columns {name}_{window}, of
+    every window of windows (window -> hours, see icu_window) in one scan."""
+    columns = [f"AVG(v.{name}) AS {name}" for name in VITAL_SIGN_NAMES]
+    for window, hours in windows.items():
+        columns += [
+            f"AVG(v.{name}) FILTER (WHERE {icu_window('v.charttime', hours)}) "
+            f"AS {name}_{window}"
+            for name in VITAL_SIGN_NAMES
+        ]
+    columns = ",\n    ".join(columns)
+    return f"""
+SELECT
+    i.subject_id, i.hadm_id,
+    {columns}
+FROM 
+    mimiciv_derived.vitalsign v
+    JOIN mimiciv_icu.icustays i ON v.stay_id = i.stay_id
+    LEFT JOIN mimiciv_derived.icustay_detail id
+        ON i.hadm_id = id.hadm_id AND id.first_icu_stay = true
+WHERE 
+    i.hadm_id = ANY( %s ) 
+GROUP BY 
+    i.hadm_id, i.subject_id;
+"""
+
+
+def windowed_labevents(windows: dict[str, int]) -> str:
+    """Mean lab values of the whole stay and, as columns valuenum_{window}, of
+    every window of windows (window -> hours, see icu_window) in one scan."""
+    columns = "".join(
+        f",\n    AVG(le.valuenum) FILTER (WHERE {icu_window('le.charttime', hours)}) "
+        f"AS valuenum_{window}"
+        for window, hours in windows.items()
+    )
+    return f"""
 SELECT 
     le.itemid, le.subject_id, le.hadm_id, AVG(le.valuenum) as valuenum, le.valueuom,
-    ls.mean_value, ls.std_dev, li.label, le.ref_range_lower, le.ref_range_upper
+    ls.mean_value, ls.std_dev, li.label, le.ref_range_lower, le.ref_range_upper{columns}
 FROM 
-    mimiciv_hosp.labevents le, labevent_statistics ls, mimiciv_hosp.d_labitems li, mimiciv_icu.icustays ie, mimiciv_derived.icustay_detail id 
+    mimiciv_hosp.labevents le
+    JOIN labevent_statistics ls ON le.itemid = ls.itemid
+    JOIN mimiciv_hosp.d_labitems li ON le.itemid = li.itemid
+    LEFT JOIN mimiciv_derived.icustay_detail id
+        ON le.hadm_id = id.hadm_id AND id.first_icu_stay = true
 WHERE 
     le.hadm_id = ANY( %s ) 
-    AND le.itemid = ls.itemid
-    AND le.itemid = li.itemid
-    AND le.hadm_id = ie.hadm_id
-    AND le.hadm_id = id.hadm_id
-    AND le.charttime >= DATETIME_SUB(ie.intime, INTERVAL '6' HOUR)
-    AND le.charttime <= DATETIME_ADD(ie.intime, INTERVAL '1' DAY)
-    AND id.first_icu_stay = 'true'
 GROUP BY 
     le.itemid, le.hadm_id, le.subject_id, le.valueuom, ls.mean_value, ls.std_dev, li.label, le.ref_range_lower, le.ref_range_upper;
 """
@@ -159,14 +196,94 @@ WHERE
     AND id.first_icu_stay = 'true';
 """
 
-all_scaled_similarity_values = """
+all_similarity_values = """
 SELECT 
-    hadm_id_a, hadm_id_b, demographics_similarity_scaled, vitalsigns_similarity_scaled, labevents_similarity_scaled, diagnoses_similarity_scaled,
-    inputevents_similarity_scaled, labevents_first24h_similarity_scaled, vitalsigns_first24h_similarity_scaled, prescriptions_similarity_scaled
-FROM similarities_20230517102646_scaled
+    hadm_id_a, hadm_id_b, {columns}
+FROM {table_name}
 ORDER BY hadm_id_a, hadm_id_b DESC;
 """
 
+min_max_similarity_values = """
+SELECT 
+    {columns}
+FROM {table_name};
+"""
+
+create_similarity_statistics_table = """
+CREATE TABLE IF NOT EXISTS similarity_statistics (
+    table_name text,
+    category text,
+    min_value float,
+    max_value float,
+    PRIMARY KEY (table_name, category)
+);
+"""
+
+similarity_statistics = """
+SELECT 
+    category, min_value, max_value
+FROM 
+    similarity_statistics
+WHERE 
+    table_name = %s;
+"""
+
+upsert_similarity_statistics = """
+INSERT INTO 
+    similarity_statistics (table_name, category, min_value, max_value)
+VALUES 
+    ( %s , %s , %s , %s )
+ON CONFLICT (table_name, category) DO UPDATE SET 
+    min_value = EXCLUDED.min_value, max_value = EXCLUDED.max_value;
+"""
+
+create_similarity_run_tables = """
+CREATE TABLE IF NOT EXISTS similarity_runs (
+    table_name text PRIMARY KEY,
+    hadm_ids integer[],
+    parameters text
+);
+
+CREATE TABLE IF NOT EXISTS similarity_tiles (
+    table_name text,
+    i_start integer,
+    j_start integer,
+    PRIMARY KEY (table_name, i_start, j_start)
+);
+"""
+
+similarity_run = """
+SELECT 
+    hadm_ids, parameters
+FROM 
+    similarity_runs
+WHERE 
+    table_name = %s ;
+"""
+
+insert_similarity_run = """
+INSERT INTO 
+    similarity_runs (table_name, hadm_ids, parameters)
+VALUES 
+    ( %s , %s , %s );
+"""
+
+similarity_tiles = """
+SELECT 
+    i_start, j_start
+FROM 
+    similarity_tiles
+WHERE 
+    table_name = %s ;
+"""
+
+insert_similarity_tile = """
+INSERT INTO 
+    similarity_tiles (table_name, i_start, j_start)
+VALUES 
+    ( %s , %s , %s );
+"""
+
 vitalsign_mean_std = """
 SELECT 
     mean_value, std_dev
@@ -176,6 +293,14 @@ WHERE
     vitalsign_name = %s ;
 """
 
+# identifies the contents of labevent_statistics, see FeatureCache
+labevent_statistics_checksum = """
+SELECT 
+    md5(string_agg(ls::text, ',' ORDER BY ls::text))
+FROM 
+    labevent_statistics ls;
+"""
+
 labevent_mean_std = """
 SELECT 
     mean_value, std_dev
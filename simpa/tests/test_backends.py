@@ -0,0 +1,26 @@
+import pytest
+
+from simpa.src.backends import make_backend
+
+offset = None
+
+
+def init_offset(value: int):
+    global offset
+    offset = value
+
+
+def add_offset(item: int) -> int:
+    return item + offset
+
+
+@pytest.mark.parametrize("backend", ["multiprocessing", "dask"])
+def test_backend_maps_with_initialized_state(backend):
+    with make_backend(backend, processes=2).start(init_offset, (10,)) as workers:
+        results = workers.imap_unordered(add_offset, iter(range(20)))
+        assert sorted(results) == list(range(10, 30))
+
+
+def test_unknown_backend():
+    with pytest.raises(ValueError):
+        make_backend("ray")
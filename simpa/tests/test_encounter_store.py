@@ -0,0 +1,93 @@
+import numpy as np
+
+from simpa.src.base_comparators import BinaryComparator, DistributionItems
+from simpa.src.encounter_store import CategoryColumns, EncounterStore
+from simpa.src.schemas import Vitalsign
+
+VITALSIGNS = [
+    Vitalsign(
+        id="sbp",
+        name="sbp",
+        subject_id=1,
+        hadm_id=2,
+        value=120.0,
+        id_mean=110.0,
+        id_std_dev=10.0,
+        abnormal=False,
+    ),
+    Vitalsign(
+        id="hr",
+        name="hr",
+        subject_id=1,
+        hadm_id=2,
+        value=80.0,
+        id_mean=70.0,
+        id_std_dev=0.0,
+        abnormal=True,
+    ),
+    Vitalsign(
+        id="hr",
+        name="hr",
+        subject_id=3,
+        hadm_id=1,
+        value=60.0,
+        id_mean=None,
+        id_std_dev=None,
+        abnormal=None,
+    ),
+]
+
+
+def vitalsign_store() -> EncounterStore:
+    columns = {
+        name: [getattr(v, name) for v in VITALSIGNS]
+        for name in [
+            "id",
+            "subject_id",
+            "hadm_id",
+            "name",
+            "value",
+            "id_mean",
+            "id_std_dev",
+            "abnormal",
+        ]
+    }
+    store = EncounterStore()
+    store.add(
+        "vitalsigns",
+        CategoryColumns.from_lists(columns, order_by="id", model=Vitalsign),
+    )
+    return store
+
+
+def test_rows_are_grouped_by_hadm_id_and_sorted_by_id():
+    store = vitalsign_store()
+    assert store.rows("vitalsigns", 1) == range(0, 1)
+    assert store.rows("vitalsigns", 2) == range(1, 3)
+    assert store.rows("vitalsigns", 5) == range(0)
+    assert store.column("vitalsigns", "id").tolist() == ["hr", "hr", "sbp"]
+    assert store.items("vitalsigns", 2) == [VITALSIGNS[1], VITALSIGNS[0]]
+
+
+def test_distribution_items_match_the_items():
+    store = vitalsign_store()
+    for hadm_id in [1, 2]:
+        items = store.distribution_items(
+            "vitalsigns", store.rows("vitalsigns", hadm_id)
+        )
+        expected = DistributionItems.from_items(
+            [v for v in VITALSIGNS if v.hadm_id == hadm_id]
+        )
+        assert items.hadm_id == expected.hadm_id
+        assert items.ids.tolist() == expected.ids.tolist()
+        np.testing.assert_array_equal(items.percentiles, expected.percentiles)
+        np.testing.assert_array_equal(items.abnormal, expected.abnormal)
+
+
+def test_compare_cohort_values_matches_compare_cohort():
+    store = vitalsign_store()
+    rows = [store.rows("vitalsigns", 1), store.rows("vitalsigns", 2), None]
+    comp = BinaryComparator()
+    expected = comp.compare_cohort([VITALSIGNS[2:], VITALSIGNS[:2], None])
+    result = comp.compare_cohort_values([store.values("vitalsigns", r) for r in rows])
+    np.testing.assert_array_equal(result, expected)
@@ -0,0 +1,62 @@
+from simpa.src.feature_cache import FeatureCache, data_source
+
+COLUMNS = ["subject_id", "hadm_id", "valuenum"]
+
+
+def test_only_missing_hadm_ids_are_queried(tmp_path):
+    cache = FeatureCache(str(tmp_path))
+    query = "SELECT subject_id, hadm_id, valuenum FROM labs WHERE hadm_id = ANY(%s)"
+    assert cache.missing("labs", query, [1, 2]) == [1, 2]
+
+    # hadm_id 2 has no records, but is cached as queried
+    cache.store("labs", query, [1, 2], COLUMNS, [(10, 1, 0.5), (10, 1, None)])
+    assert cache.missing("labs", query, [1, 2, 3]) == [3]
+    cache.store("labs", query, [3], COLUMNS, [(30, 3, 1.5)])
+
+    records = cache.load("labs", query, [1, 3])
+    assert sorted(records, key=lambda r: r["hadm_id"]) == [
+        {"subject_id": 10, "hadm_id": 1, "valuenum": 0.5},
+        {"subject_id": 10, "hadm_id": 1, "valuenum": None},
+        {"subject_id": 30, "hadm_id": 3, "valuenum": 1.5},
+    ]
+    assert cache.load("labs", query, [2]) == []
+
+
+def test_changed_query_invalidates_records(tmp_path):
+    cache = FeatureCache(str(tmp_path))
+    cache.store("labs", "SELECT 1", [1], COLUMNS, [(10, 1, 0.5)])
+
+    cache = FeatureCache(str(tmp_path))
+    assert cache.missing("labs", "SELECT 2", [1]) == [1]
+    # records of other query versions are kept until they are removed
+    assert cache.missing("labs", "SELECT 1", [1]) == []
+    cache.remove_stale("labs", "SELECT 2")
+    assert cache.missing("labs", "SELECT 1", [1]) == [1]
+
+
+def test_changed_source_invalidates_records(tmp_path):
+    source = data_source("localhost:5432/mimiciv", "a")
+    FeatureCache(str(tmp_path), source).store(
+        "labs", "SELECT 1", [1], COLUMNS, [(10, 1, 0.5)]
+    )
+
+    assert FeatureCache(str(tmp_path), source).missing("labs", "SELECT 1", [1]) == []
+    for changed in [
+        data_source("localhost:5432/mimiciv", "b"),
+        data_source("otherhost:5432/mimiciv", "a"),
+    ]:
+        cache = FeatureCache(str(tmp_path), changed)
+        assert cache.missing("labs", "SELECT 1", [1]) == [1]
+
+
+def test_hadm_ids_stored_twice_are_loaded_once(tmp_path):
+    # e.g. two processes that both found hadm_id 1 missing
+    cache = FeatureCache(str(tmp_path))
+    cache.store("labs", "SELECT 1", [1], COLUMNS, [(10, 1, 0.5)])
+    cache.store("labs", "SELECT 1", [1, 2], COLUMNS, [(10, 1, 0.5), (20, 2, 1.0)])
+
+    records = cache.load("labs", "SELECT 1", [1, 2])
+    assert sorted(records, key=lambda r: r["hadm_id"]) == [
+        {"subject_id": 10, "hadm_id": 1, "valuenum": 0.5},
+        {"subject_id": 20, "hadm_id": 2, "valuenum": 1.0},
+    ]
@@ -0,0 +1,27 @@
+from simpa.src.helper import (
+    chunked,
+    shard_tiles,
+    tile_pair_count,
+    tile_pairs,
+    upper_triangle_tiles,
+)
+
+
+def test_tiles_cover_upper_triangle():
+    n = 11
+    pairs = [pair for tile in upper_triangle_tiles(n, 4) for pair in tile_pairs(tile)]
+    assert sorted(pairs) == [(i, j) for i in range(n) for j in range(i + 1, n)]
+
+
+def test_chunked():
+    assert list(chunked(iter(range(5)), 2)) == [[0, 1], [2, 3], [4]]
+
+
+def test_shards_partition_tiles_with_balanced_pairs():
+    tiles = list(upper_triangle_tiles(1000, 64))
+    shards = [shard_tiles(tiles, k, 3) for k in range(3)]
+    assert sorted(t for shard in shards for t in shard) == sorted(tiles)
+    pairs = [sum(tile_pair_count(t) for t in shard) for shard in shards]
+    assert sum(pairs) == 1000 * 999 // 2
+    assert max(pairs) - min(pairs) <= 64 * 64
+    assert shard_tiles(tiles, 1, 3) == shards[1]
@@ -0,0 +1,144 @@
+import json
+
+import pytest
+
+from simpa.src.schemas import ICDDiagnosis
+from simpa.src.code_pair_store import CodePairSimilarityStore
+from simpa.src.icd_diagnoses import (
+    CodeSimilarityCache,
+    ICDComparator,
+    IcdCodeNormalizer,
+    get_icd10_graph,
+    get_icd10_index,
+)
+
+
+@pytest.fixture
+def diagnosis_a():
+    return ICDDiagnosis(
+        subject_id=1,
+        hadm_id=1,
+        seq_num=1,
+        icd_code="A001",
+        icd_version="10",
+    )
+
+
+def test_graph_is_loaded_once():
+    assert get_icd10_graph() is get_icd10_graph()
+
+
+def test_comparators_share_graph():
+    assert ICDComparator().G is ICDComparator().G
+
+
+def test_comparator_uses_given_graph():
+    G = get_icd10_graph()
+    assert ICDComparator(G=G).G is G
+
+
+def test_equal_diagnoses(diagnosis_a):
+    comp = ICDComparator()
+    assert comp.compare([diagnosis_a], [diagnosis_a]) == pytest.approx(1.0)
+
+
+@pytest.mark.parametrize("ic_metric", ["intrinsic_ic", "intrinsic_ic_sanchez"])
+@pytest.mark.parametrize(
+    "cs_metric", ["resnik", "resnik_scaled", "lin", "jiang", "jiang_seco"]
+)
+def test_index_matches_nxontology(ic_metric, cs_metric):
+    G = get_icd10_graph()
+    index = get_icd10_index()
+    codes = ["root", "A00-B99", "A00", "A001", "A009", "B20", "I10", "I110", "Z992"]
+    result = index.similarity_matrix(codes, codes, ic_metric, cs_metric)
+    for i, code_a in enumerate(codes):
+        for j, code_b in enumerate(codes):
+            expected = getattr(G.similarity(code_a, code_b, ic_metric), cs_metric)
+            assert result[i, j] == pytest.approx(expected)
+
+
+def test_index_backend_matches_nxontology_backend(diagnosis_a):
+    diagnoses_b = [
+        diagnosis_a.copy(update={"icd_code": code, "tfidf_score": 0.5})
+        for code in ["A009", "I10", "I110"]
+    ]
+    index_result = ICDComparator().compare([diagnosis_a], diagnoses_b)
+    nx_result = ICDComparator(backend="nxontology").compare([diagnosis_a], diagnoses_b)
+    assert index_result == pytest.approx(nx_result)
+
+
+def test_cached_comparator_matches_uncached(diagnosis_a):
+    diagnoses_b = [
+        diagnosis_a.copy(update={"icd_code": code, "tfidf_score": 0.5})
+        for code in ["A009", "I10", "I110"]
+    ]
+    cache = CodeSimilarityCache.from_diagnoses([diagnosis_a] + diagnoses_b)
+    assert len(cache) == 4
+    cached_result = ICDComparator(cache=cache).compare([diagnosis_a], diagnoses_b)
+    result = ICDComparator().compare([diagnosis_a], diagnoses_b)
+    assert cached_result == pytest.approx(result)
+
+
+def test_cache_matrix_is_symmetric():
+    cache = CodeSimilarityCache(["A00", "A001", "B20", "I10"], block_size=3)
+    matrix = cache.matrix("intrinsic_ic_sanchez", "lin")
+    assert (matrix == matrix.T).all()
+    assert matrix.diagonal() == pytest.approx(1.0)
+
+
+def test_store_reuses_flushed_similarities(tmp_path):
+    index = get_icd10_index()
+    codes = ["A00", "A001", "B20", "I10"]
+    store = CodePairSimilarityStore(index, path=str(tmp_path))
+    expected = index.similarity_matrix(codes, codes)
+    assert store.similarity_matrix(codes, codes) == pytest.approx(expected)
+    assert store.hits == 0
+    store.flush()
+
+    store = CodePairSimilarityStore(index, path=str(tmp_path))
+    assert store.similarity_matrix(codes, codes) == pytest.approx(expected)
+    assert store.misses == 0
+
+
+def test_concurrent_flushes_keep_all_pairs(tmp_path):
+    index = get_icd10_index()
+    store_a = CodePairSimilarityStore(index, path=str(tmp_path))
+    store_b = CodePairSimilarityStore(index, path=str(tmp_path))
+    store_a.similarity_matrix(["A00"], ["A001"])
+    store_b.similarity_matrix(["B20"], ["I10"])
+    store_a.flush()
+    store_b.flush()
+
+    store = CodePairSimilarityStore(index, path=str(tmp_path))
+    store.similarity_matrix(["A00", "B20"], ["A001", "I10"])
+    assert store.hits == 2
+
+
+def test_store_flushes_at_the_threshold(tmp_path):
+    index = get_icd10_index()
+    codes = ["A00", "A001", "B20", "I10"]
+    store = CodePairSimilarityStore(index, path=str(tmp_path), flush_threshold=4)
+    comp = ICDComparator(store=store)
+    comp.code_similarity_matrix(codes, codes)
+    assert store._pending == {}
+
+    store = CodePairSimilarityStore(index, path=str(tmp_path))
+    store.similarity_matrix(codes, codes)
+    assert store.misses == 0
+
+
+def test_normalizer_maps_icd9_codes_and_drops_unknown_codes(tmp_path):
+    path = tmp_path / "icd9_to_icd10_map.json"
+    icd9_map = [
+        {"code": "4019", "icd10_code": "I10"},
+        {"code": "4019", "icd10_code": "I15"},
+        {"code": "0010", "icd10_code": "XXX"},
+    ]
+    path.write_text(json.dumps({"data": icd9_map}))
+    normalizer = IcdCodeNormalizer.from_file(str(path))
+
+    codes, dropped = normalizer.normalize(
+        ["4019 ", "A001 ", "0010", "9999", "A001", "ZZZ"], [9, 10, 9, 9, 10, "10"]
+    )
+    assert codes.tolist() == ["I10", "A001", None, None, "A001", None]
+    assert dropped == {"unmapped": 1, "not_in_graph": 2}
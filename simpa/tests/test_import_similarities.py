@@ -0,0 +1,523 @@
+import asyncio
+import contextlib
+import random
+import re
+import subprocess
+import sys
+import threading
+import time
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+import simpa.src.import_similarities as imp
+import simpa.src.sql_queries as sq
+from simpa.src.constants import (
+    SIMILARITY_CATEGORIES,
+    VITAL_SIGN_NAMES,
+    VITALSIGN_STATISTICS,
+)
+from simpa.src.encounter_store import EncounterStore
+from simpa.src.helper import (
+    labevent_is_abnormal,
+    psycop_to_asyncpg_string,
+    vitalsign_is_abnormal,
+)
+from simpa.src.similarity_files import load_condensed, load_pair_segments
+from simpa.src.schemas import InputEvent, LabEvent, Prescription, Vitalsign
+
+# queries that import_similarities runs through asyncpg
+ASYNCPG_QUERIES = {
+    "sepsis_cohort": sq.sepsis_cohort,
+    "upsert_similarity_statistics": sq.upsert_similarity_statistics,
+    "similarity_run": sq.similarity_run,
+    "insert_similarity_run": sq.insert_similarity_run,
+    "similarity_tiles": sq.similarity_tiles,
+    "insert_similarity_tile": sq.insert_similarity_tile,
+    **{name: query for name, (query, _) in imp.FEATURE_QUERIES.items()},
+    **{
+        name: build(imp.FEATURE_WINDOWS)
+        for name, (build, _) in imp.WINDOWED_FEATURE_QUERIES.items()
+    },
+}
+
+
+@pytest.mark.parametrize("name", ASYNCPG_QUERIES)
+def test_asyncpg_queries_have_no_psycopg_placeholders(name):
+    converted = psycop_to_asyncpg_string(ASYNCPG_QUERIES[name])
+    assert "%s" not in converted
+    assert "$1" in converted
+
+
+WINDOWS = {"first6h": 6, "first24h": 24, "first48h": 48}
+
+
+def window_filter(column: str, hours: int) -> str:
+    return (
+        f"FILTER (WHERE {column} >= DATETIME_SUB(id.icu_intime, INTERVAL '6' HOUR) "
+        f"AND {column} <= DATETIME_ADD(id.icu_intime, INTERVAL '{hours}' HOUR))"
+    )
+
+
+def test_windowed_queries_have_a_filter_column_per_window():
+    labevents = sq.windowed_labevents(WINDOWS)
+    vitalsigns = sq.windowed_vitalsigns(WINDOWS)
+    for window, hours in WINDOWS.items():
+        assert (
+            f"AVG(le.valuenum) {window_filter('le.charttime', hours)} "
+            f"AS valuenum_{window}"
+        ) in labevents
+        for name in VITAL_SIGN_NAMES:
+            assert (
+                f"AVG(v.{name}) {window_filter('v.charttime', hours)} "
+                f"AS {name}_{window}"
+            ) in vitalsigns
+    assert labevents.count("FILTER") == len(WINDOWS)
+    assert vitalsigns.count("FILTER") == len(WINDOWS) * len(VITAL_SIGN_NAMES)
+    # one scan, the hadm_ids are the only parameter
+    for query in [labevents, vitalsigns]:
+        assert query.count("%s") == 1
+
+
+def test_windows_without_a_similarity_category_are_rejected(monkeypatch):
+    imp.check_feature_windows()
+    monkeypatch.setattr(imp, "FEATURE_WINDOWS", WINDOWS)
+    with pytest.raises(ValueError, match="first6h"):
+        imp.check_feature_windows()
+    with pytest.raises(ValueError):
+        asyncio.run(imp.main("similarities_windows"))
+
+
+def test_windowed_decoders_skip_null_window_columns(monkeypatch):
+    monkeypatch.setattr(imp, "FEATURE_WINDOWS", WINDOWS)
+    lab_record = {
+        "itemid": 1,
+        "subject_id": 10,
+        "hadm_id": 100,
+        "valuenum": 5.0,
+        "valueuom": "u",
+        "mean_value": 5.0,
+        "std_dev": 2.0,
+        "label": "x",
+        "ref_range_lower": 4.0,
+        "ref_range_upper": 6.0,
+        "valuenum_first6h": None,
+        "valuenum_first24h": 7.0,
+        "valuenum_first48h": None,
+    }
+    labevents = imp.decode_windowed_labevents(
+        [lab_record, {**lab_record, "hadm_id": 101, "valuenum_first24h": None}]
+    )
+    assert labevents["labevents"].hadm_ids.tolist() == [100, 101]
+    assert labevents["labevents_first24h"].hadm_ids.tolist() == [100]
+    assert labevents["labevents_first24h"].columns["value"].tolist() == [7.0]
+    for window in ["first6h", "first48h"]:
+        assert len(labevents[f"labevents_{window}"]) == 0
+
+    vitalsign_record = {
+        "subject_id": 10,
+        "hadm_id": 100,
+        **{name: 80.0 for name in VITAL_SIGN_NAMES},
+        **{f"{name}_{window}": None for name in VITAL_SIGN_NAMES for window in WINDOWS},
+        "heart_rate_first24h": 90.0,
+    }
+    vitalsigns = imp.decode_windowed_vitalsigns([vitalsign_record])
+    assert len(vitalsigns["vitalsigns"]) == len(VITAL_SIGN_NAMES)
+    assert vitalsigns["vitalsigns_first24h"].columns["id"].tolist() == ["heart_rate"]
+    for window in ["first6h", "first48h"]:
+        assert len(vitalsigns[f"vitalsigns_{window}"]) == 0
+
+
+class FakeConnection:
+    """In-memory asyncpg connection and pool for the Postgres sink. Like
+    asyncpg, it rejects queries whose $n placeholders do not match the
+    arguments."""
+
+    def __init__(self, records: dict[str, list[dict]]):
+        # converted query -> records of the feature and cohort queries
+        self.records = records
+        self.tables: dict[str, dict[tuple, tuple]] = {}
+        self.runs: dict[str, tuple] = {}
+        self.tiles: set[tuple] = set()
+        self.statistics: dict[tuple, tuple] = {}
+        # batches that are written before a write fails, None to never fail
+        self.fail_after = None
+
+    def check(self, query: str, args: tuple):
+        assert "%s" not in query
+        assert len(set(re.findall(r"\$(\d+)", query))) == len(args)
+
+    async def fetch(self, query: str, *args):
+        self.check(query, args)
+        if "FROM similarity_runs" in query:
+            run = self.runs.get(args[0])
+            return [{"hadm_ids": run[0], "parameters": run[1]}] if run else []
+        if "FROM similarity_tiles" in query:
+            return [
+                {"i_start": i, "j_start": j} for t, i, j in self.tiles if t == args[0]
+            ]
+        return self.records[query]
+
+    async def fetchrow(self, query: str, *args):
+        self.check(query, args)
+        rows = self.tables[re.search(r"FROM (\w+)", query).group(1)].values()
+        result = []
+        for c in range(len(imp.SIMILARITY_COLUMNS)):
+            values = [r[2 + c] for r in rows if r[2 + c] is not None]
+            result += [min(values, default=None), max(values, default=None)]
+        return result
+
+    async def execute(self, query: str, *args):
+        self.check(query, args)
+        if "INSERT INTO similarity_runs" in query:
+            self.runs[args[0]] = (args[1], args[2])
+        elif match := re.search(r"INSERT INTO (\w+) SELECT \* FROM (\w+)", query):
+            self.tables[match.group(1)].update(self.tables[match.group(2)])
+        elif match := re.search(r"CREATE TABLE IF NOT EXISTS (similarities\w*)", query):
+            self.tables.setdefault(match.group(1), {})
+
+    async def executemany(self, query: str, rows: list[tuple]):
+        self.check(query, rows[0])
+        if "similarity_tiles" in query:
+            self.tiles.update(rows)
+        elif "similarity_statistics" in query:
+            for table_name, category, min_value, max_value in rows:
+                self.statistics[(table_name, category)] = (min_value, max_value)
+
+    async def copy_records_to_table(self, table_name: str, records, columns):
+        if self.fail_after is not None:
+            if self.fail_after == 0:
+                raise ConnectionError("connection lost")
+            self.fail_after -= 1
+        for r in records:
+            self.tables[table_name][(r[0], r[1])] = r
+
+    @contextlib.asynccontextmanager
+    async def transaction(self):
+        yield
+
+    async def close(self):
+        pass
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+
+@pytest.fixture
+def database(monkeypatch):
+    """FakeConnection of a cohort with prescriptions only, tiled into 10 tiles."""
+    hadm_ids = list(range(100, 120))
+    rng = random.Random(0)
+    prescriptions = [
+        {
+            "subject_id": h,
+            "hadm_id": h,
+            "drug": "d",
+            "pharmacy_id": 1,
+            "gsn": "g",
+            "value": v,
+        }
+        for h in hadm_ids
+        for v in rng.sample(range(10), 3)
+    ]
+    conn = FakeConnection(
+        {
+            psycop_to_asyncpg_string(sq.sepsis_cohort): [
+                {"hadm_id": h} for h in hadm_ids
+            ],
+            psycop_to_asyncpg_string(sq.get_prescriptions_first_24h_icu): prescriptions,
+        }
+    )
+
+    async def connect(*args, **kwargs):
+        return conn
+
+    monkeypatch.setattr(imp.asyncpg, "connect", connect)
+    monkeypatch.setattr(imp.asyncpg, "create_pool", lambda *args, **kwargs: conn)
+    monkeypatch.setattr(
+        imp, "FEATURE_QUERIES", {"prescriptions": imp.FEATURE_QUERIES["prescriptions"]}
+    )
+    monkeypatch.setattr(imp, "WINDOWED_FEATURE_QUERIES", {})
+    monkeypatch.setattr(imp, "FEATURE_CACHE", False)
+    monkeypatch.setattr(imp, "SINK", "postgres")
+    monkeypatch.setattr(imp, "TILE_SIZE", 5)
+    monkeypatch.setattr(imp, "TILES_PER_BATCH", 2)
+    return conn
+
+
+def test_merged_shards_equal_a_single_run(database):
+    asyncio.run(imp.main("similarities_single"))
+    for k in range(3):
+        asyncio.run(imp.main("similarities_sharded", shard=(k, 3)))
+    asyncio.run(imp.merge_shards("similarities_sharded", 3))
+
+    single = database.tables["similarities_single"]
+    assert len(single) == 20 * 19 // 2
+    assert database.tables["similarities_sharded"] == single
+    for category in SIMILARITY_CATEGORIES:
+        assert (
+            database.statistics[("similarities_sharded", category)]
+            == database.statistics[("similarities_single", category)]
+        )
+
+
+def test_merged_file_shards_equal_a_single_run(database, monkeypatch, tmp_path):
+    monkeypatch.setattr(imp, "SINK", "files")
+    monkeypatch.setattr(imp, "SIMILARITY_DIR", str(tmp_path))
+    asyncio.run(imp.main("similarities_single"))
+    for k in range(3):
+        asyncio.run(imp.main("similarities_sharded", shard=(k, 3)))
+    asyncio.run(imp.merge_shards("similarities_sharded", 3))
+
+    # the shards only hold the pairs of their tiles
+    shard_pairs = sum(
+        len(segment)
+        for k in range(3)
+        for segment in load_pair_segments(
+            str(tmp_path / imp.shard_table_name("similarities_sharded", (k, 3)))
+        )
+    )
+    assert shard_pairs == 20 * 19 // 2
+    for category in SIMILARITY_CATEGORIES:
+        np.testing.assert_array_equal(
+            load_condensed(str(tmp_path / "similarities_sharded"), category),
+            load_condensed(str(tmp_path / "similarities_single"), category),
+        )
+
+
+def test_binary_lsh_compares_only_candidate_pairs(database, monkeypatch):
+    asyncio.run(imp.main("similarities_single"))
+    monkeypatch.setattr(imp, "BINARY_LSH", {"num_perm": 64, "threshold": 0.5})
+    asyncio.run(imp.main("similarities_lsh"))
+    assert imp.run_parameters()["BINARY_LSH"] == imp.BINARY_LSH
+
+    column = 2 + SIMILARITY_CATEGORIES.index("prescriptions")
+    single = database.tables["similarities_single"]
+    lsh = database.tables["similarities_lsh"]
+    assert lsh.keys() == single.keys()
+    compared = [pair for pair in lsh if lsh[pair][column] != 0]
+    # identical value sets are always candidates, pairs that are not are 0
+    assert all(lsh[pair][column] == single[pair][column] for pair in compared)
+    assert all(pair in compared for pair in single if single[pair][column] == 1)
+    assert 0 < len(compared) < len(single)
+
+
+def test_fewer_pending_tiles_than_a_batch(database, monkeypatch):
+    monkeypatch.setattr(imp, "MAX_PENDING_TILES", 1)
+    asyncio.run(asyncio.wait_for(imp.main("similarities_single"), timeout=30))
+    assert len(database.tables["similarities_single"]) == 20 * 19 // 2
+
+
+def test_interrupted_run_is_resumed(database):
+    asyncio.run(imp.main("similarities_single"))
+    database.fail_after = 2
+    with pytest.raises(ConnectionError):
+        asyncio.run(imp.main("similarities_resumed"))
+    assert 0 < len(database.tables["similarities_resumed"]) < 20 * 19 // 2
+
+    database.fail_after = None
+    asyncio.run(imp.main("similarities_resumed", resume=True))
+    assert (
+        database.tables["similarities_resumed"]
+        == database.tables["similarities_single"]
+    )
+
+
+def test_resume_ignores_the_shard_of_old_manifests():
+    parameters = imp.run_parameters()
+    manifest = {"hadm_ids": [2, 1], "parameters": dict(parameters, SHARD=[0, 2])}
+    assert imp.resume_cohort(manifest, [1, 2], "run", parameters) == [2, 1]
+    with pytest.raises(ValueError):
+        imp.resume_cohort(manifest, [1, 2], "run", dict(parameters, LIMIT=10))
+
+
+def category_records(hadm_ids: list[int]) -> dict[str, list[dict]]:
+    """Records of the item category queries, with missing values."""
+    rng = random.Random(1)
+    return {
+        "labevents": [
+            {
+                "itemid": itemid,
+                "subject_id": h,
+                "hadm_id": h,
+                "valuenum": None if rng.random() < 0.2 else rng.gauss(5, 2),
+                "valueuom": "u",
+                "mean_value": 5.0,
+                "std_dev": 0.0 if rng.random() < 0.2 else 2.0,
+                "ref_range_lower": 4.0,
+                "ref_range_upper": 6.0,
+            }
+            for h in hadm_ids
+            for itemid in rng.sample(range(6), 4)
+        ],
+        "vitalsigns": [
+            {
+                "subject_id": h,
+                "hadm_id": h,
+                **{n: rng.choice([None, rng.gauss(90, 20)]) for n in VITAL_SIGN_NAMES},
+            }
+            for h in hadm_ids
+        ],
+        "inputevents": [
+            {
+                "subject_id": h,
+                "hadm_id": h,
+                "itemid": itemid,
+                "amount": 1.234,
+                "amountuom": "ml",
+                "ordercategoryname": "c",
+            }
+            for h in hadm_ids
+            for itemid in rng.sample(range(10), 3)
+        ],
+        "prescriptions": [
+            {
+                "subject_id": h,
+                "hadm_id": h,
+                "drug": "d",
+                "pharmacy_id": 1,
+                "gsn": "g",
+                "value": value,
+            }
+            for h in hadm_ids
+            for value in rng.sample(range(10), 3)
+        ],
+    }
+
+
+def category_objects(records: dict[str, list[dict]]) -> dict[str, list]:
+    """The pydantic objects of the records, as the imports built them before
+    the EncounterStore."""
+    labevents = [
+        LabEvent(
+            id=i["itemid"],
+            subject_id=i["subject_id"],
+            itemid=i["itemid"],
+            value=i["valuenum"],
+            valueuom=i["valueuom"],
+            hadm_id=i["hadm_id"],
+            id_mean=i["mean_value"],
+            id_std_dev=i["std_dev"],
+            abnormal=labevent_is_abnormal(
+                i["valuenum"],
+                i["ref_range_lower"],
+                i["ref_range_upper"],
+                i["mean_value"],
+                i["std_dev"],
+            ),
+        )
+        for i in records["labevents"]
+        if i["valuenum"] is not None
+    ]
+    vitalsigns = [
+        Vitalsign(
+            id=name,
+            subject_id=i["subject_id"],
+            hadm_id=i["hadm_id"],
+            name=name,
+            value=i[name],
+            id_mean=VITALSIGN_STATISTICS[name]["mean"],
+            id_std_dev=VITALSIGN_STATISTICS[name]["std"],
+            abnormal=vitalsign_is_abnormal(i[name], name),
+        )
+        for i in records["vitalsigns"]
+        for name in VITAL_SIGN_NAMES
+        if i[name] is not None
+    ]
+    inputevents = [InputEvent(value=i["itemid"], **i) for i in records["inputevents"]]
+    prescriptions = [Prescription(**i) for i in records["prescriptions"]]
+    return {
+        "labevents": labevents,
+        "vitalsigns": vitalsigns,
+        "inputevents": inputevents,
+        "prescriptions": prescriptions,
+    }
+
+
+def test_store_tiles_match_the_object_comparisons(monkeypatch):
+    hadm_ids = list(range(100, 112))
+    records = category_records(hadm_ids)
+    store = EncounterStore()
+    store.add("labevents", imp.decode_labevents(records["labevents"]))
+    store.add("vitalsigns", imp.decode_vitalsigns(records["vitalsigns"]))
+    store.add("inputevents", imp.decode_inputevents(records["inputevents"]))
+    store.add("prescriptions", imp.decode_prescriptions(records["prescriptions"]))
+    # like main, encounters only have the categories they have rows of
+    encounters = [
+        {
+            "hadm_id": h,
+            **{
+                category: store.rows(category, h)
+                for category in store.categories
+                if len(store.rows(category, h)) > 0
+            },
+        }
+        for h in hadm_ids
+    ]
+    monkeypatch.setattr(imp, "encounters", [])
+    monkeypatch.setattr(imp, "cohort_store", EncounterStore())
+    imp.init_worker(encounters, store, None)
+
+    objects = category_objects(records)
+    comparators = {**imp.distribution_comps, **imp.binary_comps}
+    results = [imp.compare_tile(tile)[1] for tile in [(0, 6, 6, 12), (0, 6, 0, 6)]]
+    for result in results[0] + results[1]:
+        for category, items in objects.items():
+            items_a = [i for i in items if i.hadm_id == result["encounter_a"]]
+            items_b = [i for i in items if i.hadm_id == result["encounter_b"]]
+            expected = comparators[category].compare(items_a, items_b)
+            similarity = result["similarity"][f"{category}_sim"]
+            if expected is None:
+                assert similarity is None
+            else:
+                assert similarity == pytest.approx(expected, rel=1e-5)
+
+
+def test_import_and_worker_setup_do_not_load_the_icd10_graph():
+    # in a new process, the tests of this one have loaded the graph
+    code = (
+        "import simpa.src.icd_diagnoses as icd\n"
+        "import simpa.src.import_similarities as imp\n"
+        "imp.init_worker([], imp.EncounterStore(), None)\n"
+        "assert icd._icd10_graph is None and icd._icd10_index is None\n"
+    )
+    subprocess.run(
+        [sys.executable, "-c", code], check=True, cwd=Path(__file__).parents[2]
+    )
+
+
+class SlowResults:
+    """imap_unordered results whose tiles arrive after a wait."""
+
+    def __init__(self, tile_results, wait: float):
+        self.tile_results = iter(tile_results)
+        self.wait = wait
+
+    def next(self, timeout=None):
+        time.sleep(self.wait)
+        return next(self.tile_results)
+
+
+def test_compute_throughput_excludes_the_wait_for_tiles():
+    tile_results = [((0, 1, 1, 2), [{}], 0.001), ((0, 1, 2, 3), [{}, {}], 0.002)]
+
+    class Backend:
+        def imap_unordered(self, func, iterable):
+            return SlowResults(tile_results, wait=0.05)
+
+    async def compute():
+        queue = asyncio.Queue()
+        throughput = imp.StageThroughput("Compute")
+        await imp.compute_similarities(
+            Backend(), [], queue, threading.Semaphore(), threading.Event(), throughput
+        )
+        return throughput, [queue.get_nowait() for _ in range(queue.qsize())]
+
+    throughput, queued = asyncio.run(compute())
+    assert throughput.rows == 3
+    assert throughput.busy == pytest.approx(0.003)
+    assert queued == [((0, 1, 1, 2), [{}]), ((0, 1, 2, 3), [{}, {}]), None]
@@ -1,9 +1,11 @@
 import sys
 
+import numpy as np
 import pytest
 
 from simpa.src.schemas import LabEvent
 from simpa.src.labevents import LabEventComparator
+from simpa.src.base_comparators import DistributionItems
 
 
 @pytest.fixture
@@ -62,3 +64,67 @@ def test_closer_to_mean_is_less_similar(labevent_a):
     result_b = comp.compare(labevent_a=labevent_c, labevent_b=labevent_d)
 
     assert result_a < result_b
+
+
+def test_set_similarity_matches_pairs(labevent_a):
+    comp = LabEventComparator()
+    set_a = [labevent_a.copy(update={"value": v, "abnormal": True}) for v in (1, 3)]
+    set_b = [
+        labevent_a.copy(update={"hadm_id": 2, "value": 2.5}),
+        labevent_a.copy(update={"hadm_id": 2, "id": 2, "itemid": 2}),
+    ]
+    expected = [comp.compare(a, set_b[0]) for a in set_a]
+    assert comp.compare(set_a, set_b) == pytest.approx(sum(expected) / 2)
+
+
+def test_set_similarity_with_distribution_items(labevent_a):
+    comp = LabEventComparator()
+    labevent_b = labevent_a.copy(update={"hadm_id": 2, "value": 3})
+    items_a = DistributionItems.from_items([labevent_a])
+    items_b = DistributionItems.from_items([labevent_b])
+    assert comp.compare(items_a, items_b) == pytest.approx(
+        comp.compare(labevent_a, labevent_b)
+    )
+
+
+def test_set_similarity_without_common_items(labevent_a):
+    comp = LabEventComparator()
+    labevent_b = labevent_a.copy(update={"hadm_id": 2, "id": 2, "itemid": 2})
+    assert comp.compare([labevent_a], [labevent_b]) is None
+
+
+def test_cohort_similarity_matches_set_similarity(labevent_a):
+    comp = LabEventComparator()
+    encounters = [
+        [labevent_a.copy(update={"hadm_id": 1, "value": 1.5, "abnormal": False})],
+        [
+            labevent_a.copy(update={"hadm_id": 2, "value": 3}),
+            labevent_a.copy(update={"hadm_id": 2, "id": 2, "value": 0}),
+        ],
+        [labevent_a.copy(update={"hadm_id": 3, "id": 2, "value": -1})],
+        [labevent_a.copy(update={"hadm_id": 4, "value": 1.2, "abnormal": False})],
+    ]
+    items = [DistributionItems.from_items(e) for e in encounters] + [None]
+    result = comp.compare_cohort(items, block_size=3)
+    for i, a in enumerate(encounters):
+        for j, b in enumerate(encounters):
+            expected = comp.compare(a, b)
+            if expected is None:
+                assert np.isnan(result[i, j])
+            else:
+                assert result[i, j] == pytest.approx(expected)
+    assert np.isnan(result[4]).all()
+
+
+def test_block_similarity_matches_cohort_similarity(labevent_a):
+    comp = LabEventComparator()
+    items = [
+        DistributionItems.from_items(
+            [labevent_a.copy(update={"hadm_id": h, "id": h % 3, "value": v})]
+        )
+        for h, v in enumerate([1.5, 3, 0, -1, 1.2, 2.5])
+    ] + [None]
+    cohort = comp.compare_cohort(items)
+    for rows, columns in [(slice(0, 3), slice(3, 7)), (slice(2, 5), slice(2, 5))]:
+        block = comp.compare_block(items[rows], items[columns])
+        np.testing.assert_array_equal(block, cohort[rows, columns])
@@ -0,0 +1,91 @@
+import math
+import random
+
+import numpy as np
+import pytest
+
+from simpa.src.minhash import MinHashLSHIndex, lsh_parameters, num_perm_for_error
+from simpa.src.schemas import InputEvent
+from simpa.src.inputevents import InputEventComparator
+
+
+@pytest.fixture
+def value_sets():
+    return [
+        set(range(0, 100)),
+        set(range(5, 100)),
+        set(range(50, 150)),
+        set(range(1000, 1100)),
+    ]
+
+
+def test_estimate_within_error_bound(value_sets):
+    index = MinHashLSHIndex.from_error_bounds(epsilon=0.05, delta=0.01)
+    index.add(["a", "b", "c", "d"], value_sets)
+    assert index.error_bound(delta=0.01) <= 0.05
+    assert index.estimate("a", "a") == 1.0
+    assert index.estimate("a", "b") == pytest.approx(0.95, abs=0.05)
+    assert index.estimate("a", "c") == pytest.approx(50 / 150, abs=0.05)
+
+
+def test_similar_pairs(value_sets):
+    index = MinHashLSHIndex(num_perm=128, threshold=0.8)
+    index.add(["a", "b", "c", "d"], value_sets)
+    pairs = list(index.similar_pairs())
+    assert [(a, b) for a, b, _ in pairs] == [("a", "b")]
+
+
+def test_top_k(value_sets):
+    index = MinHashLSHIndex(num_perm=128, threshold=0.3)
+    index.add(["a", "b", "c", "d"], value_sets)
+    assert [key for key, _ in index.top_k("a", k=1)] == ["b"]
+    assert index.query(range(1000, 1100))[0] == ("d", 1.0)
+
+
+def test_empty_sets_are_never_candidates(value_sets):
+    index = MinHashLSHIndex(num_perm=128, threshold=0.3)
+    index.add(["a", "b", "c", "d", "e", "f"], value_sets + [set(), []])
+    assert math.isnan(index.estimate("e", "f"))
+    assert math.isnan(index.estimate("a", "e"))
+    assert all("e" not in pair and "f" not in pair for pair in index.similar_pairs())
+    assert index.top_k("e") == []
+    assert index.query([]) == []
+    assert "e" not in [key for key, _ in index.top_k("a", k=10)]
+
+
+def test_candidate_pairs_share_a_bucket():
+    rng = random.Random(0)
+    value_sets = [rng.sample(range(8), 3) for _ in range(40)]
+    index = MinHashLSHIndex(num_perm=32, threshold=0.5)
+    index.add(list(range(40)), value_sets)
+    expected = set()
+    for buckets in index.buckets:
+        for members in buckets.values():
+            for x, i in enumerate(members):
+                expected.update((i, j) for j in members[x + 1 :])
+    pairs = index.candidate_pairs()
+    assert [tuple(pair) for pair in pairs] == sorted(expected)
+    np.testing.assert_array_equal(
+        index.candidate_keys(), pairs[:, 0] * 40 + pairs[:, 1]
+    )
+
+
+def test_parameters():
+    bands, rows = lsh_parameters(128, 0.5)
+    assert bands * rows <= 128
+    assert (1 / bands) ** (1 / rows) == pytest.approx(0.5, abs=0.05)
+    assert num_perm_for_error(0.1, 0.05) == 185
+
+
+def test_lsh_index_from_comparator():
+    encounters = [
+        [
+            InputEvent(value=v, subject_id=1, hadm_id=h, itemid=v, amount=1.0)
+            for v in values
+        ]
+        for h, values in enumerate([[1, 2, 3], [1, 2, 3], [7, 8]])
+    ]
+    index = InputEventComparator().build_lsh_index([0, 1, 2, 3], encounters + [None])
+    assert index.estimate(0, 1) == 1.0
+    assert index.estimate(0, 2) < 0.5
+    assert math.isnan(index.estimate(0, 3))
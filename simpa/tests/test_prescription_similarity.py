@@ -1,5 +1,6 @@
 import sys
 
+import numpy as np
 import pytest
 
 from simpa.src.schemas import Prescription
@@ -27,4 +28,39 @@ def test_equal_prescriptions(presc_a):
     comp = PrescriptionComparator()
     assert comp.compare(prescription_a=[presc_a], prescription_b=[presc_a]) == 1.0
 
-    
\ No newline at end of file
+
+def test_cohort_similarity_matches_set_similarity(presc_a):
+    comp = PrescriptionComparator()
+    encounters = [
+        [presc_a.copy(update={"value": v}) for v in values]
+        for values in ([1, 2, 3], [2, 3, 3, 4], [5], [1])
+    ]
+    result = comp.compare_cohort(encounters + [[]], block_size=2)
+    for i, a in enumerate(encounters):
+        for j, b in enumerate(encounters):
+            assert result[i, j] == pytest.approx(comp.compare(a, b))
+    assert result[4, 0] == 0
+    assert np.isnan(result[4, 4])
+
+
+def test_block_similarity_matches_cohort_similarity():
+    comp = PrescriptionComparator()
+    value_sets = [[1, 2, 3], [2, 3, 3, 4], [5], [1], None, []]
+    cohort = comp.compare_cohort_values(value_sets)
+    for rows, columns in [(slice(0, 2), slice(2, 6)), (slice(1, 5), slice(1, 5))]:
+        block = comp.compare_block_values(value_sets[rows], value_sets[columns])
+        np.testing.assert_array_equal(block, cohort[rows, columns])
+
+
+def test_block_similarity_of_candidate_pairs():
+    comp = PrescriptionComparator()
+    value_sets = [[1, 2, 3], [2, 3, 3, 4], None, [5], [1], None, []]
+    cohort = comp.compare_cohort_values(value_sets)
+    pairs = (np.array([1, 2]), np.array([0, 3]))
+    block = comp.compare_block_values(value_sets[:3], value_sets[3:], pairs=pairs)
+    expected = np.where(np.isnan(cohort[:3, 3:]), np.nan, 0).astype(np.float32)
+    expected[pairs] = cohort[:3, 3:][pairs]
+    np.testing.assert_array_equal(block, expected)
+    # [1, 2, 3] and [1] are not a candidate pair
+    assert block[0, 1] == 0 and cohort[0, 4] > 0
+    assert np.isnan(block[2, 2])
@@ -0,0 +1,43 @@
+from simpa.src.schemas import ICDDiagnosis, LabEvent
+
+RECORD = {
+    "id": 50912,
+    "itemid": 50912,
+    "subject_id": 1,
+    "hadm_id": 2,
+    "value": 1.2,
+    "valuenum": 1.2,
+    "valueuom": "mg/dL",
+    "id_mean": 1.0,
+    "id_std_dev": 0.5,
+    "label": "Creatinine",
+}
+
+
+def test_from_records_equals_validated_records():
+    assert LabEvent.from_records([RECORD]) == [LabEvent(**RECORD)]
+
+
+def test_from_records_ignores_other_keys_and_sets_defaults():
+    [diagnosis] = ICDDiagnosis.from_records(
+        [
+            {
+                "subject_id": 1,
+                "hadm_id": 2,
+                "seq_num": 1,
+                "icd_code": "I10",
+                "icd_version": "10",
+                "long_title": "Essential (primary) hypertension",
+            }
+        ]
+    )
+    assert diagnosis.tfidf_score == 1.0
+    assert not hasattr(diagnosis, "long_title")
+    assert diagnosis.dict() == {
+        "subject_id": 1,
+        "hadm_id": 2,
+        "seq_num": 1,
+        "icd_code": "I10",
+        "icd_version": "10",
+        "tfidf_score": 1.0,
+    }
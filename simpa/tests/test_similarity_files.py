@@ -0,0 +1,170 @@
+import numpy as np
+import pytest
+from scipy.spatial.distance import squareform
+
+from simpa.src.similarity_files import (
+    SimilarityFileWriter,
+    SimilarityPairWriter,
+    aggregate_square_matrices,
+    condensed_index,
+    load_hadm_ids,
+    load_pair_segments,
+    load_similarity_matrix,
+    load_statistics,
+    load_square_matrix,
+    open_square_matrices,
+    scatter_pairs,
+)
+
+
+def test_condensed_index_matches_squareform():
+    n = 6
+    condensed = np.arange(n * (n - 1) // 2, dtype=float)
+    matrix = squareform(condensed)
+    i, j = np.triu_indices(n, k=1)
+    assert (condensed_index(i, j, n) == matrix[i, j]).all()
+    assert (condensed_index(j, i, n) == matrix[i, j]).all()
+
+
+def test_writer_round_trip(tmp_path):
+    hadm_ids = [30, 10, 20]
+    writer = SimilarityFileWriter(str(tmp_path), hadm_ids, categories=["diagnoses"])
+    writer.write(
+        [
+            {
+                "encounter_a": 10,
+                "encounter_b": 30,
+                "similarity": {"diagnoses_sim": 0.5},
+            },
+            {
+                "encounter_a": 10,
+                "encounter_b": 20,
+                "similarity": {"diagnoses_sim": None},
+            },
+        ]
+    )
+    writer.close()
+
+    assert list(load_hadm_ids(str(tmp_path))) == hadm_ids
+    matrix = load_similarity_matrix(str(tmp_path), "diagnoses")
+    assert matrix.dtype == np.float32
+    assert matrix[0, 1] == matrix[1, 0] == 0.5
+    assert np.isnan(matrix[1, 2]) and np.isnan(matrix[0, 2])
+    assert (matrix.diagonal() == 1).all()
+
+
+def test_scatter_pairs_mirrors_and_fills(tmp_path):
+    matrices = open_square_matrices(str(tmp_path), [1, 2, 3], ["a", "b"])
+    values = np.array([[0.5, np.nan], [0.25, 0.75]])
+    scatter_pairs(matrices, np.array([0, 1]), np.array([1, 2]), values)
+    for matrix in matrices.values():
+        matrix.flush()
+
+    a = load_square_matrix(str(tmp_path), "a")
+    b = load_square_matrix(str(tmp_path), "b")
+    assert a[0, 1] == a[1, 0] == 0.5
+    assert b[0, 1] == b[1, 0] == 0.0
+    assert b[1, 2] == b[2, 1] == 0.75
+    assert a[0, 2] == 0.0
+    assert (a.diagonal() == 1).all()
+
+
+@pytest.mark.parametrize("aggregate_method", ["mean", "rmse"])
+def test_aggregate_square_matrices(tmp_path, aggregate_method):
+    rng = np.random.default_rng(0)
+    matrices = open_square_matrices(str(tmp_path), [1, 2, 3, 4, 5], ["a", "b", "c"])
+    for matrix in matrices.values():
+        matrix[:] = rng.random(matrix.shape)
+        matrix.flush()
+    weights = {"a": 0.5, "b": 0.5, "c": 0.0}
+
+    result = aggregate_square_matrices(
+        str(tmp_path), weights, aggregate_method, block_size=2
+    )
+    a = matrices["a"].astype(np.float64)
+    b = matrices["b"].astype(np.float64)
+    if aggregate_method == "mean":
+        expected = 0.5 * a + 0.5 * b
+    else:
+        expected = np.sqrt(0.5 * a**2 + 0.5 * b**2)
+    assert result == pytest.approx(expected, rel=1e-6)
+
+
+def test_aggregate_unknown_method(tmp_path):
+    open_square_matrices(str(tmp_path), [1, 2], ["a"])
+    with pytest.raises(ValueError):
+        aggregate_square_matrices(str(tmp_path), {"a": 1.0}, "median")
+
+
+def test_scaled_matrix_uses_run_statistics(tmp_path):
+    writer = SimilarityFileWriter(str(tmp_path), [1, 2, 3], categories=["labevents"])
+    for (a, b), value in {(1, 2): 0.2, (1, 3): 0.6, (2, 3): None}.items():
+        writer.write(
+            [
+                {
+                    "encounter_a": a,
+                    "encounter_b": b,
+                    "similarity": {"labevents_sim": value},
+                }
+            ]
+        )
+    writer.close()
+
+    statistics = load_statistics(str(tmp_path))
+    assert statistics.min["labevents"] == pytest.approx(0.2)
+    assert statistics.max["labevents"] == pytest.approx(0.6)
+    matrix = load_similarity_matrix(str(tmp_path), "labevents", scaled=True)
+    assert matrix[0, 1] == pytest.approx(0.0)
+    assert matrix[2, 0] == pytest.approx(1.0)
+    assert np.isnan(matrix[1, 2])
+    assert matrix[1, 1] == 1.0
+
+
+def test_resumed_writer_keeps_written_pairs(tmp_path):
+    def result(a, b, value):
+        return {"encounter_a": a, "encounter_b": b, "similarity": {"x_sim": value}}
+
+    writer = SimilarityFileWriter(str(tmp_path), [1, 2, 3], categories=["x"])
+    writer.write([result(1, 2, 0.2)])
+    writer.flush()
+
+    writer = SimilarityFileWriter(str(tmp_path), [1, 2, 3], ["x"], resume=True)
+    writer.write([result(1, 3, 0.6)])
+    writer.close()
+
+    matrix = load_similarity_matrix(str(tmp_path), "x")
+    assert matrix[0, 1] == pytest.approx(0.2)
+    assert matrix[0, 2] == pytest.approx(0.6)
+    assert load_statistics(str(tmp_path)).min["x"] == pytest.approx(0.2)
+
+
+def test_pair_writers_are_merged(tmp_path):
+    def result(a, b, value):
+        return {"encounter_a": a, "encounter_b": b, "similarity": {"x_sim": value}}
+
+    hadm_ids = [1, 2, 3, 4]
+    shards = [str(tmp_path / "shard0"), str(tmp_path / "shard1")]
+    writer = SimilarityPairWriter(shards[0], hadm_ids, categories=["x"])
+    writer.write([result(1, 2, 0.2), result(1, 3, None)])
+    writer.close()
+    writer = SimilarityPairWriter(shards[1], hadm_ids, categories=["x"])
+    writer.write([result(3, 4, 0.6)])
+    writer = SimilarityPairWriter(shards[1], hadm_ids, ["x"], resume=True)
+    writer.write([result(2, 4, 0.4)])
+    writer.close()
+
+    # a shard only stores its own pairs
+    assert [len(s) for s in load_pair_segments(shards[1])] == [1, 1]
+    assert load_statistics(shards[1]).min["x"] == pytest.approx(0.4)
+
+    merged = str(tmp_path / "merged")
+    writer = SimilarityFileWriter(merged, hadm_ids, categories=["x"])
+    writer.merge(shards)
+    writer.close()
+    matrix = load_similarity_matrix(merged, "x")
+    assert matrix[0, 1] == pytest.approx(0.2)
+    assert matrix[2, 3] == pytest.approx(0.6)
+    assert matrix[1, 3] == pytest.approx(0.4)
+    assert np.isnan(matrix[0, 2]) and np.isnan(matrix[0, 3])
+    assert writer.rows == 4
+    assert load_statistics(merged).max["x"] == pytest.approx(0.6)